@@ -1,6 +1,6 @@
 
 # import modules
-from flask import Flask, render_template, g
+from flask import Flask, render_template, g, request, abort, make_response, jsonify
 import os, sys
 import flask_sijax
 from werkzeug import secure_filename
@@ -9,7 +9,25 @@ import inspect
 import importlib
 import time
 import re
+import logging
+import threading
+import functools
+import collections
+import copy
 from plots import *
+from workers import close_pool, get_pool
+from inprocess import unload_routine, ENTRY_POINT
+from images import image_store
+from metrics import metrics, push_seconds, pushed_bytes, missed_deadlines, shot_selection_seconds
+from scheduler import Scheduler
+from runcontrol import ActiveRuns, run_timeouts, TIMED_OUT, CANCELLED, MAX_BACKOFF_EXPONENT
+from hub import hub, make_key
+from push import PushServer
+from shotwatch import watch_shots, unwatch_shots, ArrivalStore
+from graph import GraphError, get_dependencies, get_closure, get_dependents, sort_routines, group_routines
+from registry import RoutineRegistry
+from jsonfiles import json_files
+from statestore import is_store_path
 
 
 # initialize and configure Flask
@@ -17,17 +35,40 @@ app = Flask(__name__)
 sijax_path = os.path.join('.', os.path.dirname(__file__), 'static/js/sijax/')
 app.config.update(
     SIJAX_STATIC_PATH=sijax_path,
-    SIJAX_JSON_URI='/static/js/sijax/json2.js'
+    SIJAX_JSON_URI='/static/js/sijax/json2.js',
+    # number of routine runs that can execute at the same time
+    ANALYSIS_WORKERS=os.cpu_count() or 1,
+    # address the plot pages receive their updates from
+    PUSH_HOST="127.0.0.1",
+    PUSH_PORT=5001
 )
 flask_sijax.Sijax(app)
+# one scheduler runs every active routine
+# routines whose runs time out are given more time before their next run
+scheduler = Scheduler(app.config["ANALYSIS_WORKERS"], backoff=run_timeouts.get_backoff)
 # add routines to path
 routine_path = os.path.join(app.root_path, "routines")
 JSON_path = os.path.join(routine_path, "routines.json")
+# routines, supporting files and folders shared by all handlers
+registry = RoutineRegistry(JSON_path, routine_path)
+# the last shot analysed by every routine analysing shots as they arrive
+arrivals = ArrivalStore(os.path.join(routine_path, "arrivals.json"))
+# batches of arrived shots a routine failed to analyse as (identities of the shots indexed by name, function analysing the
+# next batch right away) indexed by arrival key, which are analysed again until they succeed or are skipped
+failed_batches = {}
+failed_batches_lock = threading.Lock()
+# pushes the results of the analyses to the plot pages, stopping the analyses of pages that went away
+push_server = PushServer(app.config["PUSH_HOST"], app.config["PUSH_PORT"], on_expire=hub.leave, on_resync=lambda viewer_id: resync_viewer(viewer_id))
 sys.path.append(routine_path)
-# set global variables
-analysis_on = False
-shots_to_analyse = {}
-start_time = time.time()
+# write the printed output of the routines to a log file
+routine_log_handler = logging.FileHandler(os.path.join(app.root_path, "routines.log"))
+routine_log_handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+logging.getLogger("routines").addHandler(routine_log_handler)
+logging.getLogger("routines").setLevel(logging.INFO)
+# minimum time (in seconds) between two progress reports of the old analysis
+PROGRESS_INTERVAL = 1
+# number of shots in each page of the shots picker
+SHOTS_PAGE_SIZE = 100
 
 
 # read a python script and write information to json
@@ -54,97 +95,70 @@ def get_routine_info(routine_name):
     return routine_info
 
 
-# a wrapper for the recursive make_tree function
+# get the folder tree of routines and supporting files to pass to the main template
 def make_tree_wrapper():
-    global routine_path, JSON_path
-    # read paths and routines from the routine json file
-    with open(JSON_path, 'r') as file:
-        data = json.load(file)
-        paths = list(map(lambda path: path.split('/'), data["paths"]))
-        routines = [routine for routine in data["routines"] if routine["name"] in os.listdir(routine_path)]
-        supports = [support for support in data["support"] if support["name"] in os.listdir(routine_path)]
-
-    # create a nested file/folder object from json file to pass to the main template
-    def make_tree(tree_path):
-        if tree_path:
-            name = tree_path[-1]
-        else:
-            name = ""
-        tree_path_joined = "/".join(tree_path)
-        tree = dict(name=name, children=[], path=tree_path_joined)
-        subpaths = [path for path in paths if len(path) == len(tree_path) + 1 and path[:-1] == tree_path]
-        for subpath in subpaths:
-            tree["children"].append(make_tree(subpath))
-        subroutines = [routine for routine in routines if routine["path"] == tree_path_joined]
-        for subroutine in subroutines:
-            tree["children"].append(dict(name=subroutine["name"], path=subroutine["path"], routine=True))
-        subsupports = [support for support in supports if support["path"] == tree_path_joined]
-        for subsupport in subsupports:
-            tree["children"].append(dict(name=subsupport["name"], path=subsupport["path"], routine=False))
-        return tree
-    return make_tree([])
-
-
-# decorator generator for reading and writing to the routine json file
+    return registry.get_tree()
+
+
+# decorator generator giving a handler the routine data, which is written back to the routine json file in the background if it changes
 def update_JSON(write = True):
-    global JSON_path
 
-    # decorator for reading and writing to the routine json file
+    # decorator for reading and changing the routine data
     def decorator(func):
 
         def wrapper(*args, **kwargs):
-            # read the routine json file
-            with open(JSON_path, "r") as file:
-                data = json.load(file)
-            data = func(*args, **kwargs, data=data)
-            if write:
-                # write to the routine json file
-                with open(JSON_path, "w") as file:
-                    json.dump(data, file)
+            if not write:
+                # handlers only reading the routine data get a copy of it, so the runs and file accesses they do don't
+                # hold up the other handlers
+                with registry.lock:
+                    data = copy.deepcopy(registry.data)
+                func(*args, **kwargs, data=data)
+                return
+            # handlers changing the routine data run one at a time so they don't overwrite each other's changes
+            with registry.lock:
+                func(*args, **kwargs, data=registry.data)
+                registry.changed()
         return wrapper
     return decorator
 
-
 # send a message to an html element
 def report_status(obj_response, container_id, msg):
     obj_response.html_append("#%s" % container_id, "%s<br/>" % msg)
 
+# get the names of the routines other than a routine in the routine data, which it can depend on
+def get_other_routines(data, routine_name):
+    return sorted(routine["name"] for routine in data["routines"] if routine["name"] != routine_name)
+
+# get a routine by its name from the routine data given to a handler
+def find_routine(data, routine_name):
+    return next(routine for routine in data["routines"] if routine["name"] == routine_name)
+
+# stop the routines depending on removed routines from depending on them
+def forget_dependencies(removed):
+    for routine in registry.data["routines"]:
+        if any(name in removed for name in get_dependencies(routine)):
+            routine["depends_on"] = [name for name in get_dependencies(routine) if name not in removed]
+
 
 # get the data directory from the routine json file
 def get_data_dir():
-    global JSON_path
-    with open(JSON_path, "r") as file:
-        data_dir = json.load(file)["data_dir"]
+    data_dir = registry.data["data_dir"]
     if data_dir == "":
         return "None"
     else:
         return data_dir
 
 
-# count the files in the shots directory separated by file type
-def count_files(dir):
-    file_count = {"total": 0}
-    filenames = [filename for filename in os.listdir(dir) if os.path.isfile(os.path.join(dir, filename)) and not filename.startswith(".")]
-    for filename in filenames:
-        extension = filename.rsplit('.', 1)[1].lower()
-        if extension in file_count.keys():
-            file_count[extension] += 1
-        else:
-            file_count[extension] = 1
-        file_count["total"] += 1
-    return file_count
-
-
 # update the shots count table
 def update_shots_count(obj_response, shots_dir_path):
-    obj_response.html("#shots-table-body", "")
-    file_count = count_files(shots_dir_path)
-    for filetype in file_count.keys():
-        if filetype != "total":
-            obj_response.html_append("#shots-table-body", "<tr><td>%s</td><td>%d</td></tr>" % (filetype, file_count[filetype]))
+    catalog = get_catalog(shots_dir_path)
+    catalog.refresh()
+    file_count = catalog.count_extensions()
+    rows = ["<tr><td>%s</td><td>%d</td></tr>" % (html.escape(filetype or "none"), count) for filetype, count in sorted(file_count.items())]
     # display the total number of files if there are multiple file types
-    if len(file_count.keys()) != 2:
-        obj_response.html_append("#shots-table-body", "<tr><td>%s</td><td>%d</td></tr>" % ("total", file_count["total"]))
+    if len(file_count) > 1:
+        rows.append("<tr><td>%s</td><td>%d</td></tr>" % ("total", sum(file_count.values())))
+    obj_response.html("#shots-table-body", "".join(rows))
 
 
 # update the options for the shots directory
@@ -157,8 +171,8 @@ def update_shots_dir_options(obj_response, routine, data_dir):
         report_status(obj_response, "status", "Warning: '%s' is no longer a valid directory" % data_dir)
         return
     obj_response.css('.shots-info', "display", "inline")
-    # list all subdirectories of the data directory
-    subdirs = [subdir for subdir in os.listdir(data_dir) if os.path.isdir(os.path.join(data_dir, subdir))]
+    # list all subdirectories of the data directory, except the directories holding the state of read-write files
+    subdirs = [subdir for subdir in os.listdir(data_dir) if os.path.isdir(os.path.join(data_dir, subdir)) and not is_store_path(os.path.join(data_dir, subdir))]
     # add the 'none' option
     obj_response.html("#shots-dir-options", "<option value=''>none</option>")
     shots_dir = routine["shots_dir"]
@@ -181,15 +195,6 @@ def update_shots_dir_options(obj_response, routine, data_dir):
             update_shots_choice(obj_response, routine["analysis"]["old_options"], shots_dir, data_dir)
 
 
-# check if a file is json loadable
-def is_json_loadable(filename):
-    try:
-        json.load(open(filename))
-        return True
-    except Exception:
-        return False
-
-
 # update the read-write json file options
 def update_json_options(obj_response, routine, data_dir):
     # if there's no data directory, hide all shots information
@@ -200,8 +205,8 @@ def update_json_options(obj_response, routine, data_dir):
         report_status(obj_response, "status", "Warning: '%s' is no longer a valid directory" % data_dir)
         return
     obj_response.css('.shots-info', "display", "inline")
-    # list all json loadable files in the data directory
-    json_options = [file for file in os.listdir(data_dir) if os.path.isfile(os.path.join(data_dir, file)) and is_json_loadable(os.path.join(data_dir, file))]
+    # list the json files in the data directory that can be used as read-write files
+    json_options = json_files.list_files(data_dir)
     obj_response.html("#json-options", "<option value=''>none</option>")
     # add an option for each json file and select the option if necessary
     for json_file in json_options:
@@ -213,17 +218,15 @@ def update_json_options(obj_response, routine, data_dir):
 
 # update the shots choice options
 def update_shots_choice(obj_response, analysis_options, shots_dir, data_dir):
-    choice = analysis_options["choice"]
     shots_dir_path = os.path.join(data_dir, shots_dir)
-    # list all files in the shots directory
-    shots = [shot for shot in os.listdir(shots_dir_path) if os.path.isfile(os.path.join(shots_dir_path, shot)) and not shot.startswith(".")]
-    # reset the shots choice options
-    obj_response.html("#shots-choice", "")
-    # add an option for each file and select the option if necessary
-    for shot in shots:
-        obj_response.html_append("#shots-choice", "<option value='%s'>%s</option>" % (shot, shot))
-        if shot in choice:
-            obj_response.attr("option[value|='%s']" % shot, "selected", "selected")
+    if not shots_dir or not os.path.isdir(shots_dir_path):
+        obj_response.call("set_shots_choice", [[]])
+        return
+    catalog = get_catalog(shots_dir_path)
+    catalog.refresh()
+    # only send the chosen shots that still exist, the picker fetches the others page by page from /shots
+    choice = [shot for shot in analysis_options["choice"] if shot in catalog.stats]
+    obj_response.call("set_shots_choice", [choice])
 
 def update_filetype(obj_response, analysis_options):
     filetypes = analysis_options["filetype"]
@@ -246,6 +249,7 @@ def update_analysis_options(obj_response, routine, data_dir):
         analysis_options = routine["analysis"]["old_options"]
         analysis_method = analysis_options["order-shots-by"]
         obj_response.attr("#order-shots-by option[value|='%s']" % analysis_method, "selected", "selected")
+        obj_response.script("$('#parallel').prop('checked', %s);" % json.dumps(bool(analysis_options.get("parallel"))))
     num_shots = analysis_options["num-shots"]
     frequency = analysis_options["frequency"]
     regex = analysis_options["regex"]
@@ -287,10 +291,10 @@ def add_routine(obj_response, files, form_values, data):
         report_status(obj_response, "status", "'%s' is not a python script" % filename)
         return data
     # send a warning if another routine exists with the same name
-    elif filename in [routine["name"] for routine in data["routines"]]:
+    elif registry.has_routine(filename):
         report_status(obj_response, "status", "A routine by the name '%s' already exists" % filename)
         return data
-    elif filename in [support["name"] for support in data["support"]]:
+    elif registry.has_support(filename):
         report_status(obj_response, "status", "A supporting file by the name '%s' already exists" % filename)
         return data
     path = form_values['path'][0]
@@ -304,11 +308,11 @@ def add_routine(obj_response, files, form_values, data):
         return data
     # set default analysis options
     default_new_analysis_options = {"select-shots-by": "choice", "num-shots": "1", "choice": [], "frequency": ".2", "filetype": [], "regex": ""}
-    default_old_analysis_options = {"order-shots-by": "choice", "num-shots": "1", "choice": [], "frequency": ".2", "filetype": [], "regex": ""}
+    default_old_analysis_options = {"order-shots-by": "choice", "num-shots": "1", "choice": [], "frequency": ".2", "filetype": [], "regex": "", "parallel": False}
     default_analysis_options = dict(new=True, new_options=default_new_analysis_options, old_options=default_old_analysis_options)
-    routine_all_info = dict(name=filename, path=path, shots_dir="", json="", analysis=default_analysis_options, active=True)
+    routine_all_info = dict(name=filename, path=path, shots_dir="", json="", execution="worker", priority=0, timeout=0, analysis=default_analysis_options, active=True)
     routine_all_info.update(routine_info)
-    data['routines'].append(routine_all_info)
+    registry.add_file(routine_all_info, True)
     obj_response.call('add_file', [path, filename, True])
     report_status(obj_response, "status", "'%s' successfully uploaded" % filename)
     return data
@@ -323,41 +327,43 @@ def add_support(obj_response, files, form_values, data):
         report_status(obj_response, "status", "Nothing uploaded")
         return data
     # send a warning if another routine exists with the same name
-    elif filename in [routine["name"] for routine in data["routines"]]:
+    elif registry.has_routine(filename):
         report_status(obj_response, "status", "A routine by the name '%s' already exists" % filename)
         return data
-    elif filename in [support["name"] for support in data["support"]]:
+    elif registry.has_support(filename):
         report_status(obj_response, "status", "A supporting file by the name '%s' already exists" % filename)
         return data
     path = form_values['path'][0]
     file_path_app = os.path.join(routine_path, filename)
     file_data.save(file_path_app)
-    data['support'].append(dict(name=filename, path=path))
+    registry.add_file(dict(name=filename, path=path), False)
     obj_response.call('add_file', [path, filename, False])
     report_status(obj_response, "status", "'%s' successfully uploaded" % filename)
     return data
 
-def analyse_routine_new(obj_response, data_dir, routine, period):
-    global analysis_on, routine_path, JSON_path, start_time
-    analysis_on = True
-    start_time = time.time()
-    reported_error = False
-    # loop analysis until paused or stopped
-    while analysis_on:
-        iter_start = time.time()
-        error, plots = generate_plot_urls(routine, routine_path, data_dir)
-        if error:
-            report_status(obj_response, "status", plots)
-            obj_response.call("stop_analysis")
-        for plot in plots:
-            update_plot(obj_response, plot["url"], plot["plot_id"], plot["data"], plot["table_id"], routine["name"], plot["name"])
-            yield obj_response
-        sleep_time = period - (time.time() - iter_start)
-        if sleep_time >= 0:
-            time.sleep(sleep_time)
-        elif not reported_error and analysis_on:
-            report_status(obj_response, "status", "Warning: update period is faster than execution time by %.3g seconds for '%s'. Try setting a lower frequency" % (-sleep_time, routine["name"]))
-            reported_error = True
+# get the scheduling priority of a routine
+def get_priority(routine):
+    try:
+        return int(routine.get("priority", 0))
+    except ValueError:
+        return 0
+
+
+# get the warning about a routine missing its update period
+def get_missed_warning(routine, missed):
+    return "Warning: '%s' missed %d update(s) because its execution takes longer than the update period. Try setting a lower frequency" % (routine["name"], missed)
+
+
+# get the warning about a failed run of a routine on arrived shots, which are analysed again after retry seconds
+def get_retry_warning(routine, msg, num_shots, retry):
+    return "Warning: %s<br/>'%s' analyses the %d shot(s) again in %s, unless they are skipped" % (msg, routine["name"], num_shots, format_time(retry))
+
+
+# get the warning about a run of a routine that was killed because it took longer than its timeout
+def get_timeout_warning(routine, msg, periodic=True):
+    if periodic:
+        msg += ", so it now runs every %d update periods until a run finishes in time" % run_timeouts.get_backoff(routine["name"])
+    return "Warning: %s" % msg
 
 def format_time(seconds):
     if seconds > 86400:
@@ -371,35 +377,525 @@ def format_time(seconds):
     else:
         return "%.3g seconds" % seconds
 
-def analyse_routine_old(obj_response, data_dir, routine, period):
-    global analysis_on, routine_path, JSON_path, shots_to_analyse, start_time
-    analysis_on = True
-    start_time = time.time()
-    reported_error = False
+# describe how many old shots were analysed, how fast and how long the rest will take
+def format_progress(num_done, num_total, elapsed):
+    throughput = num_done / elapsed if elapsed > 0 else 0
+    remaining = format_time((num_total - num_done) / throughput) if throughput else "unknown"
+    return "%d/%d shots, %.3g shots/s, %s left" % (num_done, num_total, throughput, remaining)
+
+# publish the result of a run to the pages watching the analysis, dropping the results of cancelled runs
+def publish_result(channel, result, finished, timeout_msg=""):
+    error, plots = result
+    if error == CANCELLED:
+        return
+    if error == TIMED_OUT:
+        channel.publish(("warning", get_timeout_warning(channel.routine, plots + timeout_msg, channel.routine["analysis"]["new"] or not is_parallel(channel.routine))))
+    elif error:
+        channel.publish(("error", plots))
+    else:
+        channel.publish(("plots", plots, finished))
+
+# publish how many old shots were analysed, at most every PROGRESS_INTERVAL unless forced
+def publish_progress(channel, force=False):
+    state = channel.state
+    if force or time.time() - state["last_progress"] > PROGRESS_INTERVAL:
+        state["last_progress"] = time.time()
+        channel.publish(("progress", state["num_done"], state["num_total"], state["last_progress"] - state["started"]))
+
+# tell the pages that all old shots were analysed and stop the analysis
+def complete_analysis(channel):
+    publish_progress(channel, force=True)
+    analysis_time = format_time(time.time() - channel.state["started"])
+    channel.complete("Analysis for '%s' complete after %s" % (channel.routine["name"], analysis_time))
+
+# check if the old shots of a routine are analysed in chunks running side by side
+# chunks can only run side by side if they don't depend on the state left by the previous ones
+def is_parallel(routine):
+    return bool(routine["analysis"]["old_options"].get("parallel") and not routine["json"])
+
+# check if a routine is active and analyses its latest shots every period, which makes it run as a graph with the
+# routines it depends on
+def is_periodic(routine):
+    return is_routine_active(routine) and routine["analysis"]["new"] and routine["analysis"]["new_options"]["select-shots-by"] != "arrival"
+
+# get the names of the periodic routines among routines indexed by name
+def get_periodic_routines(routines):
+    return [name for name, routine in routines.items() if is_periodic(routine)]
+
+# get the routines of the graph a routine runs in indexed by name, which are the periodic routines it depends on or that
+# depend on it, directly or through others, and all routines they depend on, or None if it doesn't run in a graph
+# the graph runs with a copy of the routines, so it doesn't hold the registry lock while it runs
+def get_graph(routine_name):
+    with registry.lock:
+        routines = copy.deepcopy(registry.routines)
+    routines = get_closure(get_periodic_routines(routines), routines)
+    for group in group_routines(routines):
+        if routine_name in group and len(group) > 1:
+            return {name: routines[name] for name in group}
+    return None
+
+# get the results of the routines a routine depends on for the first run of an analysis, running the routines whose plots
+# aren't in plots yet, which holds the plots of the routines that ran (or None if they failed) indexed by name
+# routines holds all routines indexed by name
+def get_initial_upstream(routine, data_dir, plots, routines):
+    upstream = {}
+    for name in get_dependencies(routine):
+        if name not in plots:
+            dependency = routines[name]
+            error, result = generate_plot_urls(dependency, routine_path, data_dir, upstream=get_initial_upstream(dependency, data_dir, plots, routines))
+            plots[name] = None if error else result
+        if plots[name] is not None:
+            upstream[name] = get_results(plots[name])
+    return upstream
+
+# run a routine on the latest shots every period, returning a function that stops it
+def start_new_engine(channel):
+    routine = channel.routine
+    # runs in progress, cancelled when the analysis stops
+    runs = ActiveRuns()
+
+    # pass each plot on as soon as it is made, and all plots of the run once it finished
+    def run():
+        return generate_plot_urls(routine, routine_path, channel.data_dir, on_plot=lambda plot: channel.publish(("plot", plot)), runs=runs)
+
+    def deliver(result, missed):
+        if result is None:
+            return
+        publish_result(channel, result, time.perf_counter())
+        if missed:
+            missed_deadlines.inc(missed, routine=routine["name"])
+            channel.publish(("missed", missed))
+
+    job = scheduler.add(routine["name"], channel.period, run, deliver, get_priority(routine))
+
+    def stop():
+        scheduler.remove(job)
+        runs.cancel_all()
+    return stop
+
+# the routines of a graph running every period, each routine as soon as the routines it depends on finished and with their
+# results, so routines that don't depend on each other run side by side on the scheduler
+# the routines depending on a routine that failed are skipped until the next period, and the plots of every routine are
+# published to its channel while a page watches it
+class GraphRun(object):
+
+    def __init__(self, key, data_dir, routines, period):
+        self.key = key
+        self.data_dir = data_dir
+        self.routines = routines
+        self.period = period
+        self.order = sort_routines(routines)
+        self.dependents = get_dependents(routines)
+        # channels of the routines of the graph watched by pages indexed by routine name
+        self.channels = {}
+        self.runs = ActiveRuns()
+        self.lock = threading.Lock()
+        self.job = None
+        # number of the current run of the graph, so routines of abandoned runs are neither started nor handed on
+        self.ticks = 0
+        # number of unfinished dependencies of the routines of the current run that didn't start yet, or None between runs
+        self.waiting = None
+        self.running = 0
+        # results of the routines of the current run that finished
+        self.results = {}
+        # runs of the graph skipped because the previous run didn't finish in time
+        self.missed = 0
+
+    # publish the plots of a routine to a channel, starting the runs of the graph if necessary
+    def attach(self, channel):
+        with self.lock:
+            self.channels[channel.routine["name"]] = channel
+            if self.job is None:
+                priority = max(get_priority(routine) for routine in self.routines.values())
+                self.job = scheduler.add(self.key, self.period, self.tick, self.deliver, priority)
+
+    # stop publishing to a channel, stopping the runs of the graph and returning True if no channel is left
+    def detach(self, channel):
+        with self.lock:
+            if self.channels.get(channel.routine["name"]) is channel:
+                del self.channels[channel.routine["name"]]
+            if self.channels or self.job is None:
+                return not self.channels
+            scheduler.remove(self.job)
+            self.job = None
+            self.ticks += 1
+            self.waiting = None
+        self.runs.cancel_all()
+        return True
+
+    # start a run of the graph with the routines that don't depend on others, unless the previous run didn't finish yet
+    def tick(self):
+        with self.lock:
+            if self.job is None:
+                return
+            if self.waiting is not None:
+                self.missed += 1
+                return
+            self.ticks += 1
+            self.waiting = {name: len(set(get_dependencies(routine))) for name, routine in self.routines.items()}
+            self.running = 0
+            self.results = {}
+            ready = self.take_ready()
+        self.submit(ready)
+
+    # report the runs of the graph that were skipped
+    def deliver(self, result, missed):
+        with self.lock:
+            missed, self.missed = missed + self.missed, 0
+            channels = list(self.channels.values())
+        if missed:
+            for channel in channels:
+                missed_deadlines.inc(missed, routine=channel.routine["name"])
+                channel.publish(("missed", missed))
+
+    # take the routines whose dependencies all finished as (name, results of its dependencies), holding the lock
+    def take_ready(self):
+        ready = []
+        for name in self.order:
+            if self.waiting.get(name) == 0:
+                del self.waiting[name]
+                self.running += 1
+                ready.append((name, {dependency: self.results[dependency] for dependency in get_dependencies(self.routines[name])}))
+        return ready
+
+    # run routines on the scheduler
+    def submit(self, ready):
+        tick = self.ticks
+        for name, upstream in ready:
+            future = scheduler.submit(name, functools.partial(self.run, tick, name, upstream), get_priority(self.routines[name]))
+            future.add_done_callback(functools.partial(self.finish, tick, name))
+
+    # run a routine of the graph unless its run of the graph was abandoned while it was waiting
+    def run(self, tick, name, upstream):
+        with self.lock:
+            if tick != self.ticks:
+                return None
+            channel = self.channels.get(name)
+        on_plot = (lambda plot: channel.publish(("plot", plot))) if channel is not None else None
+        return generate_plot_urls(self.routines[name], routine_path, self.data_dir, on_plot=on_plot, runs=self.runs, upstream=upstream), time.perf_counter()
+
+    # publish the plots of a routine and run the routines depending on it whose dependencies all finished, or skip them if it failed
+    def finish(self, tick, name, future):
+        outcome = future.result()
+        with self.lock:
+            if tick != self.ticks:
+                return
+            # the scheduler gives None if running the routine raised
+            result, finished = outcome if outcome is not None else ((True, "running '%s' failed" % name), time.perf_counter())
+            self.running -= 1
+            skipped = []
+            if result[0]:
+                # skip the routines depending on the routine, directly or through others
+                stack = list(self.dependents[name])
+                while stack:
+                    dependent = stack.pop()
+                    if dependent in self.waiting:
+                        del self.waiting[dependent]
+                        skipped.append(dependent)
+                        stack += self.dependents[dependent]
+            else:
+                self.results[name] = get_results(result[1])
+                for dependent in set(self.dependents[name]):
+                    if dependent in self.waiting:
+                        self.waiting[dependent] -= 1
+            ready = self.take_ready()
+            if not self.waiting and not self.running:
+                self.waiting = None
+            channel = self.channels.get(name)
+            skipped_channels = [self.channels[dependent] for dependent in skipped if dependent in self.channels]
+        if channel is not None:
+            publish_result(channel, result, finished)
+        for skipped_channel in skipped_channels:
+            skipped_channel.publish(("warning", "Warning: '%s' was skipped because '%s', which it depends on, failed" % (skipped_channel.routine["name"], name)))
+        self.submit(ready)
+
+
+# runs of graphs shared by the channels of their routines indexed by the key of the graph
+graph_runs = {}
+graph_runs_lock = threading.Lock()
+
+# run a routine every period in the graph of the routines it depends on or that depend on it, returning a function that stops it
+# all pages watching routines of the same graph share one run of the graph, which runs as often as its most frequent routine
+# and stops once none of its routines is watched
+def start_graph_engine(channel):
+    routines = get_graph(channel.routine["name"])
+    if routines is None:
+        # the routine was taken out of its graph since the engine was chosen
+        return start_new_engine(channel)
+    period = min(get_period(routine["analysis"]["new_options"]) for routine in routines.values() if is_periodic(routine))
+    key = make_key(channel.data_dir, routines, period)
+    with graph_runs_lock:
+        graph = graph_runs.get(key)
+        if graph is None:
+            graph = graph_runs[key] = GraphRun(key, channel.data_dir, routines, period)
+        graph.attach(channel)
+
+    def stop():
+        with graph_runs_lock:
+            if graph.detach(channel) and graph_runs.get(key) is graph:
+                del graph_runs[key]
+    return stop
+
+# get the key of the shots analysed by a routine analysing the shots arriving in its shots directory
+def get_arrival_key(routine, data_dir):
+    return json.dumps([routine["name"], os.path.abspath(os.path.join(data_dir, routine["shots_dir"]))])
+
+# run a routine once for every batch of shots that finished arriving in its shots directory, returning a function that stops it
+# the shots analysed are remembered on disk, so every shot is analysed once even if the server restarts, and a batch the
+# routine fails to analyse is analysed again until it succeeds or is skipped with skip_failed_shots
+def start_arrival_engine(channel):
+    routine = channel.routine
+    options = routine["analysis"]["new_options"]
+    shots_dir_path = os.path.join(channel.data_dir, routine["shots_dir"])
+    arrival_key = get_arrival_key(routine, channel.data_dir)
+    runs = ActiveRuns()
+    stopped = threading.Event()
+    # held while a batch is analysed, so the batches run one after the other
+    running = threading.Lock()
+    # number of times in a row the analysis of the batch starting with the shot failed_from failed
+    failures, failed_from = 0, None
+    # time (of time.monotonic) before which the batch that failed or timed out isn't analysed again
+    retry_at = 0
+
+    def accept(name):
+        return bool(filter_shots([os.path.join(shots_dir_path, name)], options))
+
+    # analyse a batch of shots unless the analysis stopped while it was waiting
+    def analyse_shots(names):
+        if stopped.is_set():
+            return None
+        shots_paths = [os.path.join(shots_dir_path, name) for name in names]
+        return generate_plot_urls(routine, routine_path, channel.data_dir, shots_paths=shots_paths, on_plot=lambda plot: channel.publish(("plot", plot)), runs=runs), time.perf_counter()
+
+    # analyse the shots that arrived since the last batch, unless a batch is being analysed or waits to be analysed again
+    def check():
+        if stopped.is_set() or not watcher.scanned.is_set() or time.monotonic() < retry_at or not running.acquire(blocking=False):
+            return
+        analysed = arrivals.get(arrival_key)
+        if analysed is None:
+            # the first time a routine watches a directory, only the shots arriving from then on are analysed
+            analysed = watcher.get_identities()
+            arrivals.record(arrival_key, analysed)
+        batch = watcher.get_batch(analysed, accept)
+        if not batch:
+            running.release()
+            return
+        future = scheduler.submit(routine["name"], functools.partial(analyse_shots, list(batch)), get_priority(routine))
+        future.add_done_callback(functools.partial(finish, batch))
+
+    # analyse the next batch right away, which is the batch after the failed batch once it was skipped
+    def wake():
+        nonlocal retry_at
+        retry_at = 0
+        check()
+
+    # record the shots of an analysed batch and look for the shots that arrived meanwhile
+    def finish(batch, future):
+        nonlocal failures, failed_from, retry_at
+        retry = 0
+        if future.result() is not None:
+            result, finished = future.result()
+            if result[0] == TIMED_OUT:
+                # analyse the batch again later, giving the routine more time before each attempt
+                retry = channel.period * run_timeouts.get_backoff(routine["name"])
+                publish_result(channel, result, finished)
+            elif result[0] and result[0] != CANCELLED and not arrivals.contains(arrival_key, batch):
+                # analyse the batch again later, waiting twice as long after each failure, until it succeeds or is skipped
+                first = next(iter(batch))
+                failures = failures + 1 if failed_from == first else 1
+                failed_from = first
+                retry = channel.period * 2 ** min(failures, MAX_BACKOFF_EXPONENT)
+                with failed_batches_lock:
+                    failed_batches[arrival_key] = (batch, wake)
+                channel.publish(("warning", get_retry_warning(routine, result[1], len(batch), retry)))
+            elif not result[0]:
+                with failed_batches_lock:
+                    failed_batches.pop(arrival_key, None)
+                # shots removed from the directory are forgotten, so the record doesn't grow forever
+                arrivals.record(arrival_key, batch, watcher.get_identities())
+                publish_result(channel, result, finished)
+        running.release()
+        if retry:
+            retry_at = time.monotonic() + retry
+            timer = threading.Timer(retry, wake)
+            timer.daemon = True
+            timer.start()
+        else:
+            check()
+
+    watcher = watch_shots(shots_dir_path, check)
+    check()
+
+    def stop():
+        stopped.set()
+        unwatch_shots(watcher, check)
+        runs.cancel_all()
+    return stop
+
+# analyse the old shots of a routine a chunk every period, returning a function that stops it
+# the shots left are kept in the channel, so starting the analysis again continues where it stopped
+def start_old_engine(channel):
+    routine = channel.routine
+    state = channel.state
     num_shots = int(routine["analysis"]["old_options"]["num-shots"])
-    while analysis_on:
-        iter_start = time.time()
-        if not shots_to_analyse[routine["name"]]:
-            analysis_time = format_time(time.time() - start_time)
-            report_status(obj_response, "status", "Analysis for '%s' complete after %s" % (routine["name"], analysis_time))
-            break
-        error, plots = generate_plot_urls(routine, routine_path, data_dir, shots_paths=shots_to_analyse[routine["name"]][:num_shots])
-        if error:
-            report_status(obj_response, "status", plots)
-            obj_response.call("stop_analysis")
-        for plot in plots:
-            update_plot(obj_response, plot["url"], plot["plot_id"], plot["data"], plot["table_id"], routine["name"], plot["name"])
-            yield obj_response
-        if len(shots_to_analyse[routine["name"]]) > num_shots:
-            shots_to_analyse[routine["name"]] = shots_to_analyse[routine["name"]][num_shots:]
+    runs = ActiveRuns()
+
+    # analyse the next chunk of old shots, or return None if there are none left
+    def analyse_next_shots():
+        chunk = state["shots"][:num_shots]
+        if not chunk:
+            return None
+        state["shots"] = state["shots"][num_shots:]
+        result = generate_plot_urls(routine, routine_path, channel.data_dir, shots_paths=chunk, on_plot=lambda plot: channel.publish(("plot", plot)), runs=runs)
+        if result[0] == CANCELLED:
+            # analyse the shots again when the analysis is started again
+            state["shots"] = chunk + state["shots"]
         else:
-            shots_to_analyse[routine["name"]] = []
-        sleep_time = period - (time.time() - iter_start)
-        if sleep_time >= 0:
-            time.sleep(sleep_time)
-        elif not reported_error:
-            report_status(obj_response, "status", "Warning: update period is faster than execution time by %.3g seconds for '%s'. Try setting a lower frequency" % (-sleep_time, routine["name"]))
-            reported_error = True
+            state["num_done"] += len(chunk)
+        return result
+
+    def deliver(result, missed):
+        if result is None:
+            complete_analysis(channel)
+            return
+        publish_result(channel, result, time.perf_counter(), " and its shots were skipped")
+        if missed:
+            missed_deadlines.inc(missed, routine=routine["name"])
+            channel.publish(("missed", missed))
+        publish_progress(channel)
+
+    job = scheduler.add(routine["name"], channel.period, analyse_next_shots, deliver, get_priority(routine))
+
+    def stop():
+        scheduler.remove(job)
+        runs.cancel_all()
+    return stop
+
+# analyse the old shots of a routine in chunks running side by side on the scheduler, as fast as the workers allow,
+# while still publishing their plots in the order of the shots, returning a function that stops it
+def start_parallel_engine(channel):
+    routine = channel.routine
+    state = channel.state
+    num_shots = int(routine["analysis"]["old_options"]["num-shots"])
+    num_workers = app.config["ANALYSIS_WORKERS"]
+    if routine.get("execution", "worker") == "worker":
+        # warm a worker for every chunk that can run at the same time
+        get_pool(os.path.join(routine_path, routine["name"]), num_workers)
+    runs = ActiveRuns()
+    stopped = threading.Event()
+    # the chunks in flight as (shots, future) in the order of the shots
+    pending = collections.deque()
+    lock = threading.RLock()
+
+    # analyse a chunk of old shots unless the analysis stopped while it was waiting
+    def analyse_shots(shots_paths):
+        if stopped.is_set():
+            return None
+        return generate_plot_urls(routine, routine_path, channel.data_dir, shots_paths=shots_paths, runs=runs), time.perf_counter()
+
+    # publish the chunks that are done up to the first one still running, and queue more chunks
+    def advance(future=None):
+        with lock:
+            if stopped.is_set():
+                return
+            # wait for the oldest chunk even if later ones are already done
+            while pending and pending[0][1].done():
+                chunk, done = pending.popleft()
+                state["num_done"] += len(chunk)
+                if done.result() is None:
+                    continue
+                result, finished = done.result()
+                publish_result(channel, result, finished, " and its shots were skipped")
+                publish_progress(channel)
+            # only queue a few chunks ahead so that stopping doesn't have to wait for the whole backlog
+            submitted = []
+            while state["shots"] and len(pending) < 2 * num_workers:
+                chunk, state["shots"] = state["shots"][:num_shots], state["shots"][num_shots:]
+                submitted.append(scheduler.submit(routine["name"], functools.partial(analyse_shots, chunk), get_priority(routine)))
+                pending.append((chunk, submitted[-1]))
+            if not pending:
+                complete_analysis(channel)
+        for future in submitted:
+            future.add_done_callback(advance)
+
+    def stop():
+        stopped.set()
+        runs.cancel_all()
+        with lock:
+            # the chunks that didn't finish are analysed again when the analysis is started again
+            state["shots"] = [shot for chunk, future in pending for shot in chunk] + state["shots"]
+            pending.clear()
+
+    advance()
+    return stop
+
+# get the function starting the analysis of a routine
+def get_engine(routine):
+    if routine["analysis"]["new"]:
+        if routine["analysis"]["new_options"]["select-shots-by"] == "arrival":
+            return start_arrival_engine
+        if get_graph(routine["name"]) is not None:
+            return start_graph_engine
+        return start_new_engine
+    elif is_parallel(routine):
+        return start_parallel_engine
+    return start_old_engine
+
+# pass the events of an analysis to a plot page through its push session, sending each plot only when it changed
+class PageSubscriber(object):
+
+    def __init__(self, session, channel, shown_plots=()):
+        self.session = session
+        self.channel = channel
+        self.routine = channel.routine
+        self.reported_missed = False
+        # what the page shows of every plot, starting with the plots it was initialized with
+        self.last_sent = {}
+        for plot in shown_plots:
+            diff_plot(plot["url"], plot["plot_id"], plot["data"], plot["table_id"], self.last_sent)
+
+    # send the plots that changed, recording how much was sent and how long it took since the run finished if given
+    def send_plots(self, plots, finished=None):
+        for plot in plots:
+            update = diff_plot(plot["url"], plot["plot_id"], plot["data"], plot["table_id"], self.last_sent)
+            if update:
+                self.session.send("plot", update, slot=("plot", plot["plot_id"]))
+                pushed_bytes.inc(len(json.dumps(update)), routine=self.routine["name"])
+        if finished is not None:
+            push_seconds.observe(time.perf_counter() - finished, routine=self.routine["name"])
+
+    # send a status message
+    def send_status(self, msg):
+        self.session.send("status", dict(html=msg))
+
+    def put(self, event):
+        kind = event[0]
+        if kind == "plot":
+            # send each plot as soon as it is made, the rest are sent once the run finished
+            self.send_plots([event[1]])
+        elif kind == "plots":
+            self.send_plots(event[1], event[2])
+        elif kind == "progress":
+            self.session.send("progress", dict(routine=self.routine["name"], text=format_progress(*event[1:])), slot=("progress", self.routine["name"]))
+        elif kind == "missed":
+            if not self.reported_missed:
+                self.send_status(get_missed_warning(self.routine, event[1]))
+                self.reported_missed = True
+        elif kind in ("warning", "complete"):
+            self.send_status(event[1])
+        elif kind == "error":
+            self.send_status(event[1])
+            self.session.send("stop", {})
+
+    # send the latest results again to a page that missed some of the messages
+    def resync(self):
+        self.last_sent.clear()
+        self.send_plots(self.channel.get_plots())
+
+# send the latest results of all its analyses to a page that reconnected too late to resume
+def resync_viewer(viewer_id):
+    for channel, subscriber in hub.get_subscriptions(viewer_id):
+        subscriber.resync()
 
 # Sijax handlers for the main page
 class MainHandler(object):
@@ -407,7 +903,7 @@ class MainHandler(object):
     @staticmethod
     @update_JSON()
     def add_folder(obj_response, path, name, data={}):
-        data['paths'].append(os.path.join(str(path), secure_filename(str(name))))
+        registry.add_folder(os.path.join(str(path), secure_filename(str(name))))
         return data
 
     # remove a routine
@@ -415,10 +911,12 @@ class MainHandler(object):
     @update_JSON()
     def remove_file(obj_response, filename, is_routine, data={}):
         global routine_path
+        registry.remove_file(str(filename), is_routine)
         if is_routine:
-            data['routines'] = [routine for routine in data["routines"] if routine['name'] != str(filename)]
-        else:
-            data['support'] = [support for support in data["support"] if support['name'] != str(filename)]
+            forget_dependencies([str(filename)])
+        close_pool(os.path.join(routine_path, filename))
+        unload_routine(os.path.join(routine_path, filename))
+        run_cache.discard(str(filename))
         os.remove(os.path.join(routine_path, filename))
         return data
 
@@ -427,17 +925,14 @@ class MainHandler(object):
     @update_JSON()
     def remove_folder(obj_response, tree_path, data={}):
         global routine_path
-        # remove all subpaths from paths
-        tree_path_split = str(tree_path).split('/')
-        paths = list(map(lambda path: path.split('/'), data["paths"]))
-        data['paths'] = ["/".join(path) for path in paths if len(path) <= len(tree_path_split) or path[:len(tree_path_split)] != tree_path_split]
-        # remove all subroutines
-        routines_to_remove = [routine["name"] for routine in data["routines"] if len(routine['path'].split("/")) + 1 > len(tree_path_split) and (routine['path'].split('/') + [""])[:len(tree_path_split)] == tree_path_split]
-        data['routines'] = [routine for routine in data["routines"] if len(routine['path'].split("/")) + 1 <= len(tree_path_split) or (routine['path'].split('/') + [""])[:len(tree_path_split)] != tree_path_split]
+        # remove the folder with all sub-folders and subroutines
+        routines_to_remove = registry.remove_folder(str(tree_path))
+        forget_dependencies(routines_to_remove)
         for routine_name in routines_to_remove:
+            close_pool(os.path.join(routine_path, routine_name))
+            unload_routine(os.path.join(routine_path, routine_name))
+            run_cache.discard(routine_name)
             os.remove(os.path.join(routine_path, routine_name))
-        # remove folder
-        data['paths'].remove(str(tree_path))
         return data
 
 
@@ -460,7 +955,7 @@ class MainHandler(object):
     @update_JSON()
     def select_data_dir(obj_response, data_dir, update_dir_options, routine_name, data={}):
         if routine_name != "":
-            routine = [routine for routine in data["routines"] if routine["name"] == routine_name][0]
+            routine = registry.get_routine(routine_name)
         else:
             routine = dict(shots_dir="")
         # set the data directory to none
@@ -496,12 +991,16 @@ class MainHandler(object):
     @staticmethod
     @update_JSON(write=False)
     def display_routine_info(obj_response, routine_name, data={}):
-        routine = [routine for routine in data["routines"] if routine["name"] == routine_name][0]
+        routine = find_routine(data, routine_name)
         obj_response.html('#routine-name', "<b>routine name</b>: %s" % routine["name"])
         if "description" in routine.keys():
             obj_response.html('#routine-description', "<b>routine description</b>: %s" % routine["description"])
         # update all displays
         update_functions(obj_response, routine)
+        obj_response.attr("#execution-options option[value|='%s']" % routine.get("execution", "worker"), "selected", "selected")
+        obj_response.attr("#priority", "value", get_priority(routine))
+        obj_response.attr("#timeout", "value", get_timeout(routine) or 0)
+        obj_response.call("set_dependencies", [get_other_routines(data, routine_name), get_dependencies(routine)])
         update_shots_dir_options(obj_response, routine, data["data_dir"])
         update_json_options(obj_response, routine, data["data_dir"])
         update_analysis_options(obj_response, routine, data["data_dir"])
@@ -514,7 +1013,7 @@ class MainHandler(object):
     @staticmethod
     @update_JSON()
     def set_shots_dir(obj_response, routine_name, shots_dir_form, data={}):
-        routine = [routine for routine in data["routines"] if routine["name"] == routine_name][0]
+        routine = registry.get_routine(routine_name)
         shots_dir = shots_dir_form["shots-dir-options"]
         routine["shots_dir"] = shots_dir
         if shots_dir == "":
@@ -536,7 +1035,7 @@ class MainHandler(object):
     @staticmethod
     @update_JSON()
     def set_json_options(obj_response, routine_name, json_file_form, data = {}):
-        routine = [routine for routine in data["routines"] if routine["name"] == routine_name][0]
+        routine = registry.get_routine(routine_name)
         json_file = json_file_form["json-options"]
         routine["json"] = json_file
         if json_file == "":
@@ -545,11 +1044,76 @@ class MainHandler(object):
             report_status(obj_response, "status", "JSON file for '%s' set to '%s'" % (routine_name, json_file))
         return data
 
+    # set how a routine is executed and its scheduling priority
+    @staticmethod
+    @update_JSON()
+    def set_execution_options(obj_response, routine_name, execution_form, data={}):
+        global routine_path
+        routine = registry.get_routine(routine_name)
+        execution = execution_form["execution-options"]
+        try:
+            priority = int(execution_form["priority"])
+        except ValueError:
+            report_status(obj_response, "status", "Warning: '%s' is not a valid priority" % execution_form["priority"])
+            priority = get_priority(routine)
+        if priority != get_priority(routine):
+            routine["priority"] = priority
+            report_status(obj_response, "status", "Priority of '%s' set to %d" % (routine_name, priority))
+        try:
+            timeout = max(float(execution_form["timeout"] or 0), 0)
+        except ValueError:
+            report_status(obj_response, "status", "Warning: '%s' is not a valid timeout" % execution_form["timeout"])
+            timeout = get_timeout(routine) or 0
+        if timeout != (get_timeout(routine) or 0):
+            routine["timeout"] = timeout
+            if timeout:
+                report_status(obj_response, "status", "Runs of '%s' are killed after %g seconds" % (routine_name, timeout))
+            else:
+                report_status(obj_response, "status", "Runs of '%s' are no longer timed out" % routine_name)
+        if execution == routine.get("execution", "worker"):
+            return data
+        routine["execution"] = execution
+        # stop the warm workers and forget the imported module if they are no longer used
+        if execution != "worker":
+            close_pool(os.path.join(routine_path, routine_name))
+        if execution != "inprocess":
+            unload_routine(os.path.join(routine_path, routine_name))
+        if execution == "subprocess":
+            report_status(obj_response, "status", "'%s' will run in a fresh process for every analysis" % routine_name)
+        elif execution == "inprocess":
+            report_status(obj_response, "status", "'%s' will run inside the server through its '%s' function" % (routine_name, ENTRY_POINT))
+        else:
+            report_status(obj_response, "status", "'%s' will run in a warm worker" % routine_name)
+        return data
+
+    # set the routines whose results a routine uses, which run before it every period
+    @staticmethod
+    @update_JSON()
+    def set_dependencies(obj_response, routine_name, dependencies, data={}):
+        routine = registry.get_routine(routine_name)
+        dependencies = [str(name) for name in dependencies]
+        if dependencies == get_dependencies(routine):
+            return data
+        routines = dict(registry.routines)
+        routines[routine_name] = dict(routine, depends_on=dependencies)
+        try:
+            sort_routines(get_closure([routine_name], routines))
+        except GraphError as err:
+            report_status(obj_response, "status", "Warning: %s" % err)
+            obj_response.call("set_dependencies", [get_other_routines(data, routine_name), get_dependencies(routine)])
+            return data
+        routine["depends_on"] = dependencies
+        if dependencies:
+            report_status(obj_response, "status", "'%s' will run after %s with their results" % (routine_name, ", ".join("'%s'" % name for name in dependencies)))
+        else:
+            report_status(obj_response, "status", "'%s' no longer depends on other routines" % routine_name)
+        return data
+
     # update analysis options
     @staticmethod
     @update_JSON()
     def set_analysis_options(obj_response, routine_name, analysis_options, shots_choice, filetypes, new_analysis, data={}):
-        routine = [routine for routine in data["routines"] if routine["name"] == routine_name][0]
+        routine = registry.get_routine(routine_name)
         analysis_options["choice"] = [shot["id"] for shot in shots_choice]
         analysis_options["filetype"] = [filetype["id"] for filetype in filetypes]
         try:
@@ -559,19 +1123,39 @@ class MainHandler(object):
             analysis_options["regex"] = ""
         if new_analysis:
             analysis_options.pop("order-shots-by")
+            analysis_options.pop("parallel", None)
             routine["analysis"]["new_options"] = analysis_options
             report_status(obj_response, "status", "Set the new analysis options for '%s' to '%s'" % (routine_name, analysis_options))
         else:
             analysis_options.pop("select-shots-by")
+            # unchecked boxes are left out of the form
+            analysis_options["parallel"] = "parallel" in analysis_options
             routine["analysis"]["old_options"] = analysis_options
             report_status(obj_response, "status", "Set the old analysis options for '%s' to '%s'" % (routine_name, analysis_options))
         return data
 
+    # skip the arrived shots a routine failed to analyse, which are otherwise analysed again until they succeed
+    @staticmethod
+    @update_JSON(write=False)
+    def skip_failed_shots(obj_response, routine_name, data={}):
+        routine = find_routine(data, routine_name)
+        arrival_key = get_arrival_key(routine, data["data_dir"])
+        with failed_batches_lock:
+            failed = failed_batches.pop(arrival_key, None)
+        if failed is None:
+            report_status(obj_response, "status", "'%s' has no failed shots to skip" % routine_name)
+            return
+        batch, wake = failed
+        arrivals.record(arrival_key, batch)
+        report_status(obj_response, "status", "Skipped %d shot(s) '%s' failed to analyse: %s" % (len(batch), routine_name, ", ".join(batch)))
+        # go on with the shots that arrived after them
+        wake()
+
     # refresh analysis options
     @staticmethod
     @update_JSON(write=False)
     def refresh_analysis(obj_response, routine_name, new_analysis, data={}):
-        routine = [routine for routine in data["routines"] if routine["name"] == routine_name][0]
+        routine = find_routine(data, routine_name)
         update_analysis_options(obj_response, routine, data["data_dir"])
         if new_analysis:
             report_status(obj_response, "status", "New data analysis options for '%s' reverted" % routine_name)
@@ -581,7 +1165,7 @@ class MainHandler(object):
     @staticmethod
     @update_JSON()
     def set_analysis_type(obj_response, routine_name, new_analysis, data={}):
-        routine = [routine for routine in data["routines"] if routine["name"] == routine_name][0]
+        routine = registry.get_routine(routine_name)
         routine["analysis"]["new"] = new_analysis
         update_analysis_options(obj_response, routine, data["data_dir"])
         return data
@@ -589,7 +1173,7 @@ class MainHandler(object):
     @staticmethod
     @update_JSON()
     def toggle_routine_activation(obj_response, routine_name, data={}):
-        routine = [routine for routine in data["routines"] if routine["name"] == routine_name][0]
+        routine = registry.get_routine(routine_name)
         routine["active"] = not routine["active"]
         if routine["active"]:
             obj_response.css("#activate-routine", "color", "green")
@@ -599,59 +1183,92 @@ class MainHandler(object):
             report_status(obj_response, "status", "'%s' switched to inactive" % routine_name)
         return data
 
+# report why the analysis couldn't start and let it be started again
+def report_failed_analysis(obj_response, msg):
+    report_status(obj_response, "status", msg)
+    obj_response.attr("#start-analysis", "class", "material-icons button")
+    obj_response.attr("#stop-analysis, #pause-analysis", "class", "material-icons button inactive")
+
 # Sijax handlers for the plot page
 class PlotHandler(object):
 
-    # stop the analysis
+    # stop the analysis of the page, which stops the analyses no other page watches
     @staticmethod
-    def stop_analysis(obj_response):
-        global analysis_on
-        analysis_on = False
+    def stop_analysis(obj_response, viewer_id):
+        hub.leave(viewer_id)
         report_status(obj_response, "status", "Analysis stopped")
+        hits, misses, rate = run_cache.get_stats()
+        if hits + misses:
+            report_status(obj_response, "status", "Skipped %d of %d runs whose inputs hadn't changed (%.3g%% hit rate)" % (hits, hits + misses, 100 * rate))
         obj_response.call("reset_timer")
 
-    # pause the analysis
+    # pause the analysis of the page
     @staticmethod
-    def pause_analysis(obj_response):
-        global analysis_on
-        analysis_on = False
+    def pause_analysis(obj_response, viewer_id):
+        hub.leave(viewer_id)
         report_status(obj_response, "status", "Analysis paused")
         obj_response.call("stop_timer")
 
-    # start the analysis
+    # start the analysis, joining the analyses of the routines that other pages already watch
     @staticmethod
     @update_JSON(write=False)
-    def analyse(obj_response, paused, data={}):
-        global routine_path, shots_to_analyse
+    def analyse(obj_response, viewer_id, paused, data={}):
+        global routine_path
+        push_server.start()
         data_dir = data["data_dir"]
+        routines = {routine["name"]: routine for routine in data["routines"]}
+        try:
+            # check that the routines running as graphs can run before analysing anything
+            graph_routines = get_closure(get_periodic_routines(routines), routines)
+            sort_routines(graph_routines)
+        except GraphError as err:
+            report_failed_analysis(obj_response, "Analysis failed: %s" % err)
+            return
         if not paused:
             remove_plots(obj_response)
+        # plots of the first runs of the routines indexed by name, handed to the routines depending on them
+        initial_plots = {}
         for routine in data["routines"]:
+            if not is_routine_active(routine):
+                continue
             new_analysis = routine["analysis"]["new"]
-            initial_shots = []
-            if new_analysis:
-                period = get_period(routine["analysis"]["new_options"])
-            else:
-                period = get_period(routine["analysis"]["old_options"])
-                shots_to_analyse[routine["name"]] = get_all_shots_paths_old(routine["analysis"]["old_options"], routine["shots_dir"], data_dir)
-                num_shots = int(routine["analysis"]["old_options"]["num-shots"])
-                initial_shots = shots_to_analyse[routine["name"]][:num_shots]
-            if is_routine_active(routine):
-                if not paused:
-                    # initialize the plots and data tables
-                    initialization_error, plot_ids = initialize_routine(obj_response, routine_path, routine, data_dir, initial_shots)
-                    if initialization_error:
-                        report_status(obj_response, "status", "Analysis failed: '%s: %s'" % (plot_ids.__class__.__name__, plot_ids))
-                        obj_response.attr("#start-analysis", "class", "material-icons button")
-                        obj_response.attr("#stop-analysis, #pause-analysis", "class", "material-icons button inactive")
-                        return
+            period = get_period(routine["analysis"]["new_options" if new_analysis else "old_options"])
+            channel = hub.get(make_key(data_dir, routine, period))
+            in_graph = new_analysis and routine["name"] in graph_routines
+            if not paused and channel is not None and channel.is_watched():
+                # show the latest results of the analysis other pages are watching instead of running the routine again
+                plots = channel.get_plots() or (initial_plots.get(routine["name"]) if in_graph else None)
+                upstream = get_initial_upstream(routine, data_dir, initial_plots, routines) if in_graph and plots is None else None
+                initialization_error, plots = initialize_routine(obj_response, routine_path, routine, data_dir, [], plots, upstream)
+            elif channel is None or not paused:
+                channel = hub.create(data_dir, routine, period)
+                initial_shots = []
                 if not new_analysis:
-                    if len(shots_to_analyse[routine["name"]]) > num_shots:
-                        shots_to_analyse[routine["name"]] = shots_to_analyse[routine["name"]][num_shots:]
-                    else:
-                        shots_to_analyse[routine["name"]] = []
-                # make a request for analyse_routine
-                obj_response.call("make_comet_request", [data_dir, routine, period])
+                    if routine["analysis"]["old_options"].get("parallel") and routine["json"]:
+                        report_status(obj_response, "status", "'%s' carries its state from one analysis to the next in '%s', so its old shots are analysed sequentially" % (routine["name"], routine["json"]))
+                    with shot_selection_seconds.time(routine=routine["name"]):
+                        shots = get_all_shots_paths_old(routine["analysis"]["old_options"], routine["shots_dir"], data_dir)
+                    num_shots = int(routine["analysis"]["old_options"]["num-shots"])
+                    initial_shots, shots = shots[:num_shots], shots[num_shots:]
+                    channel.state.update(shots=shots, num_done=0, num_total=len(shots), started=time.time(), last_progress=0)
+                initialization_error, plots = False, []
+                if not paused:
+                    # initialize the plots and data tables, reusing the first run of a routine other routines depend on
+                    plots = initial_plots.get(routine["name"]) if in_graph else None
+                    upstream = get_initial_upstream(routine, data_dir, initial_plots, routines) if in_graph and plots is None else None
+                    initialization_error, plots = initialize_routine(obj_response, routine_path, routine, data_dir, initial_shots, plots, upstream)
+                    if not initialization_error:
+                        channel.publish(("plots", plots, None))
+            else:
+                # continue the paused analysis where it stopped
+                initialization_error, plots = False, []
+            if initialization_error:
+                report_failed_analysis(obj_response, "Analysis failed: '%s: %s'" % (plots.__class__.__name__, plots))
+                return
+            if in_graph:
+                initial_plots[routine["name"]] = plots
+            # push the results of the analysis to the page as they come
+            hub.subscribe(viewer_id, channel, get_engine(routine), PageSubscriber(push_server.get_session(viewer_id), channel, plots))
         if paused:
             report_status(obj_response, "status", "Analysis restarted")
         else:
@@ -659,17 +1276,6 @@ class PlotHandler(object):
         # start the timer
         obj_response.call("start_timer")
 
-# Sijax comet handlers for the plot page
-class PlotCometHandler(object):
-
-    # periodically update the plot and data tables for a routine
-    @staticmethod
-    def analyse_routine(obj_response, data_dir, routine, period):
-        new_analysis = routine["analysis"]["new"]
-        if new_analysis:
-            yield from analyse_routine_new(obj_response, data_dir, routine, period)
-        else:
-            yield from analyse_routine_old(obj_response, data_dir, routine, period)
 
 # route the main page
 @flask_sijax.route(app, '/')
@@ -687,6 +1293,45 @@ def main():
     # render template
     return render_template('main.html', form_init_js=form_init_js, routines=routines, data_dir=data_dir)
 
+# serve a rendered plot by the hash of its content, which never changes so it can be cached forever
+@app.route('/plots/<digest>')
+def plot_image(digest):
+    image = image_store.get(digest)
+    if image is None:
+        abort(404)
+    response = make_response(image[0])
+    response.headers["Content-Type"] = image[1]
+    response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    response.set_etag(digest)
+    return response.make_conditional(request)
+
+# serve a page of the shots of a routine containing a search term, in the format of the select2 shots picker
+@app.route('/shots')
+def shots_page():
+    try:
+        page = max(int(request.args.get("page", 1)), 1)
+    except ValueError:
+        page = 1
+    with registry.lock:
+        if not registry.has_routine(request.args.get("routine", "")):
+            abort(404)
+        shots_dir = registry.get_routine(request.args["routine"])["shots_dir"]
+        data_dir = registry.data["data_dir"]
+    shots_dir_path = os.path.join(data_dir, shots_dir)
+    if not data_dir or not shots_dir or not os.path.isdir(shots_dir_path):
+        return jsonify(results=[], pagination=dict(more=False))
+    catalog = get_catalog(shots_dir_path)
+    catalog.refresh()
+    names, more = catalog.search(request.args.get("term", ""), page, SHOTS_PAGE_SIZE)
+    return jsonify(results=[dict(id=name, text=name) for name in names], pagination=dict(more=more))
+
+# serve the metrics of the analysis in the Prometheus text format
+@app.route('/metrics')
+def metrics_page():
+    response = make_response(metrics.render())
+    response.headers["Content-Type"] = "text/plain; version=0.0.4; charset=utf-8"
+    return response
+
 # route the plot page
 @flask_sijax.route(app, '/plot')
 def main_plot():
@@ -694,11 +1339,10 @@ def main_plot():
     if g.sijax.is_sijax_request:
         # register Sijax handlers
         g.sijax.register_object(PlotHandler)
-        # register Sijax comet handlers
-        g.sijax.register_comet_object(PlotCometHandler)
         return g.sijax.process_request()
+    push_server.start()
     # render template
-    return render_template('plot.html')
+    return render_template('plot.html', push_port=push_server.port)
 
 
 # run the flask app with threads in debug mode
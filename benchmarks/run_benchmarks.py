@@ -0,0 +1,202 @@
+# microbenchmarks of the shot selection, result decoding and plot rendering hot paths, run against synthetic data
+# usage: python benchmarks/run_benchmarks.py [--sizes 1000 10000 100000] [--repeat 5] [--output results.json] [--compare old.json]
+# results are written as json with the minimum, median and mean time of every benchmark, and --compare prints the ratio to an earlier run
+
+# import libraries
+import os
+import sys
+import io
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+
+# import the app modules from the repository root
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("MPLBACKEND", "Agg")
+
+import catalog
+import plots
+import protocol
+import seneca_analysis
+import matplotlib.pyplot as plt
+
+# refresh the catalog on every selection, so the warm benchmarks time a refresh instead of returning within the refresh
+# interval, and treat the generated directories as settled although they were just written
+catalog.REFRESH_INTERVAL = 0
+catalog.RECENT_DIRECTORY = 0
+
+# number of files in the generated shots directories
+SIZES = [1000, 10000, 100000]
+# times each benchmark is run
+REPEAT = 5
+# the shots are spread over this many seconds of modification times, like a day of measurements
+TIME_SPREAD = 86400
+# sizes (in bytes) of the images in the decoded result streams
+IMAGE_SIZES = [100 * 1024, 1024 ** 2, 4 * 1024 ** 2]
+# number of plots in each result stream
+PLOTS_PER_RUN = 10
+# figure sizes (in inches) and formats of the rendered plots
+FIGURE_SIZES = [(4, 3), (8, 6), (16, 12)]
+IMAGE_FORMATS = ["png", "jpeg"]
+# selection methods sorting by creation (change) time, which can't be set like the modification time, so all generated shots
+# were created within the few seconds it took to write them instead of over TIME_SPREAD
+CTIME_METHODS = ["last-created", "new", "creation"]
+CTIME_NOTE = "creation times of the generated shots are all within the time it took to write them, so these numbers aren't realistic"
+
+
+# create a shots directory with num_shots json files whose modification times are spread over TIME_SPREAD
+# only the modification times can be set, see CTIME_METHODS
+def make_shots_dir(parent, num_shots):
+    shots_dir = os.path.join(parent, "shots_%d" % num_shots)
+    os.makedirs(shots_dir)
+    now = time.time()
+    for i in range(num_shots):
+        path = os.path.join(shots_dir, "shot_%06d.%s" % (i, "json" if i % 10 else "h5"))
+        with open(path, "w") as file:
+            file.write('{"x": [%d]}' % i)
+        mtime = now - TIME_SPREAD * (1 - i / num_shots)
+        os.utime(path, (mtime, mtime))
+    return shots_dir
+
+
+# time a function, starting from a fresh state made by setup before every run if given
+def measure(function, repeat, setup=None):
+    times = []
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return dict(min=min(times), median=statistics.median(times), mean=statistics.mean(times), repeat=repeat)
+
+
+# forget all shot catalogs so the next selection scans the directory again
+def clear_catalogs():
+    with catalog.catalogs_lock:
+        catalog.catalogs.clear()
+
+
+# get the note added to the results of a selection method, which warns about methods sorting by creation time
+def get_note(method):
+    return dict(note=CTIME_NOTE) if method in CTIME_METHODS else {}
+
+
+# time the shot selection of the new and old analysis for every method, with a cold and a warm catalog
+def bench_shot_selection(data_dir, shots_dir, num_shots, repeat):
+    results = []
+    names = sorted(os.listdir(os.path.join(data_dir, shots_dir)))
+    for method in ["choice", "all", "last-created", "last-modified", "new", "modified"]:
+        options = {"select-shots-by": method, "num-shots": "10", "choice": names[:10], "frequency": "1", "filetype": [], "regex": ""}
+        for cache in ["cold", "warm"]:
+            timing = measure(lambda: plots.get_shots_paths(options, shots_dir, data_dir), repeat, clear_catalogs if cache == "cold" else None)
+            results.append(dict(name="get_shots_paths", params=dict(method=method, shots=num_shots, catalog=cache), **get_note(method), **timing))
+    for method in ["choice", "creation", "modification", "sort", "regex"]:
+        options = {"order-shots-by": method, "num-shots": "10", "choice": names[:10], "frequency": "1", "filetype": ["json"], "regex": r"\d+"}
+        for cache in ["cold", "warm"]:
+            timing = measure(lambda: plots.get_all_shots_paths_old(options, shots_dir, data_dir), repeat, clear_catalogs if cache == "cold" else None)
+            results.append(dict(name="get_all_shots_paths_old", params=dict(method=method, shots=num_shots, catalog=cache), **get_note(method), **timing))
+    return results
+
+
+# time reading the plots of a run from a result stream and storing them, as generate_plot_urls does for every run
+def bench_result_decoding(repeat):
+    results = []
+    for image_size in IMAGE_SIZES:
+        stream = io.BytesIO()
+        for count in range(PLOTS_PER_RUN):
+            # random bytes so every image is stored instead of deduplicated
+            protocol.write_frame(stream, "plot", count, os.urandom(image_size), dict(a=1.5, b=count), "png", dict(draw=0.1, render=0.2))
+        content = stream.getvalue()
+
+        def decode():
+            for name, count, image, data, image_format, timings in protocol.read_frames(io.BytesIO(content)):
+                plots.make_plot(name, count, image, data, image_format)
+        timing = measure(decode, repeat)
+        results.append(dict(name="decode_results", params=dict(image_bytes=image_size, plots=PLOTS_PER_RUN), **timing))
+    return results
+
+
+# time drawing, rendering and encoding a plot function at several figure sizes and image formats
+def bench_plot_rendering(repeat):
+    results = []
+    x = list(range(1000))
+    y = [value ** 0.5 for value in x]
+    for figsize in FIGURE_SIZES:
+        for image_format in IMAGE_FORMATS:
+            @seneca_analysis.plot(figsize=figsize, image_format=image_format)
+            def line(x, y):
+                plt.plot(x, y, "o-")
+            # the plots are thrown away instead of sent to a server
+            with seneca_analysis.plot_handler(lambda *plot: None):
+                timing = measure(lambda: line(x, y), repeat)
+            seneca_analysis.close_figures()
+            results.append(dict(name="plot", params=dict(figsize=list(figsize), format=image_format), **timing))
+    return results
+
+
+# get information about the machine and the code the benchmarks ran on
+def get_environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ""
+    return dict(python=platform.python_version(), platform=platform.platform(), cpus=os.cpu_count(), commit=commit, time=time.strftime("%Y-%m-%dT%H:%M:%S"))
+
+
+# get the key identifying a benchmark in the results
+def get_key(result):
+    return result["name"], json.dumps(result["params"], sort_keys=True)
+
+
+# print the median time of every benchmark next to the one from an earlier run, marking the results with a note with *
+def compare(results, old_results):
+    old = {get_key(result): result for result in old_results}
+    for result in results:
+        previous = old.get(get_key(result))
+        mark = "*" if "note" in result else ""
+        if previous is None:
+            print("%-26s %-70s %10.6f s   (new)%s" % (result["name"], json.dumps(result["params"], sort_keys=True), result["median"], mark))
+        else:
+            print("%-26s %-70s %10.6f s   %5.2fx%s" % (result["name"], json.dumps(result["params"], sort_keys=True), result["median"], result["median"] / previous["median"], mark))
+    if any("note" in result for result in results):
+        print("* %s" % CTIME_NOTE)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the microbenchmarks and write the results as json")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES, help="numbers of files in the generated shots directories")
+    parser.add_argument("--repeat", type=int, default=REPEAT, help="number of times each benchmark is run")
+    parser.add_argument("--output", default="benchmark_results.json", help="file the results are written to")
+    parser.add_argument("--compare", help="results of an earlier run to compare with")
+    args = parser.parse_args()
+    results = []
+    data_dir = tempfile.mkdtemp(prefix="seneca-bench-")
+    try:
+        for num_shots in args.sizes:
+            print("generating %d shots" % num_shots)
+            shots_dir = os.path.basename(make_shots_dir(data_dir, num_shots))
+            results += bench_shot_selection(data_dir, shots_dir, num_shots, args.repeat)
+    finally:
+        shutil.rmtree(data_dir)
+    print("decoding results")
+    results += bench_result_decoding(args.repeat)
+    print("rendering plots")
+    results += bench_plot_rendering(args.repeat)
+    with open(args.output, "w") as file:
+        json.dump(dict(environment=get_environment(), results=results), file, indent=1)
+    print("results written to '%s'" % args.output)
+    print("note: results of the %s methods: %s" % (", ".join(CTIME_METHODS), CTIME_NOTE))
+    if args.compare:
+        with open(args.compare) as file:
+            compare(results, json.load(file)["results"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+# import libraries
+import os
+import re
+import time
+import bisect
+import threading
+from shotwatch import open_inotify, read_events, RESCAN_INTERVAL
+
+# minimum time (in seconds) between two scans of the same shots directory
+REFRESH_INTERVAL = 0.05
+# directories modified this recently (in seconds) are always rescanned, since their modification time may be too coarse
+RECENT_DIRECTORY = 2
+
+
+# an in-memory list of the shots in a directory with cached file information and sorted indexes
+class ShotCatalog(object):
+
+    def __init__(self, path):
+        self.path = path
+        # file information indexed by name as (size, ctime, mtime)
+        self.stats = {}
+        self.dir_mtime = None
+        self.last_scan = 0
+        self.last_restat = 0
+        self.last_full_restat = 0
+        # inotify events of the directory telling which shots changed since the last restat, opened on the first restat
+        self.events = None
+        self.use_inotify = True
+        self.lock = threading.RLock()
+        # sorted indexes, rebuilt only when the directory changes
+        self.indexes = {}
+        self.regex_indexes = {}
+        # number of shots by extension and the shots matching the last search term, both dropped when the shots change
+        self.extension_counts = None
+        self.last_search = None
+
+    # check for new, removed and (if restat is set) modified shots
+    def refresh(self, restat=False):
+        with self.lock:
+            now = time.time()
+            if now - self.last_scan >= REFRESH_INTERVAL:
+                self.last_scan = now
+                dir_mtime = os.stat(self.path).st_mtime
+                # the list of files only changes when the directory itself is modified
+                if dir_mtime != self.dir_mtime or now - dir_mtime < RECENT_DIRECTORY:
+                    self.dir_mtime = dir_mtime
+                    self.scan()
+            if restat and now - self.last_restat >= REFRESH_INTERVAL:
+                self.last_restat = now
+                self.restat()
+
+    # list the directory and stat only the files that weren't seen before
+    def scan(self):
+        names = set()
+        changed = False
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                if entry.name.startswith(".") or not entry.is_file():
+                    continue
+                names.add(entry.name)
+                if entry.name not in self.stats:
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    self.stats[entry.name] = (stat.st_size, stat.st_ctime, stat.st_mtime)
+                    changed = True
+        for name in list(self.stats):
+            if name not in names:
+                del self.stats[name]
+                changed = True
+        if changed:
+            self.invalidate()
+
+    # get the names of the known shots that may have changed since the last restat, which inotify tells when it is available,
+    # or all of them without inotify and every RESCAN_INTERVAL seconds, since inotify doesn't see the shots written by other
+    # machines to network file systems
+    def get_changed_names(self):
+        now = time.monotonic()
+        if self.events is None and self.use_inotify:
+            self.events = open_inotify(self.path)
+            self.use_inotify = self.events is not None
+            self.last_full_restat = 0
+        if self.events is not None:
+            names, lost = read_events(self.events)
+            if lost:
+                # the directory went away or events were lost, so its events are opened again on the next restat
+                os.close(self.events)
+                self.events = None
+            elif now - self.last_full_restat < RESCAN_INTERVAL:
+                return [name for name in names if name in self.stats]
+        self.last_full_restat = now
+        return list(self.stats)
+
+    # update the file information of the known shots that changed
+    def restat(self):
+        changed = False
+        for name in self.get_changed_names():
+            old_stat = self.stats[name]
+            try:
+                stat = os.stat(os.path.join(self.path, name))
+            except OSError:
+                del self.stats[name]
+                changed = True
+                continue
+            new_stat = (stat.st_size, stat.st_ctime, stat.st_mtime)
+            if new_stat != old_stat:
+                self.stats[name] = new_stat
+                changed = True
+        if changed:
+            self.invalidate()
+
+    # drop the sorted indexes after the shots changed
+    def invalidate(self):
+        self.indexes = {}
+        self.regex_indexes = {}
+        self.extension_counts = None
+        self.last_search = None
+
+    # get the index of shots sorted by 'name', 'ctime' or 'mtime' as a list of keys and a list of names
+    def get_index(self, key):
+        with self.lock:
+            if key not in self.indexes:
+                if key == "name":
+                    items = sorted((name, name) for name in self.stats)
+                else:
+                    position = dict(ctime=1, mtime=2)[key]
+                    items = sorted((stat[position], name) for name, stat in self.stats.items())
+                self.indexes[key] = ([item[0] for item in items], [item[1] for item in items])
+            return self.indexes[key]
+
+    # get the full paths of shots from their names, in the same form as the paths of the other methods
+    def get_paths(self, names):
+        return [os.path.join(self.path, name) for name in names]
+
+    # get the full paths of the shots sorted by 'name', 'ctime' or 'mtime'
+    def sorted_paths(self, key):
+        return [os.path.join(self.path, name) for name in self.get_index(key)[1]]
+
+    # get the full paths of the last num_shots shots sorted by 'name', 'ctime' or 'mtime'
+    def last_paths(self, key, num_shots):
+        names = self.get_index(key)[1]
+        return [os.path.join(self.path, name) for name in names[max(len(names) - num_shots, 0):]]
+
+    # get the full paths of the shots whose 'ctime' or 'mtime' is at least start
+    def paths_since(self, key, start):
+        keys, names = self.get_index(key)
+        return [os.path.join(self.path, name) for name in names[bisect.bisect_left(keys, start):]]
+
+    # get the full paths of the shots sorted by the part of their path matching a regular expression
+    def regex_sorted_paths(self, regex):
+        with self.lock:
+            if regex not in self.regex_indexes:
+                pattern = re.compile(regex)
+                paths = [os.path.join(self.path, name) for name in self.stats]
+                self.regex_indexes[regex] = sorted(paths, key=lambda path: get_sort_key(pattern, path))
+            return list(self.regex_indexes[regex])
+
+    # count the shots by their lowercase extension, with "" for shots without one
+    def count_extensions(self):
+        with self.lock:
+            if self.extension_counts is None:
+                counts = {}
+                for name in self.stats:
+                    extension = name.rsplit(".", 1)[1].lower() if "." in name else ""
+                    counts[extension] = counts.get(extension, 0) + 1
+                self.extension_counts = counts
+            return dict(self.extension_counts)
+
+    # get a page (starting at 1) of the names of the shots containing a search term in name order, and whether more pages follow
+    def search(self, term, page, page_size):
+        with self.lock:
+            term = term.lower()
+            # the pages of the same search are requested one after the other while scrolling
+            if self.last_search is None or self.last_search[0] != term:
+                names = self.get_index("name")[1]
+                if term:
+                    names = [name for name in names if term in name.lower()]
+                self.last_search = (term, names)
+            names = self.last_search[1]
+        start = (page - 1) * page_size
+        return names[start:start + page_size], len(names) > start + page_size
+
+
+# get the sort key of a path from a regular expression, putting paths that don't match last
+def get_sort_key(pattern, path):
+    match = pattern.search(path)
+    if match is None:
+        return (True, "")
+    return (False, match.group(0))
+
+
+# shot catalogs shared by all routines indexed by the path to the shots directory
+catalogs = {}
+catalogs_lock = threading.Lock()
+
+
+# get the shared catalog for a shots directory, creating it if necessary
+def get_catalog(shots_dir_path):
+    shots_dir_path = os.path.abspath(shots_dir_path)
+    with catalogs_lock:
+        catalog = catalogs.get(shots_dir_path)
+        if catalog is None:
+            catalog = catalogs[shots_dir_path] = ShotCatalog(shots_dir_path)
+    return catalog
@@ -0,0 +1,163 @@
+# import libraries
+import numpy as np
+import matplotlib.pyplot as plt
+
+# ways of decimating a line: "minmax" keeps the first, lowest, highest and last point of every pixel column, which draws
+# the same line, and "lttb" (largest triangle three buckets) keeps the points that shape the line the most
+DECIMATION_METHODS = ["minmax", "lttb"]
+# lines with more points than this many per pixel column of their axes are decimated by the plot decorator
+POINTS_PER_PIXEL = 4
+# number of points per pixel column kept by lttb
+LTTB_POINTS_PER_PIXEL = 2
+
+
+# get the width in pixels of the plotting area of axes (the current axes by default) in an image of the given resolution
+def get_pixel_width(axes=None, dpi=None):
+    axes = axes or plt.gca()
+    figure = axes.get_figure()
+    return max(1, int(round(axes.get_position().width * figure.get_figwidth() * (dpi or figure.dpi))))
+
+
+# check if a line can be decimated, which needs finite values and sorted x values
+# sorted x values between finite ends are finite (comparisons with nan fail), and the sum of y is only finite if its values are
+def is_decimable(x, y):
+    if not len(x):
+        return True
+    return bool(np.isfinite([x[0], x[-1]]).all() and (x[1:] >= x[:-1]).all() and np.isfinite(np.sum(y)))
+
+
+# get the indices of the points of a line kept by lttb, which splits the points between the first and the last one into
+# buckets and keeps the point of every bucket forming the largest triangle with the point kept before it and the average
+# of the next bucket
+def get_lttb_indices(x, y, num_points):
+    if num_points >= len(x) or num_points < 3:
+        return np.arange(len(x))
+    edges = np.linspace(1, len(x) - 1, num_points - 1).astype(np.int64)
+    sizes = np.diff(edges)
+    averages_x = np.add.reduceat(x[1:-1], edges[:-1] - 1) / sizes
+    averages_y = np.add.reduceat(y[1:-1], edges[:-1] - 1) / sizes
+    keep = np.empty(num_points, dtype=np.int64)
+    keep[0], keep[-1] = 0, len(x) - 1
+    last = 0
+    for bucket in range(num_points - 2):
+        start, stop = edges[bucket], edges[bucket + 1]
+        if bucket + 1 < len(sizes):
+            next_x, next_y = averages_x[bucket + 1], averages_y[bucket + 1]
+        else:
+            next_x, next_y = x[-1], y[-1]
+        # twice the area of the triangles, which is enough to compare them
+        areas = np.abs((x[last] - next_x) * (y[start:stop] - y[last]) - (x[last] - x[start:stop]) * (next_y - y[last]))
+        last = keep[bucket + 1] = start + int(np.argmax(areas))
+    return keep
+
+
+# get the indices of the points of a line kept by minmax, which splits the x range (the range of the line by default) into
+# columns and keeps the first, lowest, highest and last point of every column, the points outside the range counting
+# as part of the first or last column
+def get_minmax_indices(x, y, num_columns, x_range=None):
+    if len(x) <= 4 * num_columns:
+        return np.arange(len(x))
+    start, stop = x_range if x_range is not None else (x[0], x[-1])
+    # the points of a column follow each other because x is sorted
+    bounds = np.searchsorted(x, start + (stop - start) * np.arange(1, num_columns) / num_columns)
+    keep = []
+    for first, last in zip(np.concatenate([[0], bounds]), np.concatenate([bounds, [len(x)]])):
+        if first < last:
+            column = y[first:last]
+            keep += [first, first + int(np.argmin(column)), first + int(np.argmax(column)), last - 1]
+    return np.unique(np.array(keep, dtype=np.int64))
+
+
+# get the indices of the points of sorted x values between start and stop, together with the points just outside them so
+# the line still reaches the edges, as a slice
+def get_visible(x, start, stop):
+    first = max(int(np.searchsorted(x, start, "left")) - 1, 0)
+    last = min(int(np.searchsorted(x, stop, "right")) + 1, len(x))
+    return slice(first, last)
+
+
+# decimate a line with lttb to num_points points
+def lttb(x, y, num_points):
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    keep = get_lttb_indices(x, y, num_points)
+    return x[keep], y[keep]
+
+
+# decimate a line with minmax to at most four points for each of num_columns columns
+def minmax(x, y, num_columns):
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    keep = get_minmax_indices(x, y, num_columns)
+    return x[keep], y[keep]
+
+
+# decimate a line to what can be seen of it at a width in pixels, by default the width of the current axes, before plotting it
+# x must be sorted and both x and y finite, and only the points inside x_range and just outside it are kept if it is given
+def decimate(x, y, method="minmax", width=None, x_range=None):
+    if method not in DECIMATION_METHODS:
+        raise ValueError("'%s' is not one of the decimation methods %s" % (method, DECIMATION_METHODS))
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    if not is_decimable(x, y):
+        raise ValueError("only lines with sorted x values and finite values can be decimated")
+    width = width or get_pixel_width()
+    if x_range is not None:
+        x_range = sorted(x_range)
+        visible = get_visible(x, *x_range)
+        x, y = x[visible], y[visible]
+    if method == "lttb":
+        keep = get_lttb_indices(x, y, LTTB_POINTS_PER_PIXEL * width)
+    else:
+        keep = get_minmax_indices(x, y, width, x_range)
+    return x[keep], y[keep]
+
+
+# check if a line is drawn as a plain line in data coordinates, which looks the same once decimated
+def is_plain_line(line, axes):
+    return (line.get_marker() in ("None", "", " ", None) and line.get_linestyle() not in ("None", "", " ")
+            and line.get_drawstyle() == "default" and line.get_transform() == axes.transData)
+
+
+# decimate the long lines of a figure to what can be seen of them in an image of the given resolution, so the time it
+# takes to render the figure doesn't grow with the number of points
+# only the visible part of plain lines with sorted x values and finite values is kept, and only for lines with more than
+# POINTS_PER_PIXEL points per pixel column
+# returns the lines that were decimated with their data as [(line, x, y)], to put it back with restore_lines
+def decimate_lines(figure, method="minmax", dpi=None):
+    decimated = []
+    for axes in figure.get_axes():
+        width = None
+        for line in axes.get_lines():
+            if not is_plain_line(line, axes):
+                continue
+            x_data, y_data = line.get_xdata(orig=False), line.get_ydata(orig=False)
+            if width is None:
+                width = get_pixel_width(axes, dpi)
+            if len(x_data) <= POINTS_PER_PIXEL * width or np.ma.isMaskedArray(x_data) or np.ma.isMaskedArray(y_data):
+                continue
+            try:
+                x, y = np.asarray(x_data, dtype=float), np.asarray(y_data, dtype=float)
+            except (TypeError, ValueError):
+                continue
+            # the view limits are computed before the lines change, and the columns are even on the scale of the axis
+            start, stop = sorted(axes.get_xlim())
+            axes.get_ylim()
+            if axes.get_xscale() != "linear":
+                scale = axes.xaxis.get_transform()
+                x_scaled, (start, stop) = scale.transform(x), sorted(scale.transform(np.array([start, stop])))
+            else:
+                x_scaled = x
+            if not is_decimable(x_scaled, y) or not np.isfinite([start, stop]).all():
+                continue
+            visible = get_visible(x_scaled, start, stop)
+            if method == "lttb":
+                keep = visible.start + get_lttb_indices(x_scaled[visible], y[visible], LTTB_POINTS_PER_PIXEL * width)
+            else:
+                keep = visible.start + get_minmax_indices(x_scaled[visible], y[visible], width, (start, stop))
+            decimated.append((line, line.get_xdata(), line.get_ydata()))
+            line.set_data(x[keep], y[keep])
+    return decimated
+
+
+# put back the data of lines decimated with decimate_lines, so routines updating them keep working with all their points
+def restore_lines(decimated):
+    for line, x, y in decimated:
+        line.set_data(x, y)
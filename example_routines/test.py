@@ -2,7 +2,6 @@
 # module docstring and plot function doc strings will appear in GUI
 """example analysis script"""
 # import modules
-import json
 from scipy.optimize import curve_fit
 import matplotlib.pyplot as plt
 import numpy as np
@@ -10,17 +9,13 @@ import sys
 # temporary solution: add app to path for importing seneca_analysis.py
 sys.path.append("/Users/zacharyandalman/PycharmProjects/analysis")
 import seneca_analysis
-# required to get paths to data files and dictionary with data from previous measurements
-old_data, paths = seneca_analysis.parse_options()
+# required to get paths to data files and the state kept from previous measurements
+state, paths = seneca_analysis.load_state()
 
 
 # read data from path
 def read(path):
-    with open(path) as file:
-        data = json.load(file)
-    data['x'] = [float(x) for x in data['x']]
-    data['y'] = [float(y) for y in data['y']]
-    return data
+    return seneca_analysis.load_shared_shot(path)
 
 
 # linear function
@@ -33,11 +28,11 @@ def expon(x, a, b):
     return a * b ** x
 
 
-# update data from previous measurements with new measurement
-def update_data(old_data, new_data):
-    old_data['x'] += new_data['x']
-    old_data['y'] += new_data['y']
-    return old_data
+# append new measurement to the data from previous measurements
+def update_data(state, new_data):
+    state.append('x', new_data['x'])
+    state.append('y', new_data['y'])
+    return state
 
 
 # do a linear fit
@@ -77,13 +72,21 @@ def hist(x, y):
     axs[1].set_title("y")
 
 
-# plots must be called inside if __name__ == "__main__"
-if __name__ == "__main__":
+# entry point called with the shot paths and the state kept from previous measurements
+# the server calls it directly when the routine runs in-process
+def analyse(paths, state):
     data = read(paths[0])
-    full_data = update_data(old_data, data)
+    full_data = update_data(state, data)
     # do plots
     linear_fit(data["x"], data["y"])
     exponential_fit(data["x"], data["y"])
     hist(full_data["x"], full_data["y"])
-    # write updated data so it can be read back later
+    # return updated state so it is committed
+    return full_data
+
+
+# plots must be called inside if __name__ == "__main__" when the routine runs in its own process
+if __name__ == "__main__":
+    full_data = analyse(paths, state)
+    # commit appended data so it can be read back later
     seneca_analysis.write_data(full_data)
@@ -1,34 +1,42 @@
 """another example analysis script"""
 
 import matplotlib.pyplot as plt
-import json
+import numpy as np
 import sys
 sys.path.append("/Users/zacharyandalman/PycharmProjects/analysis")
 import seneca_analysis
 
-old_data, paths = seneca_analysis.parse_options()
+state, paths = seneca_analysis.load_state()
 
 def read(paths):
-    new_cpu_data = []
-    for path in paths:
-        with open(path) as file:
-            data = json.load(file)
-        new_cpu_data += [float(x) for x in data['cpu']]
-    return new_cpu_data
+    return np.concatenate([seneca_analysis.load_shared_shot(path)['cpu'] for path in paths] + [np.zeros(0)])
 
-def update_data(old_data, new_cpu_data):
-    old_data['cpu'] += new_cpu_data
-    return old_data
+def update_data(state, new_cpu_data):
+    state.append('cpu', new_cpu_data)
+    return state
 
-@seneca_analysis.plot
+# keep the figure between runs and only update the line data
+@seneca_analysis.plot(persistent=True)
 def cpu_percentage(cpu):
-    x = range(len(cpu))
-    plt.plot(x, cpu)
-    plt.xlim(max(0, len(cpu) - 50), len(cpu) + 50)
-    plt.ylabel("cpu percentage")
+    plot = seneca_analysis.current_plot()
+    start, stop = max(0, len(cpu) - 50), len(cpu) + 50
+    # only hand the visible part of the growing history to matplotlib, decimated to the width of the plot
+    x, y = seneca_analysis.decimate(np.arange(len(cpu)), cpu, x_range=(start, stop))
+    if plot.first:
+        plot.artists["cpu"], = plt.plot(x, y)
+        plt.ylabel("cpu percentage")
+    else:
+        plot.artists["cpu"].set_data(x, y)
+        plt.gca().relim()
+        plt.gca().autoscale_view()
+    plt.xlim(start, stop)
 
-if __name__ == "__main__":
+def analyse(paths, state):
     new_cpu_data = read(paths)
-    full_data = update_data(old_data, new_cpu_data)
+    full_data = update_data(state, new_cpu_data)
     cpu_percentage(full_data["cpu"])
+    return full_data
+
+if __name__ == "__main__":
+    full_data = analyse(paths, state)
     seneca_analysis.write_data(full_data)
\ No newline at end of file
@@ -0,0 +1,80 @@
+# import libraries
+import collections
+
+
+# raised when routines can't be run as a graph, because a routine they depend on doesn't exist or they depend on each other
+class GraphError(Exception):
+    pass
+
+
+# get the names of the routines whose results a routine uses
+def get_dependencies(routine):
+    return list(routine.get("depends_on", []))
+
+
+# get the routines that have to run for the given routines, which are the routines and everything they depend on, indexed by name
+def get_closure(names, routines):
+    closure = {}
+    stack = [(name, None) for name in names]
+    while stack:
+        name, dependent = stack.pop()
+        if name in closure:
+            continue
+        if name not in routines:
+            raise GraphError("'%s' depends on '%s', which doesn't exist" % (dependent, name))
+        closure[name] = routines[name]
+        stack += [(dependency, name) for dependency in get_dependencies(routines[name])]
+    return closure
+
+
+# get the names of the routines depending on each routine of a closure
+def get_dependents(routines):
+    dependents = {name: [] for name in routines}
+    for name, routine in routines.items():
+        for dependency in get_dependencies(routine):
+            dependents[dependency].append(name)
+    return dependents
+
+
+# sort the names of the routines of a closure so that every routine comes after the routines it depends on
+def sort_routines(routines):
+    waiting = {name: len(set(get_dependencies(routine))) for name, routine in routines.items()}
+    dependents = get_dependents(routines)
+    ready = collections.deque(sorted(name for name, count in waiting.items() if count == 0))
+    order = []
+    while ready:
+        name = ready.popleft()
+        order.append(name)
+        for dependent in sorted(set(dependents[name])):
+            waiting[dependent] -= 1
+            if waiting[dependent] == 0:
+                ready.append(dependent)
+    if len(order) < len(routines):
+        cycle = sorted(name for name in routines if name not in order)
+        raise GraphError("%s depend on each other" % ", ".join("'%s'" % name for name in cycle))
+    return order
+
+
+# split the routines of a closure into groups that run together, the routines of a group depending on each other
+# directly or through the other routines of the group
+def group_routines(routines):
+    neighbours = {name: set(get_dependencies(routine)) for name, routine in routines.items()}
+    for name, routine in routines.items():
+        for dependency in get_dependencies(routine):
+            neighbours[dependency].add(name)
+    groups = []
+    seen = set()
+    for name in sorted(routines):
+        if name in seen:
+            continue
+        group = []
+        stack = [name]
+        seen.add(name)
+        while stack:
+            member = stack.pop()
+            group.append(member)
+            for neighbour in neighbours[member] - seen:
+                seen.add(neighbour)
+                stack.append(neighbour)
+        groups.append(sorted(group))
+    return groups
@@ -0,0 +1,159 @@
+# import libraries
+import json
+import hashlib
+import threading
+import collections
+
+
+# get the key of the analysis of a routine, which is shared by all pages analysing it with the same settings
+def make_key(data_dir, routine, period):
+    content = json.dumps([data_dir, routine, period], sort_keys=True)
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+
+# the analysis of a routine, run once however many pages watch it
+# the engine publishes its events to every subscriber, and remembers the latest plots and progress so that pages
+# subscribing later start from the current results
+# events are ("plot", plot), ("plots", plots, time the run finished), ("progress", done, total, elapsed), ("missed", number),
+# ("warning", message), ("error", message) and ("complete", message)
+class Channel(object):
+
+    def __init__(self, key, data_dir, routine, period):
+        self.key = key
+        self.data_dir = data_dir
+        self.routine = routine
+        self.period = period
+        # latest plot of every plot id, in the order they were first made
+        self.snapshot = collections.OrderedDict()
+        self.progress = None
+        self.completed = None
+        # queues of the subscribed pages
+        self.subscribers = set()
+        # data the engine keeps while it is stopped, like the shots it still has to analyse
+        self.state = {}
+        # stops the engine, or None if it isn't running
+        self.stop_engine = None
+        self.lock = threading.RLock()
+
+    # send an event to every subscriber and remember the latest results
+    def publish(self, event):
+        with self.lock:
+            kind = event[0]
+            if kind == "plot":
+                self.snapshot[event[1]["plot_id"]] = event[1]
+            elif kind == "plots":
+                for plot in event[1]:
+                    self.snapshot[plot["plot_id"]] = plot
+            elif kind == "progress":
+                self.progress = event
+            elif kind == "complete":
+                self.completed = event
+            for subscriber in self.subscribers:
+                subscriber.put(event)
+
+    # get the latest plots
+    def get_plots(self):
+        with self.lock:
+            return list(self.snapshot.values())
+
+    # subscribe to the events, starting with the current results, and start the engine if it isn't running
+    # the events are passed to the put method of the subscriber, which must not block the engine
+    # start_engine is called with the channel and returns a function stopping the engine
+    def subscribe(self, start_engine, subscriber):
+        with self.lock:
+            if self.snapshot:
+                subscriber.put(("plots", list(self.snapshot.values()), None))
+            if self.progress is not None:
+                subscriber.put(self.progress)
+            if self.completed is not None:
+                subscriber.put(self.completed)
+            self.subscribers.add(subscriber)
+            if self.stop_engine is None and self.completed is None:
+                self.stop_engine = start_engine(self)
+        return subscriber
+
+    # remove a subscriber, waking it up, and stop the engine once nobody is subscribed
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            if subscriber not in self.subscribers:
+                return
+            self.subscribers.discard(subscriber)
+            idle = not self.subscribers
+        # the engine publishes while holding its own locks, so it is stopped outside the lock of the channel
+        if idle:
+            self.stop()
+
+    # stop the engine, keeping the results and its state so it can be started again
+    def stop(self):
+        with self.lock:
+            stop_engine, self.stop_engine = self.stop_engine, None
+        if stop_engine is not None:
+            stop_engine()
+
+    # mark the analysis as finished after the engine ran out of work
+    def complete(self, message):
+        self.publish(("complete", message))
+        self.stop()
+
+    # check if any page watches the analysis
+    def is_watched(self):
+        with self.lock:
+            return bool(self.subscribers)
+
+
+# the analyses of all routines and the pages subscribed to them
+class AnalysisHub(object):
+
+    def __init__(self):
+        self.channels = {}
+        # subscriptions of every page as (channel, subscriber) indexed by the id of the page
+        self.viewers = collections.defaultdict(list)
+        self.lock = threading.Lock()
+
+    # get the analysis with a key, or None
+    def get(self, key):
+        with self.lock:
+            return self.channels.get(key)
+
+    # start a new analysis of a routine, replacing analyses of the routine that nobody watches
+    def create(self, data_dir, routine, period):
+        key = make_key(data_dir, routine, period)
+        with self.lock:
+            for other in list(self.channels.values()):
+                if other.routine["name"] == routine["name"] and not other.is_watched():
+                    other.stop()
+                    del self.channels[other.key]
+            channel = self.channels[key] = Channel(key, data_dir, routine, period)
+        return channel
+
+    # subscribe a page to an analysis
+    def subscribe(self, viewer_id, channel, start_engine, subscriber):
+        channel.subscribe(start_engine, subscriber)
+        with self.lock:
+            self.viewers[viewer_id].append((channel, subscriber))
+
+    # get the subscriptions of a page as (channel, subscriber)
+    def get_subscriptions(self, viewer_id):
+        with self.lock:
+            return list(self.viewers.get(viewer_id, []))
+
+    # unsubscribe a page from an analysis
+    def unsubscribe(self, viewer_id, channel, subscriber):
+        with self.lock:
+            subscriptions = self.viewers.get(viewer_id, [])
+            if (channel, subscriber) in subscriptions:
+                subscriptions.remove((channel, subscriber))
+            if not subscriptions:
+                self.viewers.pop(viewer_id, None)
+        channel.unsubscribe(subscriber)
+
+    # unsubscribe a page from all analyses, which stops the analyses nobody else watches
+    def leave(self, viewer_id):
+        with self.lock:
+            subscriptions = self.viewers.pop(viewer_id, [])
+        for channel, subscriber in subscriptions:
+            channel.unsubscribe(subscriber)
+
+
+# analyses shared by all pages
+hub = AnalysisHub()
@@ -0,0 +1,44 @@
+# import libraries
+import hashlib
+import threading
+from collections import OrderedDict
+
+# total size (in bytes) of the rendered plots kept in memory
+MAX_BYTES = 256 * 1024 ** 2
+
+
+# rendered plots stored under the hash of their content, dropping the least recently used plots when full
+class ImageStore(object):
+
+    def __init__(self, max_bytes=MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.images = OrderedDict()
+        self.lock = threading.Lock()
+
+    # store an image and return its content hash
+    def put(self, image, mime_type):
+        digest = hashlib.sha1(image).hexdigest()
+        with self.lock:
+            if digest in self.images:
+                self.images.move_to_end(digest)
+                return digest
+            self.images[digest] = (image, mime_type)
+            self.num_bytes += len(image)
+            # always keep the newest image, even if it is larger than the store
+            while self.num_bytes > self.max_bytes and len(self.images) > 1:
+                old_image, old_mime_type = self.images.popitem(last=False)[1]
+                self.num_bytes -= len(old_image)
+        return digest
+
+    # get an image and its MIME type from its content hash, or None if it isn't stored
+    def get(self, digest):
+        with self.lock:
+            image = self.images.get(digest)
+            if image is not None:
+                self.images.move_to_end(digest)
+            return image
+
+
+# rendered plots shared by all routines and viewers
+image_store = ImageStore()
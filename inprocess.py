@@ -0,0 +1,253 @@
+# import libraries
+import os
+import sys
+import io
+import contextlib
+import traceback
+import queue
+import threading
+import functools
+import importlib.util
+# plots are only ever saved to memory, so don't open any windows in the server
+os.environ.setdefault("MPLBACKEND", "Agg")
+import seneca_analysis
+from statestore import StateStore
+
+# name of the function a routine defines to be run inside the server
+ENTRY_POINT = "analyse"
+# matplotlib's pyplot state is global, so only one routine runs in-process at a time
+run_lock = threading.Lock()
+# interval (in seconds) at which a run waiting for run_lock checks if it was stopped in the meantime
+LOCK_POLL_INTERVAL = 0.1
+# threads of the in-process runs that were stopped while their routine was running indexed by the path to the routine,
+# which keep running (and holding run_lock) until the routine returns since a thread can't be killed
+abandoned_runs = {}
+# path to the routine holding run_lock, or None
+lock_owner = None
+# guards abandoned_runs and lock_owner
+runs_lock = threading.Lock()
+# routine modules imported into the server indexed by the path to the routine
+loaded_routines = {}
+
+
+# raised instead of running a routine in-process while it, or the routine blocking all in-process runs, is stuck in a run
+# that was stopped
+class RoutineStuck(RuntimeError):
+    pass
+
+
+# stands in for sys.stdout or sys.stderr, writing what a thread prints to the stream registered for it, or to the stream
+# it replaced for the other threads, so the output of a routine running in-process doesn't mix with what the server prints
+class ThreadStream(object):
+
+    def __init__(self, default):
+        self.default = default
+        # streams indexed by thread identifier
+        self.streams = {}
+
+    # get the stream of the current thread
+    def get_stream(self):
+        return self.streams.get(threading.get_ident(), self.default)
+
+    def write(self, text):
+        return self.get_stream().write(text)
+
+    def flush(self):
+        self.get_stream().flush()
+
+    def __getattr__(self, name):
+        return getattr(self.get_stream(), name)
+
+
+# the streams standing in for sys.stdout and sys.stderr, installed the first time a routine runs in-process
+thread_streams = None
+thread_streams_lock = threading.Lock()
+
+
+# send what the current thread prints to a stream while inside the block
+@contextlib.contextmanager
+def capture_output(stream):
+    global thread_streams
+    with thread_streams_lock:
+        if thread_streams is None:
+            thread_streams = ThreadStream(sys.stdout), ThreadStream(sys.stderr)
+            sys.stdout, sys.stderr = thread_streams
+    ident = threading.get_ident()
+    for thread_stream in thread_streams:
+        thread_stream.streams[ident] = stream
+    try:
+        yield
+    finally:
+        for thread_stream in thread_streams:
+            thread_stream.streams.pop(ident, None)
+
+
+# a routine module together with the modification times of the files it was loaded from
+class LoadedRoutine(object):
+
+    def __init__(self, module, mtimes):
+        self.module = module
+        self.mtimes = mtimes
+
+    # check if the routine or one of its support files changed on disk
+    def is_stale(self):
+        for path, mtime in self.mtimes.items():
+            try:
+                if os.path.getmtime(path) != mtime:
+                    return True
+            except OSError:
+                return True
+        return False
+
+
+# get the modification time of a file, or None if it no longer exists
+def get_mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+# list the modules imported from a directory and the files they were loaded from
+def get_directory_modules(directory):
+    modules = {}
+    for name, module in list(sys.modules.items()):
+        filename = getattr(module, "__file__", None)
+        if filename and os.path.dirname(os.path.abspath(filename)) == directory:
+            modules[name] = os.path.abspath(filename)
+    return modules
+
+
+# get a valid module name from the file name of a routine
+def get_module_name(path_to_routine):
+    name = os.path.splitext(os.path.basename(path_to_routine))[0]
+    return "".join(char if char.isalnum() else "_" for char in name)
+
+
+# import a routine as a module, reloading it only if it or its support files changed
+def load_routine(path_to_routine):
+    path_to_routine = os.path.abspath(path_to_routine)
+    loaded = loaded_routines.get(path_to_routine)
+    if loaded is not None and not loaded.is_stale():
+        return loaded.module
+    directory = os.path.dirname(path_to_routine)
+    # forget support modules that changed so the routine imports the new versions
+    for name, filename in get_directory_modules(directory).items():
+        if loaded is not None and filename in loaded.mtimes and loaded.mtimes[filename] != get_mtime(filename):
+            sys.modules.pop(name, None)
+    module_name = "seneca_routine_%s" % get_module_name(path_to_routine)
+    spec = importlib.util.spec_from_file_location(module_name, path_to_routine)
+    module = importlib.util.module_from_spec(spec)
+    if directory not in sys.path:
+        sys.path.append(directory)
+    # routines parse the command line when imported, so hide the server's arguments
+    save_argv = sys.argv
+    sys.argv = [path_to_routine]
+    try:
+        spec.loader.exec_module(module)
+    finally:
+        sys.argv = save_argv
+    # remember the files the routine was loaded from
+    mtimes = {path_to_routine: get_mtime(path_to_routine)}
+    for filename in get_directory_modules(directory).values():
+        mtimes[filename] = get_mtime(filename)
+    loaded_routines[path_to_routine] = LoadedRoutine(module, mtimes)
+    return module
+
+
+# forget a routine so it is imported again the next time it runs
+def unload_routine(path_to_routine):
+    loaded_routines.pop(os.path.abspath(path_to_routine), None)
+
+
+# pass a plot of an in-process routine on, unless its run was cancelled, which stops the routine instead
+def handle_plot(plots, control, *plot):
+    if control is not None:
+        control.check()
+    plots.put(plot)
+
+
+# raise RoutineStuck if a routine can't run in-process because an earlier run that was stopped is still running it or
+# holds run_lock, which only a restart of the server ends if the routine never returns
+def check_stuck(path_to_routine):
+    with runs_lock:
+        if path_to_routine in abandoned_runs:
+            raise RoutineStuck("'%s' is stuck in a run that was stopped and can't run again until it returns, restart the server to stop it" % os.path.basename(path_to_routine))
+        if lock_owner in abandoned_runs:
+            raise RoutineStuck("'%s' is stuck in a run that was stopped and no routine can run in-process until it returns, restart the server to stop it" % os.path.basename(lock_owner))
+
+
+# run a routine inside the server, yielding (function name, count, image, data, format, timings) for each plot as soon as it is made
+# a thread can't be killed, so a cancelled routine is stopped at its next plot and stops being waited for right away, and
+# a run stopped before it got to run its routine doesn't run it at all
+# returns the printed output of the routine and whether it failed
+def run_inprocess(path_to_routine, shots_paths, data_path=None, control=None, upstream=None):
+    path_to_routine = os.path.abspath(path_to_routine)
+    check_stuck(path_to_routine)
+    plots = queue.Queue()
+    output = io.StringIO()
+    result = dict(failed=False, started=False, done=False)
+    stopped = threading.Event()
+
+    # the routine runs in its own thread so the plots can be handed on while it is still running
+    def run():
+        global lock_owner
+        # wait for the routine running before this one, unless this run is stopped in the meantime
+        while not run_lock.acquire(timeout=LOCK_POLL_INTERVAL):
+            if stopped.is_set():
+                return
+        with runs_lock:
+            if stopped.is_set():
+                run_lock.release()
+                return
+            result["started"] = True
+            lock_owner = path_to_routine
+        with capture_output(output):
+            try:
+                module = load_routine(path_to_routine)
+                entry_point = getattr(module, ENTRY_POINT, None)
+                if not callable(entry_point):
+                    raise AttributeError("'%s' has no '%s(paths, data)' function to run in-process" % (os.path.basename(path_to_routine), ENTRY_POINT))
+                # the routine gets the state kept from previous measurements and appends to it
+                state = StateStore(data_path) if data_path else None
+                seneca_analysis.reset_counters(module)
+                with seneca_analysis.plot_handler(functools.partial(handle_plot, plots, control)), seneca_analysis.upstream_results(upstream or {}):
+                    new_data = entry_point(list(shots_paths), state)
+                # commit the updated state, or replace it by the data returned by the routine
+                if state is not None and new_data is not None:
+                    if new_data is not state:
+                        state.replace(new_data)
+                    state.commit()
+            except Exception:
+                result["failed"] = True
+                traceback.print_exc()
+            finally:
+                # close figures left open by the routine so they don't accumulate between runs
+                seneca_analysis.close_figures()
+                with runs_lock:
+                    result["done"] = True
+                    lock_owner = None
+                    if abandoned_runs.get(path_to_routine) is threading.current_thread():
+                        del abandoned_runs[path_to_routine]
+                run_lock.release()
+                plots.put(None)
+
+    thread = threading.Thread(target=run, name="inprocess-%s" % os.path.basename(path_to_routine), daemon=True)
+    thread.start()
+    try:
+        # cancelling the run wakes this loop up as if the routine finished
+        with control.killing(lambda: plots.put(None)) if control else contextlib.nullcontext():
+            while True:
+                plot = plots.get()
+                if plot is None:
+                    break
+                yield plot
+    finally:
+        # a run stopped while its routine is running is remembered until the routine returns
+        with runs_lock:
+            stopped.set()
+            if result["started"] and not result["done"]:
+                abandoned_runs[path_to_routine] = thread
+    if control is not None:
+        control.check()
+    return output.getvalue(), result["failed"]
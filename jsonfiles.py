@@ -0,0 +1,105 @@
+# import libraries
+import os
+import json
+import queue
+import threading
+
+# extensions of the files that can be used as read-write files
+JSON_EXTENSIONS = (".json",)
+# number of bytes read from the start of a file to check that it looks like a json object
+SNIFF_BYTES = 64
+# files larger than this (in bytes) are only sniffed and never parsed completely
+MAX_VALIDATE_BYTES = 256 * 1024 ** 2
+
+
+# check if a file starts like a json object without reading all of it
+def sniff(path):
+    try:
+        with open(path, "rb") as file:
+            start = file.read(SNIFF_BYTES)
+    except OSError:
+        return False
+    return start.lstrip(b"\xef\xbb\xbf \t\r\n").startswith(b"{")
+
+
+# check if a file contains a json object by parsing all of it
+def validate(path):
+    try:
+        with open(path, "r") as file:
+            return isinstance(json.load(file), dict)
+    except (OSError, ValueError):
+        return False
+
+
+# the json files of data directories that can be used as read-write files, found by sniffing the start of the files while
+# the complete parse of new and modified files runs in the background and is remembered by (inode, size, modification time)
+class JsonFileIndex(object):
+
+    def __init__(self):
+        # results indexed by path as ((inode, size, modification time), whether the file is valid, whether it was parsed)
+        self.results = {}
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.queued = set()
+        self.thread = None
+
+    # get the names of the json files in a directory, using the result of the last parse of files that didn't change
+    def list_files(self, directory):
+        names = []
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if not entry.name.lower().endswith(JSON_EXTENSIONS):
+                    continue
+                try:
+                    if not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                version = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+                with self.lock:
+                    result = self.results.get(entry.path)
+                if result is None or result[0] != version:
+                    valid = sniff(entry.path)
+                    # files that look right are parsed in the background, which corrects them on the next listing if they aren't
+                    parsed = not valid or stat.st_size > MAX_VALIDATE_BYTES
+                    result = (version, valid, parsed)
+                    with self.lock:
+                        self.results[entry.path] = result
+                    if not parsed:
+                        self.queue_validation(entry.path, version)
+                if result[1]:
+                    names.append(entry.name)
+        return sorted(names)
+
+    # parse a file in the background
+    def queue_validation(self, path, version):
+        with self.lock:
+            if (path, version) in self.queued:
+                return
+            self.queued.add((path, version))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.validate_queued, name="json-files", daemon=True)
+                self.thread.start()
+        self.queue.put((path, version))
+
+    # parse the queued files one after the other
+    def validate_queued(self):
+        while True:
+            path, version = self.queue.get()
+            valid = validate(path)
+            try:
+                stat = os.stat(path)
+                unchanged = (stat.st_ino, stat.st_size, stat.st_mtime_ns) == version
+            except OSError:
+                unchanged = False
+            with self.lock:
+                self.queued.discard((path, version))
+                # only keep the result if the file didn't change in the meantime
+                result = self.results.get(path)
+                if unchanged and result is not None and result[0] == version:
+                    self.results[path] = (version, valid, True)
+
+
+# json files of all data directories
+json_files = JsonFileIndex()
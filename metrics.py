@@ -0,0 +1,144 @@
+# import libraries
+import math
+import time
+import threading
+import contextlib
+
+# upper bounds of the histogram buckets for durations (in seconds) and sizes (in bytes)
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BYTE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+
+# escape a label value for the Prometheus text format
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+# format labels as {name="value",...}, or nothing if there are none
+def format_labels(names, values, extra=()):
+    pairs = ['%s="%s"' % (name, escape_label(value)) for name, value in list(zip(names, values)) + list(extra)]
+    return "{%s}" % ",".join(pairs) if pairs else ""
+
+
+# format a number for the Prometheus text format
+def format_number(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
+
+
+# a value that only goes up, one for every combination of label values
+class Counter(object):
+
+    def __init__(self, name, description, label_names=()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    # add to the counter of the given label values
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.label_names)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    # get the lines of the counter in the Prometheus text format
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.description), "# TYPE %s counter" % self.name]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append("%s%s %s" % (self.name, format_labels(self.label_names, key), format_number(value)))
+        return lines
+
+
+# the distribution of observed values in cumulative buckets, one for every combination of label values
+class Histogram(object):
+
+    def __init__(self, name, description, label_names=(), buckets=TIME_BUCKETS):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets) + (math.inf,)
+        # number of observations per bucket, their sum and their count indexed by label values
+        self.values = {}
+        self.lock = threading.Lock()
+
+    # add an observation for the given label values
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.label_names)
+        with self.lock:
+            counts, total, count = self.values.get(key, ([0] * len(self.buckets), 0, 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self.values[key] = (counts, total + value, count + 1)
+
+    # context manager observing the time (in seconds) spent inside it
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    # get the lines of the histogram in the Prometheus text format
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.description), "# TYPE %s histogram" % self.name]
+        with self.lock:
+            for key, (counts, total, count) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    labels = format_labels(self.label_names, key, [("le", format_number(bound))])
+                    lines.append("%s_bucket%s %d" % (self.name, labels, cumulative))
+                labels = format_labels(self.label_names, key)
+                lines.append("%s_sum%s %s" % (self.name, labels, format_number(total)))
+                lines.append("%s_count%s %d" % (self.name, labels, count))
+        return lines
+
+
+# all metrics of the server, rendered together at /metrics
+class MetricsRegistry(object):
+
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, description, label_names=()):
+        metric = Counter(name, description, label_names)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, description, label_names=(), buckets=TIME_BUCKETS):
+        metric = Histogram(name, description, label_names, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    # get all metrics in the Prometheus text format
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+
+shot_selection_seconds = metrics.histogram("seneca_shot_selection_seconds", "Time spent selecting the shots to analyse.", ["routine"])
+spawn_seconds = metrics.histogram("seneca_spawn_seconds", "Time spent starting a routine process or worker.", ["routine"])
+run_seconds = metrics.histogram("seneca_run_seconds", "Time spent running a routine, from the start of the run to its last plot.", ["routine"])
+draw_seconds = metrics.histogram("seneca_draw_seconds", "Time spent in a plot function drawing its figure.", ["routine", "function"])
+render_seconds = metrics.histogram("seneca_render_seconds", "Time spent rendering and encoding the figure of a plot function.", ["routine", "function"])
+decode_seconds = metrics.histogram("seneca_decode_seconds", "Time spent storing the plots of a run once they were received from the routine.", ["routine"])
+push_seconds = metrics.histogram("seneca_push_seconds", "Time from a run finishing to its changed plots being pushed to the browser.", ["routine"])
+image_bytes = metrics.histogram("seneca_image_bytes", "Size of the encoded plot images.", ["routine", "function"], BYTE_BUCKETS)
+pushed_bytes = metrics.counter("seneca_pushed_bytes_total", "Bytes of plot updates pushed to the browser.", ["routine"])
+shots_processed = metrics.counter("seneca_shots_processed_total", "Shots analysed successfully.", ["routine"])
+runs_total = metrics.counter("seneca_runs_total", "Runs of a routine, including the runs skipped because their inputs hadn't changed.", ["routine"])
+cached_runs = metrics.counter("seneca_cached_runs_total", "Runs skipped because their inputs hadn't changed.", ["routine"])
+errors_total = metrics.counter("seneca_errors_total", "Runs that failed.", ["routine"])
+timeouts_total = metrics.counter("seneca_timeouts_total", "Runs killed because they took longer than the timeout of their routine.", ["routine"])
+dropped_messages = metrics.counter("seneca_dropped_messages_total", "Push messages replaced by newer ones or dropped because a page couldn't keep up.")
+missed_deadlines = metrics.counter("seneca_missed_deadlines_total", "Updates missed because a routine took longer than its update period.", ["routine"])
@@ -2,9 +2,24 @@
 # import libraries
 import os
 import subprocess
-import json
+import tempfile
+import logging
+import html
 import time
 import re
+import contextlib
+import threading
+from workers import get_pool
+from catalog import get_catalog
+from images import image_store
+from runcache import run_cache, make_run_key, get_state_version
+from inprocess import run_inprocess
+from metrics import shot_selection_seconds, spawn_seconds, run_seconds, draw_seconds, render_seconds, decode_seconds, image_bytes, shots_processed, runs_total, cached_runs, errors_total, timeouts_total
+from protocol import read_frames, encode_upstream, RESULT_FD_VARIABLE, UPSTREAM_FD_VARIABLE
+from runcontrol import RunControl, RunCancelled, RunTimeout, run_timeouts, kill_process_group, TIMED_OUT, CANCELLED
+
+# printed output of the routines is written to this log instead of being parsed
+logger = logging.getLogger("routines")
 
 def filter_regex(lst, regex, sort=False):
     filt = re.compile(regex)
@@ -20,96 +35,272 @@ def filter_regex(lst, regex, sort=False):
 def get_shots_paths(analysis_options, shots_dir, data_dir):
     # get measurement selection method
     select_method = analysis_options["select-shots-by"]
-    # get the paths to all measurement files in the directory
-    all_shots = [os.path.join(data_dir, shots_dir, shot) for shot in os.listdir(os.path.join(data_dir, shots_dir)) if os.path.isfile(os.path.join(data_dir, shots_dir, shot)) and not shot.startswith(".")]
+    # get the shared catalog of all measurement files in the directory, checking modification times only if needed
+    catalog = get_catalog(os.path.join(data_dir, shots_dir))
+    catalog.refresh(restat=select_method in ["last-modified", "modified"])
     num_shots = int(analysis_options["num-shots"])
-    filetypes = analysis_options["filetype"]
-    regex = analysis_options["regex"]
     now = time.time()
     period = get_period(analysis_options)
     if select_method == "choice":
-        shots = [os.path.join(data_dir, shots_dir, shot) for shot in analysis_options["choice"]]
+        shots = catalog.get_paths(analysis_options["choice"])
     elif select_method == "all":
-        shots = all_shots
+        shots = catalog.sorted_paths("name")
     elif select_method == "last-created":
-        all_shots.sort(key=os.path.getctime)
-        shots = all_shots[-num_shots:]
+        shots = catalog.last_paths("ctime", num_shots)
     elif select_method == "last-modified":
-        all_shots.sort(key=os.path.getmtime)
-        shots = all_shots[-num_shots:]
+        shots = catalog.last_paths("mtime", num_shots)
     elif select_method == "new":
-        shots = [shot for shot in all_shots if now - os.path.getctime(shot) <= period]
+        shots = catalog.paths_since("ctime", now - period)
     elif select_method == "modified":
-        shots = [shot for shot in all_shots if now - os.path.getmtime(shot) <= period]
+        shots = catalog.paths_since("mtime", now - period)
+    elif select_method == "arrival":
+        # the shots are chosen by the arrival engine as they arrive, so only the latest one is analysed to draw the plots at the start
+        shots = catalog.last_paths("ctime", 1)
+    return filter_shots(shots, analysis_options)
+
+# keep the shots of the chosen file types, which are given as extensions separated by "/" (e.g. "jpeg/jpg")
+def filter_filetypes(shots, filetypes):
     if filetypes:
         all_filetypes = []
         for filetype in filetypes:
             all_filetypes += filetype.split("/")
-        shots = [shot for shot in shots if shot.rsplit('.', 1)[1].lower() in all_filetypes]
+        shots = [shot for shot in shots if shot.rsplit('.', 1)[-1].lower() in all_filetypes]
+    return shots
+
+# keep the shots of the chosen file types matching the regular expression filter
+def filter_shots(shots, analysis_options):
+    regex = analysis_options["regex"]
+    shots = filter_filetypes(shots, analysis_options["filetype"])
     if regex:
         shots = filter_regex(shots, regex)
     return shots
 
 def get_all_shots_paths_old(analysis_options, shots_dir, data_dir):
     order_method = analysis_options["order-shots-by"]
-    all_shots = [os.path.join(data_dir, shots_dir, shot) for shot in os.listdir(os.path.join(data_dir, shots_dir)) if os.path.isfile(os.path.join(data_dir, shots_dir, shot)) and not shot.startswith(".")]
+    catalog = get_catalog(os.path.join(data_dir, shots_dir))
+    catalog.refresh(restat=order_method == "modification")
     filetypes = analysis_options["filetype"]
     if order_method == "choice":
-        shots = [os.path.join(data_dir, shots_dir, shot) for shot in analysis_options["choice"]]
+        shots = catalog.get_paths(analysis_options["choice"])
     elif order_method == "creation":
-        shots = sorted(all_shots, key=os.path.getctime)
+        shots = catalog.sorted_paths("ctime")
     elif order_method == "modification":
-        shots = sorted(all_shots, key=os.path.getmtime)
+        shots = catalog.sorted_paths("mtime")
     elif order_method == "sort":
-        shots = sorted(all_shots)
+        shots = catalog.sorted_paths("name")
     elif order_method == "regex":
         regex = analysis_options["regex"]
-        shots = filter_regex(all_shots, regex, sort=True)
-    if filetypes:
-        all_filetypes = []
-        for filetype in filetypes:
-            all_filetypes += filetype.split("/")
-        shots = [shot for shot in shots if shot.rsplit('.', 1)[1].lower() in all_filetypes]
-    return shots
+        shots = catalog.regex_sorted_paths(regex)
+    # the regular expression sorts the old shots instead of filtering them
+    return filter_filetypes(shots, filetypes)
 
 
-# run the routines and generate the plot urls
-def generate_plot_urls(routine, routine_path, data_dir, shots_paths=None):
-    if not shots_paths:
-        shots_paths = get_shots_paths(routine["analysis"]["new_options"], routine["shots_dir"], data_dir)
-    path_to_routine = os.path.join(routine_path, routine["name"])
-    # create a list of arguments to pass to the command line
-    arguments = ["python", path_to_routine]
-    if routine["json"]:
-        arguments += ["-d", os.path.join(data_dir, routine["json"])]
-    arguments += shots_paths
+# raised when a routine fails, with the output of the routine as the message
+class RoutineError(Exception):
+    pass
+
+
+# write the printed output of a routine to the routine log
+def log_output(routine_name, output):
+    if output.strip():
+        logger.info("output of '%s':\n%s", routine_name, output.rstrip())
+
+
+# write the results of the routines a routine depends on to a pipe in the background, so a routine that doesn't read them
+# never blocks the run
+def send_upstream(write_fd, upstream):
+
+    def write():
+        try:
+            with os.fdopen(write_fd, "wb") as stream:
+                stream.write(encode_upstream(upstream))
+        except OSError:
+            pass
+    threading.Thread(target=write, name="upstream", daemon=True).start()
+
+
+# run a routine in a fresh python process, yielding its plots as they are written to the result pipe
+# the process gets its own process group, so cancelling the run also kills the processes the routine started
+# the results of the routines it depends on are passed through a second pipe
+# returns the printed output of the routine and whether it failed
+def run_subprocess(path_to_routine, arguments, control=None, upstream=None):
+    read_fd, write_fd = os.pipe()
+    env = dict(os.environ)
+    env[RESULT_FD_VARIABLE] = str(write_fd)
+    pass_fds = [write_fd]
+    upstream_fds = os.pipe() if upstream else None
+    if upstream_fds:
+        env[UPSTREAM_FD_VARIABLE] = str(upstream_fds[0])
+        pass_fds.append(upstream_fds[0])
+    with tempfile.TemporaryFile() as log:
+        try:
+            # printed output goes to a temporary file so the routine never blocks on it
+            with spawn_seconds.time(routine=os.path.basename(path_to_routine)):
+                out = subprocess.Popen(["python", path_to_routine] + arguments, stdout=log, stderr=subprocess.STDOUT, pass_fds=pass_fds, env=env, start_new_session=True)
+        except Exception:
+            os.close(read_fd)
+            if upstream_fds:
+                os.close(upstream_fds[1])
+            raise
+        finally:
+            os.close(write_fd)
+            if upstream_fds:
+                os.close(upstream_fds[0])
+        if upstream_fds:
+            send_upstream(upstream_fds[1], upstream)
+        finished = False
+        try:
+            # killing the routine closes the result pipe, which ends the stream
+            with os.fdopen(read_fd, "rb") as results, (control.killing(lambda: kill_process_group(out)) if control else contextlib.nullcontext()):
+                yield from read_frames(results)
+            finished = True
+        finally:
+            # stop the routine if the rest of its plots are no longer wanted
+            if not finished:
+                kill_process_group(out)
+            out.wait()
+        log.seek(0)
+        output = log.read().decode("utf-8", "replace")
+    return output, out.returncode != 0
+
+
+# run a routine with the results of the routines it depends on, yielding (function name, count, image, data, format, timings)
+# for each plot as it arrives
+# raises RunCancelled or RunTimeout if the run was stopped through its control
+def run_routine(routine, path_to_routine, shots_paths, data_path, control=None, upstream=None):
+    execution = routine.get("execution", "worker")
+    if execution == "inprocess":
+        # call trusted routines directly inside the server without spawning or parsing anything
+        runner = run_inprocess(path_to_routine, shots_paths, data_path, control, upstream)
+    else:
+        # create a list of arguments to pass to the command line
+        arguments = []
+        if data_path:
+            arguments += ["-d", data_path]
+        arguments += shots_paths
+        if execution == "subprocess":
+            # run in a fresh python process to isolate the routine completely
+            runner = run_subprocess(path_to_routine, arguments, control, upstream)
+        else:
+            # otherwise reuse a warm worker which already has the analysis libraries imported
+            runner = get_pool(path_to_routine).run(path_to_routine, arguments, control, upstream)
     try:
-        # run the routine
-        out = subprocess.Popen(arguments, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    except Exception as err:
-        return True, err
-    # get the standard output
-    stdout, stderr = out.communicate()
+        output, failed = yield from runner
+    except Exception:
+        # a killed routine breaks off its stream, which is reported as the reason it was killed
+        if control is not None:
+            control.check()
+        raise
+    log_output(routine["name"], output)
+    if control is not None:
+        control.check()
+    if failed:
+        raise RoutineError(output)
+
+
+# get the MIME type of a plot image format
+def get_mime_type(image_format):
+    if image_format == "svg":
+        return "image/svg+xml"
+    elif image_format == "jpg":
+        return "image/jpeg"
+    return "image/%s" % image_format
+
+
+# generate a dictionary with information about a plot
+def make_plot(function_name, function_cnt, image, plot_data, image_format="png"):
+    plot_id = "plot-container-%s%s" % (function_name, function_cnt)
+    table_id = "table-container-%s%s" % (function_name, function_cnt)
+    # the image is served from the image store under the hash of its content
+    digest = image_store.put(image, get_mime_type(image_format))
+    plot_url = "/plots/%s" % digest
+    return dict(plot_id=plot_id, url=plot_url, data=plot_data, table_id=table_id, name=function_name, count=function_cnt)
+
+
+# format the output of a failed routine to be displayed as a status message
+def format_output(output):
+    return html.escape(output.strip()).replace("\n", "<br/>")
+
+
+# run the routines and generate the plot urls, handing each plot to on_plot as soon as the routine produced it if given
+# returns (error, plots), where error is TIMED_OUT or CANCELLED instead of True if the run was stopped before it finished
+# the run is added to runs if given, so it can be cancelled together with the other runs of an analysis
+# upstream holds the results of the routines the routine depends on, indexed by routine name (see get_results)
+def generate_plot_urls(routine, routine_path, data_dir, shots_paths=None, on_plot=None, runs=None, upstream=None):
+    routine_name = routine["name"]
+    if not shots_paths:
+        with shot_selection_seconds.time(routine=routine_name):
+            shots_paths = get_shots_paths(routine["analysis"]["new_options"], routine["shots_dir"], data_dir)
+    path_to_routine = os.path.join(routine_path, routine_name)
+    data_path = os.path.join(data_dir, routine["json"]) if routine["json"] else None
+    runs_total.inc(routine=routine_name)
     try:
-        # parse the standard output
-        split_stdout = str(stdout)[:-1].split("@@@")[1:]
-        function_name_list = split_stdout[::4]
-        function_cnt_list = split_stdout[1::4]
-        plot_url_list = split_stdout[2::4]
-        plot_data_list = split_stdout[3::4]
-        # generate a list of dictionaries with information about the plots
+        # reuse the plots of the last run if the routine, the shots and the read-write file are unchanged
+        key = make_run_key(path_to_routine, shots_paths, data_path, upstream)
+        plots = run_cache.lookup(routine_name, key)
+        if plots is not None:
+            cached_runs.inc(routine=routine_name)
+            return False, plots
         plots = []
-        for i in range(len(function_name_list)):
-            plot_id = "plot-container-%s%s" % (function_name_list[i], function_cnt_list[i])
-            plot_url = "data:image/png;base64,{}".format(plot_url_list[i])
-            plot_data = json.loads(plot_data_list[i])
-            table_id = "table-container-%s%s" % (function_name_list[i], function_cnt_list[i])
-            plots.append(dict(plot_id=plot_id, url=plot_url, data=plot_data, table_id=table_id, name=function_name_list[i], count=function_cnt_list[i]))
-    except IndexError:
-        return True, "".join(str(stdout)[2:-1].split("\\n"))
+        decode_time = 0
+        start = time.perf_counter()
+        with RunControl(routine_name, get_timeout(routine), runs) as control:
+            for function_name, count, image, plot_data, image_format, timings in run_routine(routine, path_to_routine, shots_paths, data_path, control, upstream):
+                received = time.perf_counter()
+                plots.append(make_plot(function_name, count, image, plot_data, image_format))
+                decode_time += time.perf_counter() - received
+                if on_plot is not None:
+                    on_plot(plots[-1])
+                # the routine measures the time spent drawing and rendering each plot
+                if "draw" in timings:
+                    draw_seconds.observe(timings["draw"], routine=routine_name, function=function_name)
+                if "render" in timings:
+                    render_seconds.observe(timings["render"], routine=routine_name, function=function_name)
+                image_bytes.observe(len(image), routine=routine_name, function=function_name)
+        run_seconds.observe(time.perf_counter() - start - decode_time, routine=routine_name)
+        decode_seconds.observe(decode_time, routine=routine_name)
+    except RunTimeout as err:
+        # remember the timeout so the scheduler gives the routine more time before its next run
+        run_timeouts.record(routine_name)
+        timeouts_total.inc(routine=routine_name)
+        return TIMED_OUT, str(err)
+    except RunCancelled as err:
+        return CANCELLED, str(err)
+    except RoutineError as err:
+        errors_total.inc(routine=routine_name)
+        return True, format_output(str(err))
+    except Exception as err:
+        errors_total.inc(routine=routine_name)
+        return True, "%s: %s" % (err.__class__.__name__, err)
+    run_timeouts.clear(routine_name)
+    shots_processed.inc(len(shots_paths), routine=routine_name)
+    # the routine may have written the read-write file itself, so store the run under the version it left behind
+    run_cache.store(routine_name, key[:2] + (get_state_version(data_path) if data_path else None,) + key[3:], plots)
     return False, plots
 
 
+# get the results of a run handed to the routines depending on it, which are the data of the last plot of every plot
+# function indexed by function name
+def get_results(plots):
+    return {plot["name"]: plot["data"] for plot in plots}
+
+
+# number of significant digits of the numbers in the data tables, so changes below it aren't sent
+TABLE_PRECISION = 6
+
+
+# format a value returned by a plot function for its data table
+def format_value(value):
+    if isinstance(value, float):
+        return "%.*g" % (TABLE_PRECISION, value)
+    return str(value)
+
+
+# format the data returned by a plot function as the cells of its data table indexed by parameter
+def format_table(plot_data):
+    return {str(param): format_value(value) for param, value in plot_data.items()}
+
+
 # create and initialize a plot and associated data table
 def create_plot(obj_response, plot_id, table_id, plot_data, plot_url, routine_name, function_name, plot_list_HTML):
     obj_response.html_append("#plots-container", "<div id='%s' class='plot-container' title='%s (%s)' style='display: none;'></div>" % (plot_id, routine_name, function_name))
@@ -118,8 +309,9 @@ def create_plot(obj_response, plot_id, table_id, plot_data, plot_url, routine_na
     if plot_data:
         caption = "<caption>%s (%s)</caption>" % (routine_name, function_name)
         plot_table_body = ""
-        for param in sorted(plot_data.keys()):
-            plot_table_body += "<tr><th>%s</th><td>%s</td></tr>" % (param, plot_data[param])
+        cells = format_table(plot_data)
+        for param in sorted(cells.keys()):
+            plot_table_body += "<tr data-param='%s'><th>%s</th><td>%s</td></tr>" % (html.escape(param, quote=True), html.escape(param), html.escape(cells[param]))
         plot_table = "<div class='table-container' id='%s' title='%s (%s)' style='display: none;'><table>%s<tbody>%s</tbody></table></div>" % (table_id, routine_name, function_name, caption, plot_table_body)
         obj_response.html_append("#plots-container", plot_table)
         plot_list_HTML += "<li class='plot-list-item invisible' data-id='%s'>%s - table</li>" % (table_id, function_name)
@@ -127,16 +319,24 @@ def create_plot(obj_response, plot_id, table_id, plot_data, plot_url, routine_na
     return plot_list_HTML
 
 
-# update a plot and associated data table
-def update_plot(obj_response, url, plot_id, plot_data, table_id, routine_name, function_name):
-    obj_response.call("update_img", [url, plot_id, "true"])
-    if plot_data:
-        caption = "<caption>%s (%s)</caption>" % (routine_name, function_name)
-        plot_table_body = ""
-        for param in sorted(plot_data.keys()):
-            plot_table_body += "<tr><th>%s</th><td>%s</td></tr>" % (param, plot_data[param])
-        plot_table = "<table>%s<tbody>%s</tbody></table>" % (caption, plot_table_body)
-        obj_response.html("#%s" % table_id, plot_table)
+# get the update of a plot and associated data table with only what changed since the last update in last_sent,
+# or None if nothing changed
+def diff_plot(url, plot_id, plot_data, table_id, last_sent):
+    last_url, last_cells = last_sent.get(plot_id, (None, {}))
+    cells = format_table(plot_data) if plot_data else {}
+    last_sent[plot_id] = (url, cells)
+    update = {}
+    if url != last_url:
+        update["url"] = url
+    # send the cells whose formatted value changed and the parameters that are gone
+    changed = {param: value for param, value in cells.items() if last_cells.get(param) != value}
+    removed = [param for param in last_cells if param not in cells]
+    if changed or removed:
+        update.update(table_id=table_id, changed=changed, removed=removed)
+    if not update:
+        return None
+    update["plot_id"] = plot_id
+    return update
 
 
 # remove all plots and data tables
@@ -144,24 +344,22 @@ def remove_plots(obj_response):
     obj_response.html("#plots-container, #plot-list", "")
 
 
-# initialize all plots and data tables for a routine
-def initialize_routine(obj_response, routine_path, routine, data_dir, initial_shots):
-    if initial_shots:
-        error, plots = generate_plot_urls(routine, routine_path, data_dir, shots_paths=initial_shots)
-    else:
-        error, plots = generate_plot_urls(routine, routine_path, data_dir)
-    if error:
-        return True, plots
+# initialize all plots and data tables for a routine from the given plots, or from a first run of the routine with the
+# results of the routines it depends on
+# returns whether the run failed and the plots, or the error message if it did
+def initialize_routine(obj_response, routine_path, routine, data_dir, initial_shots, plots=None, upstream=None):
+    if plots is None:
+        error, plots = generate_plot_urls(routine, routine_path, data_dir, shots_paths=initial_shots or None, upstream=upstream)
+        if error:
+            return True, plots
     routine_name = routine["name"]
-    plot_ids = []
     plot_list_HTML = "<ul class='plot-list-routine' id='plot-list-%s'>" % routine_name
     plot_list_HTML += "<li class='plot-list-routine-title invisible'><b>%s</b></li>" % routine_name
     for plot in plots:
-        plot_ids.append(plot["plot_id"])
         plot_list_HTML = create_plot(obj_response, plot["plot_id"], plot["table_id"], plot["data"], plot["url"], routine_name, plot["name"], plot_list_HTML)
     plot_list_HTML += "</ul>"
     obj_response.html_append("#plot-list", plot_list_HTML)
-    return False, plot_ids
+    return False, plots
 
 
 # check if a routine has enough settings to be used in analysis
@@ -181,4 +379,13 @@ def get_period(analysis_options):
         period = 1000
     else:
         period = 1 / float(frequency)
-    return period
\ No newline at end of file
+    return period
+
+
+# get the time (in seconds) after which a run of a routine is killed, or None if it can run for as long as it takes
+def get_timeout(routine):
+    try:
+        timeout = float(routine.get("timeout") or 0)
+    except ValueError:
+        return None
+    return timeout if timeout > 0 else None
\ No newline at end of file
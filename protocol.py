@@ -0,0 +1,61 @@
+# import libraries
+import json
+import struct
+
+# every frame starts with this marker followed by the length of the header
+FRAME_MAGIC = b"SNCA"
+FRAME_PREFIX = struct.Struct(">4sI")
+# environment variable holding the file descriptor routines write their frames to
+RESULT_FD_VARIABLE = "SENECA_RESULT_FD"
+# environment variable holding the file descriptor routines read the results of the routines they depend on from
+UPSTREAM_FD_VARIABLE = "SENECA_UPSTREAM_FD"
+
+
+# raised when the result stream is not made of valid frames
+class ProtocolError(Exception):
+    pass
+
+
+# encode a plot as a frame: prefix, json header, raw image bytes and json data
+def encode_frame(name, count, image, data, image_format="png", timings=None):
+    data_bytes = json.dumps(data).encode("utf-8")
+    header = dict(name=name, count=count, format=image_format, image=len(image), data=len(data_bytes), timings=timings or {})
+    header_bytes = json.dumps(header).encode("utf-8")
+    return [FRAME_PREFIX.pack(FRAME_MAGIC, len(header_bytes)), header_bytes, image, data_bytes]
+
+
+# write a plot as a frame to a binary stream
+def write_frame(stream, name, count, image, data, image_format="png", timings=None):
+    for part in encode_frame(name, count, image, data, image_format, timings):
+        stream.write(part)
+    stream.flush()
+
+
+# encode the results of the routines a routine depends on, indexed by routine name and then by plot function name
+def encode_upstream(upstream):
+    return json.dumps(upstream, default=str).encode("utf-8")
+
+
+# read exactly size bytes from a binary stream
+def read_exactly(stream, size):
+    chunk = stream.read(size)
+    if len(chunk) != size:
+        raise ProtocolError("result stream ended in the middle of a frame")
+    return chunk
+
+
+# read plots from a binary stream as they arrive, yielding (name, count, image, data, format, timings) for each frame
+def read_frames(stream):
+    while True:
+        prefix = stream.read(FRAME_PREFIX.size)
+        if not prefix:
+            return
+        if len(prefix) != FRAME_PREFIX.size:
+            raise ProtocolError("result stream ended in the middle of a frame")
+        magic, header_size = FRAME_PREFIX.unpack(prefix)
+        if magic != FRAME_MAGIC:
+            raise ProtocolError("result stream is not made of frames")
+        header = json.loads(read_exactly(stream, header_size).decode("utf-8"))
+        image = read_exactly(stream, header["image"])
+        data = json.loads(read_exactly(stream, header["data"]).decode("utf-8"))
+        yield header["name"], header["count"], image, data, header.get("format", "png"), header.get("timings", {})
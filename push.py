@@ -0,0 +1,255 @@
+# import libraries
+import json
+import time
+import asyncio
+import logging
+import threading
+import collections
+import urllib.parse
+from metrics import dropped_messages
+
+logger = logging.getLogger("push")
+
+# time (in seconds) between two heartbeats on an idle connection, which keep proxies from closing it
+HEARTBEAT_INTERVAL = 15
+# time (in milliseconds) the browser waits before reconnecting
+RETRY_INTERVAL = 2000
+# number of sent messages kept per page so a page that reconnects can resume after the last message it received
+RESUME_MESSAGES = 1000
+# number of messages without a slot waiting to be sent to a page before the oldest are dropped
+MAX_PENDING = 200
+# time (in seconds) after which a page that disconnected is forgotten
+SESSION_EXPIRY = 60
+# maximum size (in bytes) of the request head of a connection
+MAX_REQUEST_SIZE = 16384
+
+
+# merge a message into an older one with the same slot that wasn't sent yet, so the page still ends up with the same state
+def merge_messages(older, newer):
+    if newer["event"] != "plot" or older["event"] != "plot":
+        return newer
+    changed = dict(older["data"].get("changed", {}))
+    removed = set(older["data"].get("removed", []))
+    changed.update(newer["data"].get("changed", {}))
+    removed.difference_update(newer["data"].get("changed", {}))
+    for param in newer["data"].get("removed", []):
+        changed.pop(param, None)
+        removed.add(param)
+    data = dict(older["data"])
+    data.update(newer["data"])
+    data.update(changed=changed, removed=sorted(removed))
+    return dict(newer, data=data)
+
+
+# encode a message as an event of the event stream
+def encode_message(message):
+    data = json.dumps(message["data"], separators=(",", ":"))
+    return ("id: %d\nevent: %s\ndata: %s\n\n" % (message["id"], message["event"], data)).encode("utf-8")
+
+
+# the messages for a single page, kept while the page is disconnected
+# messages with a slot replace the unsent message with the same slot, so a page that can't keep up gets the latest state
+# instead of every intermediate one and the analysis never waits for it
+class PushSession(object):
+
+    def __init__(self, viewer_id):
+        self.viewer_id = viewer_id
+        self.last_id = 0
+        # messages that were queued, for pages resuming after a reconnect
+        self.history = collections.deque(maxlen=RESUME_MESSAGES)
+        # messages waiting to be sent indexed by their slot, or by their id if they have none
+        self.pending = collections.OrderedDict()
+        self.lock = threading.Lock()
+        # set by the server to wake up the connection of the page when a message is queued
+        self.wakeup = None
+        self.connection = None
+        self.last_seen = time.time()
+
+    # queue a message for the page, replacing the unsent message in the same slot
+    def send(self, event, data, slot=None):
+        with self.lock:
+            self.last_id += 1
+            message = dict(id=self.last_id, event=event, data=data, slot=slot)
+            self.history.append(message)
+            self.queue(message)
+            wakeup = self.wakeup
+        if wakeup is not None:
+            wakeup()
+
+    # add a message to the pending messages, holding the lock
+    def queue(self, message):
+        slot = message["slot"]
+        if slot is None:
+            self.pending[("id", message["id"])] = message
+        else:
+            older = self.pending.pop(slot, None)
+            if older is not None:
+                message = merge_messages(older, message)
+                dropped_messages.inc()
+            self.pending[slot] = message
+        # drop the oldest messages without a slot, like status messages, if the page stays behind
+        unslotted = [key for key in self.pending if isinstance(key, tuple) and key[0] == "id"]
+        for key in unslotted[:max(0, len(unslotted) - MAX_PENDING)]:
+            del self.pending[key]
+            dropped_messages.inc()
+
+    # take the messages waiting to be sent
+    def take(self):
+        with self.lock:
+            messages, self.pending = list(self.pending.values()), collections.OrderedDict()
+        return messages
+
+    # prepare the messages of a page reconnecting after the message last_event_id, or return False if they are no longer kept
+    def resume(self, last_event_id):
+        with self.lock:
+            if last_event_id >= self.last_id:
+                self.pending.clear()
+                return True
+            if not self.history or self.history[0]["id"] > last_event_id + 1:
+                self.pending.clear()
+                return False
+            self.pending.clear()
+            for message in self.history:
+                if message["id"] > last_event_id:
+                    self.queue(message)
+            return True
+
+
+# a server pushing the messages of the analysis to the plot pages as server-sent events, running on its own event loop
+# on_expire is called with the id of a page that went away and on_resync with the id of a page that reconnected too late to
+# resume, which must be sent the latest results again
+class PushServer(object):
+
+    def __init__(self, host, port, on_expire=None, on_resync=None):
+        self.host = host
+        self.port = port
+        self.on_expire = on_expire
+        self.on_resync = on_resync
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.loop = None
+        self.thread = None
+        self.started = threading.Event()
+
+    # start serving in a background thread if the server isn't running yet
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self.serve, name="push", daemon=True)
+            self.thread.start()
+        self.started.wait()
+
+    def serve(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            server = self.loop.run_until_complete(asyncio.start_server(self.handle, self.host, self.port))
+        except OSError:
+            logger.exception("can't push updates on %s:%d", self.host, self.port)
+            self.started.set()
+            return
+        # the port may have been chosen by the system
+        self.port = server.sockets[0].getsockname()[1]
+        self.started.set()
+        self.loop.run_forever()
+
+    # get the session of a page, creating it if necessary
+    def get_session(self, viewer_id):
+        with self.lock:
+            session = self.sessions.get(viewer_id)
+            if session is None:
+                session = self.sessions[viewer_id] = PushSession(viewer_id)
+                if self.loop is not None:
+                    self.loop.call_soon_threadsafe(self.schedule_expiry, session)
+            return session
+
+    # forget a page that stayed disconnected for SESSION_EXPIRY seconds
+    def schedule_expiry(self, session):
+        self.loop.call_later(SESSION_EXPIRY, self.expire, session)
+
+    def expire(self, session):
+        if session.connection is not None or time.time() - session.last_seen < SESSION_EXPIRY:
+            if session.connection is None:
+                self.schedule_expiry(session)
+            return
+        with self.lock:
+            if self.sessions.get(session.viewer_id) is session:
+                del self.sessions[session.viewer_id]
+        if self.on_expire is not None:
+            self.loop.run_in_executor(None, self.on_expire, session.viewer_id)
+
+    # serve the event stream of a page
+    async def handle(self, reader, writer):
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            writer.close()
+            return
+        lines = head.decode("latin-1").split("\r\n")
+        try:
+            method, target, version = lines[0].split(" ", 2)
+        except ValueError:
+            method, target = "", ""
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        url = urllib.parse.urlsplit(target)
+        query = urllib.parse.parse_qs(url.query)
+        viewer_id = query.get("viewer", [""])[0]
+        if method != "GET" or url.path != "/events" or not viewer_id or len(head) > MAX_REQUEST_SIZE:
+            writer.write(b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+            await self.close(writer)
+            return
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n"
+                     b"Connection: keep-alive\r\nAccess-Control-Allow-Origin: *\r\n\r\n")
+        writer.write(b"retry: %d\n\n" % RETRY_INTERVAL)
+        await self.stream(self.get_session(viewer_id), headers.get("last-event-id"), writer)
+
+    # send the messages of a session to a connection until the page goes away or another connection takes over
+    async def stream(self, session, last_event_id, writer):
+        wakeup = asyncio.Event()
+        previous = session.connection
+        session.connection = writer
+        session.wakeup = lambda: self.loop.call_soon_threadsafe(wakeup.set)
+        if previous is not None:
+            previous.close()
+        if last_event_id is not None:
+            try:
+                resumed = session.resume(int(last_event_id))
+            except ValueError:
+                resumed = False
+            if not resumed and self.on_resync is not None:
+                # the page missed messages that are no longer kept, so it is sent the latest results instead
+                await self.loop.run_in_executor(None, self.on_resync, session.viewer_id)
+        try:
+            while session.connection is writer:
+                messages = session.take()
+                if messages:
+                    writer.write(b"".join(encode_message(message) for message in messages))
+                else:
+                    try:
+                        await asyncio.wait_for(wakeup.wait(), HEARTBEAT_INTERVAL)
+                        wakeup.clear()
+                        continue
+                    except asyncio.TimeoutError:
+                        writer.write(b": heartbeat\n\n")
+                # wait for slow pages here while new messages pile up in the session and replace stale ones
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            if session.connection is writer:
+                session.connection = None
+                session.wakeup = None
+                session.last_seen = time.time()
+                self.schedule_expiry(session)
+            await self.close(writer)
+
+    async def close(self, writer):
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except ConnectionError:
+            pass
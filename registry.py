@@ -0,0 +1,187 @@
+# import libraries
+import os
+import json
+import atexit
+import threading
+import contextlib
+from statestore import write_atomic
+try:
+    import fcntl
+except ImportError:
+    # file locks are only available on unix, elsewhere only threads of this server are kept from writing at the same time
+    fcntl = None
+
+# time (in seconds) changes are collected before the routine json file is written
+WRITE_DELAY = 0.5
+
+
+# check if a path is a folder or is inside a folder, both given as strings separated by '/'
+def is_inside(path, folder):
+    return path == folder or path.startswith(folder + "/")
+
+
+# the routines, supporting files and folders of the routine json file kept in memory, indexed by name and by folder,
+# together with the folder tree shown on the main page; changes are written back to the file in the background
+class RoutineRegistry(object):
+
+    def __init__(self, json_path, routine_path, write_delay=WRITE_DELAY):
+        self.json_path = json_path
+        self.routine_path = routine_path
+        self.write_delay = write_delay
+        # held by handlers while they read or change the data
+        self.lock = threading.RLock()
+        # keeps writes of the file in the order of the changes
+        self.write_lock = threading.Lock()
+        self.timer = None
+        self.dirty = False
+        with self.file_lock(shared=True):
+            with open(json_path, "r") as file:
+                self.data = json.load(file)
+        self.reindex()
+        atexit.register(self.flush)
+
+    # lock the routine json file against other processes
+    @contextlib.contextmanager
+    def file_lock(self, shared=False):
+        if fcntl is None:
+            yield
+            return
+        with open(self.json_path + ".lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    # build the indexes and the folder tree from the data
+    def reindex(self):
+        self.routines = {routine["name"]: routine for routine in self.data["routines"]}
+        self.supports = {support["name"]: support for support in self.data["support"]}
+        # folder nodes of the tree indexed by their path, with the root at ""
+        self.tree = dict(name="", children=[], path="")
+        self.folders = {"": self.tree}
+        # parents come before their sub-folders, and folders whose parent is missing are left out of the tree like before
+        for path in sorted(self.data["paths"], key=lambda path: path.count("/")):
+            self.insert_folder(path)
+        # files removed from the routine folder behind the server's back aren't shown
+        existing = set(os.listdir(self.routine_path))
+        for routine in self.data["routines"]:
+            if routine["name"] in existing:
+                self.insert_file(routine, True)
+        for support in self.data["support"]:
+            if support["name"] in existing:
+                self.insert_file(support, False)
+
+    # add a folder node to the tree below its parent, after the other folders
+    def insert_folder(self, path):
+        parent = self.folders.get(path.rsplit("/", 1)[0] if "/" in path else "")
+        if parent is None or path in self.folders:
+            return
+        node = dict(name=path.split("/")[-1], children=[], path=path)
+        position = len([child for child in parent["children"] if "children" in child])
+        parent["children"].insert(position, node)
+        self.folders[path] = node
+
+    # add a file to the tree in its folder, routines after the folders and supporting files last
+    def insert_file(self, entry, is_routine):
+        parent = self.folders.get(entry["path"])
+        if parent is None:
+            return
+        leaf = dict(name=entry["name"], path=entry["path"], routine=is_routine)
+        if is_routine:
+            position = len([child for child in parent["children"] if child.get("routine", True)])
+            parent["children"].insert(position, leaf)
+        else:
+            parent["children"].append(leaf)
+
+    # remove a file from the tree
+    def remove_leaf(self, entry):
+        parent = self.folders.get(entry["path"])
+        if parent is not None:
+            parent["children"] = [child for child in parent["children"] if "children" in child or child["name"] != entry["name"]]
+
+    # get the folder tree shown on the main page
+    def get_tree(self):
+        return self.tree
+
+    # get a routine by its name
+    def get_routine(self, name):
+        return self.routines[name]
+
+    # check if a routine or a supporting file has a name
+    def has_routine(self, name):
+        return name in self.routines
+
+    def has_support(self, name):
+        return name in self.supports
+
+    # add a folder given as a path separated by '/'
+    def add_folder(self, path):
+        with self.lock:
+            self.data["paths"].append(path)
+            self.insert_folder(path)
+            self.changed()
+
+    # add a routine or a supporting file
+    def add_file(self, entry, is_routine):
+        with self.lock:
+            if is_routine:
+                self.data["routines"].append(entry)
+                self.routines[entry["name"]] = entry
+            else:
+                self.data["support"].append(entry)
+                self.supports[entry["name"]] = entry
+            self.insert_file(entry, is_routine)
+            self.changed()
+
+    # remove a routine or a supporting file
+    def remove_file(self, name, is_routine):
+        with self.lock:
+            if is_routine:
+                entry = self.routines.pop(name, None)
+                self.data["routines"] = [routine for routine in self.data["routines"] if routine["name"] != name]
+            else:
+                entry = self.supports.pop(name, None)
+                self.data["support"] = [support for support in self.data["support"] if support["name"] != name]
+            if entry is not None:
+                self.remove_leaf(entry)
+            self.changed()
+
+    # remove a folder with its sub-folders and the routines inside them, returning the names of the removed routines
+    def remove_folder(self, path):
+        with self.lock:
+            self.data["paths"] = [folder for folder in self.data["paths"] if not is_inside(folder, path)]
+            removed = [routine["name"] for routine in self.data["routines"] if is_inside(routine["path"], path)]
+            for name in removed:
+                self.routines.pop(name)
+            self.data["routines"] = [routine for routine in self.data["routines"] if not is_inside(routine["path"], path)]
+            for folder in [folder for folder in self.folders if folder and is_inside(folder, path)]:
+                del self.folders[folder]
+            parent = self.folders.get(path.rsplit("/", 1)[0] if "/" in path else "")
+            if parent is not None:
+                parent["children"] = [child for child in parent["children"] if "children" not in child or child["path"] != path]
+            self.changed()
+            return removed
+
+    # remember that the data changed and write it after a short delay, so a burst of changes is written only once
+    def changed(self):
+        with self.lock:
+            self.dirty = True
+            if self.timer is None:
+                self.timer = threading.Timer(self.write_delay, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    # write the data to the routine json file now if it changed
+    def flush(self):
+        with self.write_lock:
+            with self.lock:
+                if self.timer is not None:
+                    self.timer.cancel()
+                    self.timer = None
+                if not self.dirty:
+                    return
+                content = json.dumps(self.data).encode("utf-8")
+                self.dirty = False
+            with self.file_lock():
+                write_atomic(self.json_path, content)
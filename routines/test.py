@@ -1,5 +1,4 @@
 """example analysis script one"""
-import json
 from scipy.optimize import curve_fit
 import matplotlib.pyplot as plt
 import numpy as np
@@ -8,14 +7,10 @@ import sys
 sys.path.append("/Users/zacharyandalman/PycharmProjects/analysis")
 import seneca_analysis
 
-old_data, paths = seneca_analysis.parse_options()
+state, paths = seneca_analysis.load_state()
 
 def read(path):
-    with open(path) as file:
-        data = json.load(file)
-    data['x'] = [float(x) for x in data['x']]
-    data['y'] = [float(y) for y in data['y']]
-    return data
+    return seneca_analysis.load_shared_shot(path)
 
 def line(x, a, b):
     return a * x + b
@@ -23,10 +18,10 @@ def line(x, a, b):
 def expon(x, a, b):
     return a * b ** x
 
-def update_data(old_data, new_data):
-    old_data['x'] += new_data['x']
-    old_data['y'] += new_data['y']
-    return old_data
+def update_data(state, new_data):
+    state.append('x', new_data['x'])
+    state.append('y', new_data['y'])
+    return state
 
 @seneca_analysis.plot
 def linear_fit(x, y):
@@ -57,10 +52,14 @@ def hist(x, y):
     axs[0].hist(x, bins=20)
     axs[1].hist(y, bins=20)
 
-if __name__ == "__main__":
+def analyse(paths, state):
     data = read(paths[0])
-    full_data = update_data(old_data, data)
+    full_data = update_data(state, data)
     linear_fit(data["x"], data["y"])
     exponential_fit(data["x"], data["y"])
     hist(full_data["x"], full_data["y"])
+    return full_data
+
+if __name__ == "__main__":
+    full_data = analyse(paths, state)
     seneca_analysis.write_data(full_data)
\ No newline at end of file
@@ -0,0 +1,103 @@
+# import libraries
+import os
+import hashlib
+import threading
+from statestore import has_store, get_header_path
+from protocol import encode_upstream
+
+
+# get the version of a file as (size, modification time in nanoseconds), or None if it doesn't exist
+def get_file_version(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_size, stat.st_mtime_ns)
+
+
+# get the version of the state of a read-write file, which changes with every commit once it was migrated to a state store
+# and when the file is edited, which replaces the state
+def get_state_version(data_path):
+    if has_store(data_path):
+        return get_file_version(get_header_path(data_path)), get_file_version(data_path)
+    return get_file_version(data_path)
+
+
+# content hashes of routine files indexed by path, together with the file version they were computed for
+file_hashes = {}
+
+
+# get the hash of the content of a file, only reading it again after it changed
+def get_file_hash(path):
+    version = get_file_version(path)
+    cached = file_hashes.get(path)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    with open(path, "rb") as file:
+        digest = hashlib.sha1(file.read()).hexdigest()
+    file_hashes[path] = (version, digest)
+    return digest
+
+
+# get the versions of the python files next to a routine, which it can import as support modules, as ((name, version), ...)
+def get_support_versions(path_to_routine):
+    directory = os.path.dirname(os.path.abspath(path_to_routine))
+    routine_name = os.path.basename(path_to_routine)
+    try:
+        names = sorted(name for name in os.listdir(directory) if name.endswith(".py") and name != routine_name)
+    except OSError:
+        return ()
+    return tuple((name, get_file_version(os.path.join(directory, name))) for name in names)
+
+
+# the inputs of a run: the routine's content, the selected shots with their versions, the version of the read-write file,
+# the results of the routines it depends on and the versions of the support files it can import
+def make_run_key(path_to_routine, shots_paths, data_path, upstream=None):
+    shots = tuple((path, get_file_version(path)) for path in shots_paths)
+    state_version = get_state_version(data_path) if data_path else None
+    upstream_hash = hashlib.sha1(encode_upstream(upstream)).hexdigest() if upstream else None
+    return (get_file_hash(path_to_routine), shots, state_version, upstream_hash, get_support_versions(path_to_routine))
+
+
+# the plots of the last run of each routine indexed by the inputs of that run
+class RunCache(object):
+
+    def __init__(self):
+        self.entries = {}
+        self.hits = {}
+        self.misses = {}
+        self.lock = threading.Lock()
+
+    # get the plots of the last run of a routine if its inputs haven't changed, or None otherwise
+    def lookup(self, routine_name, key):
+        with self.lock:
+            entry = self.entries.get(routine_name)
+            if entry is not None and entry[0] == key:
+                self.hits[routine_name] = self.hits.get(routine_name, 0) + 1
+                return entry[1]
+            self.misses[routine_name] = self.misses.get(routine_name, 0) + 1
+            return None
+
+    # remember the plots of a run
+    def store(self, routine_name, key, plots):
+        with self.lock:
+            self.entries[routine_name] = (key, plots)
+
+    # forget the last run of a routine
+    def discard(self, routine_name):
+        with self.lock:
+            self.entries.pop(routine_name, None)
+
+    # get the number of hits and misses and the hit rate of a routine, or of all routines if routine_name is None
+    def get_stats(self, routine_name=None):
+        with self.lock:
+            if routine_name is None:
+                hits, misses = sum(self.hits.values()), sum(self.misses.values())
+            else:
+                hits, misses = self.hits.get(routine_name, 0), self.misses.get(routine_name, 0)
+        rate = hits / (hits + misses) if hits + misses else 0
+        return hits, misses, rate
+
+
+# cached runs shared by all viewers
+run_cache = RunCache()
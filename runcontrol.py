@@ -0,0 +1,148 @@
+# import libraries
+import os
+import signal
+import threading
+import contextlib
+
+# reasons a run was stopped before it finished
+TIMED_OUT = "timeout"
+CANCELLED = "cancelled"
+# the period of a routine is doubled for each consecutive timeout, up to 2 ** MAX_BACKOFF_EXPONENT times the period
+MAX_BACKOFF_EXPONENT = 4
+
+
+# raised when a run is stopped because the analysis was stopped or paused
+class RunCancelled(Exception):
+    pass
+
+
+# raised when a run is stopped because it took longer than the timeout of its routine
+class RunTimeout(RunCancelled):
+    pass
+
+
+# kill a process together with the processes it started, which share its process group if it was started in a new session
+def kill_process_group(process):
+    try:
+        if hasattr(os, "killpg"):
+            os.killpg(process.pid, signal.SIGKILL)
+        else:
+            process.kill()
+    except OSError:
+        pass
+
+
+# a single run of a routine, which can be cancelled from another thread or by a timer after timeout seconds
+# the runners register how to kill what they started while they run, so cancelling takes effect right away
+# while it runs, the run is part of runs (all runs in progress by default), which can cancel it together with the others
+class RunControl(object):
+
+    def __init__(self, name, timeout=None, runs=None):
+        self.name = name
+        self.timeout = timeout
+        self.runs = active_runs if runs is None else runs
+        # None while the run may continue, TIMED_OUT or CANCELLED once it was stopped
+        self.reason = None
+        self.killers = []
+        self.lock = threading.Lock()
+        self.timer = None
+
+    def __enter__(self):
+        if self.timeout:
+            self.timer = threading.Timer(self.timeout, self.cancel, [TIMED_OUT])
+            self.timer.daemon = True
+            self.timer.start()
+        self.runs.add(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.timer is not None:
+            self.timer.cancel()
+        self.runs.discard(self)
+
+    # call kill if the run is cancelled while inside the block, or right away if it already was
+    @contextlib.contextmanager
+    def killing(self, kill):
+        with self.lock:
+            cancelled = self.reason is not None
+            if not cancelled:
+                self.killers.append(kill)
+        if cancelled:
+            kill()
+        try:
+            yield
+        finally:
+            with self.lock:
+                if kill in self.killers:
+                    self.killers.remove(kill)
+
+    # stop the run, killing whatever it is running
+    def cancel(self, reason=CANCELLED):
+        with self.lock:
+            if self.reason is not None:
+                return
+            self.reason = reason
+            killers, self.killers = self.killers, []
+        for kill in killers:
+            kill()
+
+    # raise the reason the run was stopped, if it was
+    def check(self):
+        if self.reason == TIMED_OUT:
+            raise RunTimeout("'%s' was stopped after running for longer than its timeout of %g seconds" % (self.name, self.timeout))
+        elif self.reason is not None:
+            raise RunCancelled("'%s' was stopped because the analysis stopped" % self.name)
+
+
+# a set of runs in progress, so stopping an analysis can cancel them
+class ActiveRuns(object):
+
+    def __init__(self):
+        self.runs = set()
+        self.lock = threading.Lock()
+
+    def add(self, control):
+        with self.lock:
+            self.runs.add(control)
+
+    def discard(self, control):
+        with self.lock:
+            self.runs.discard(control)
+
+    # cancel every run in progress
+    def cancel_all(self):
+        with self.lock:
+            runs = list(self.runs)
+        for control in runs:
+            control.cancel()
+
+
+# the number of consecutive timeouts of every routine, which stretches the time until its next run
+class TimeoutRecord(object):
+
+    def __init__(self):
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    # remember that a run of a routine timed out
+    def record(self, name):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    # forget the timeouts of a routine once it finishes in time
+    def clear(self, name):
+        with self.lock:
+            self.counts.pop(name, None)
+
+    # get the number of consecutive timeouts of a routine
+    def get_count(self, name):
+        with self.lock:
+            return self.counts.get(name, 0)
+
+    # get the factor the period of a routine is multiplied by
+    def get_backoff(self, name):
+        return 2 ** min(self.get_count(name), MAX_BACKOFF_EXPONENT)
+
+
+active_runs = ActiveRuns()
+run_timeouts = TimeoutRecord()
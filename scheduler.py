@@ -0,0 +1,139 @@
+# import libraries
+import time
+import heapq
+import logging
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+
+logger = logging.getLogger("scheduler")
+
+
+# a function that the scheduler runs periodically
+class Job(object):
+
+    def __init__(self, name, period, function, callback, priority=0, deadline=None):
+        self.name = name
+        self.period = period
+        self.function = function
+        self.callback = callback
+        self.priority = priority
+        self.deadline = time.time() if deadline is None else deadline
+        self.active = True
+        self.runs = 0
+        # number of ticks skipped since the job was last run
+        self.missed = 0
+
+
+# runs all periodic jobs on a bounded pool of threads, the due jobs with the highest priority first
+# backoff gets the name of a job and returns the factor its period is stretched by, for example after its runs timed out
+class Scheduler(object):
+
+    def __init__(self, max_workers, backoff=None):
+        self.max_workers = max_workers
+        self.backoff = backoff
+        self.executor = ThreadPoolExecutor(max_workers)
+        # jobs waiting for their next tick as a heap of (deadline, count, job), and due jobs waiting for a free thread as a
+        # heap of (-priority, deadline, count, job)
+        self.timers = []
+        self.ready = []
+        self.num_running = 0
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.thread = None
+
+    # run function every period seconds, passing its result and the number of missed ticks to callback
+    def add(self, name, period, function, callback, priority=0, delay=0):
+        job = Job(name, period, function, callback, priority, time.time() + delay)
+        with self.condition:
+            self.push_timer(job)
+            self.start()
+            self.condition.notify()
+        return job
+
+    # run function once on the pool alongside the periodic jobs and return a future for its result
+    def submit(self, name, function, priority=0):
+        future = Future()
+        job = Job(name, None, function, lambda result, missed: future.set_result(result), priority)
+        with self.condition:
+            self.push_ready(job)
+            self.start()
+            self.condition.notify()
+        return future
+
+    # start the thread that dispatches the jobs if it isn't running yet
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.loop, name="scheduler", daemon=True)
+            self.thread.start()
+
+    # stop running a job, letting a run that already started finish
+    def remove(self, job):
+        with self.condition:
+            job.active = False
+            self.condition.notify()
+
+    # add a job to the jobs waiting for their next tick, ordered by deadline
+    def push_timer(self, job):
+        heapq.heappush(self.timers, (job.deadline, next(self.counter), job))
+
+    # add a due job to the jobs waiting for a free thread, ordered by priority and then by deadline, since all of them are due
+    def push_ready(self, job):
+        heapq.heappush(self.ready, (-job.priority, job.deadline, next(self.counter), job))
+
+    # move due jobs to the ready queue and start as many as there are free threads
+    def loop(self):
+        with self.condition:
+            while True:
+                now = time.time()
+                while self.timers and self.timers[0][0] <= now:
+                    job = heapq.heappop(self.timers)[-1]
+                    if job.active:
+                        self.push_ready(job)
+                while self.ready and self.num_running < self.max_workers:
+                    job = heapq.heappop(self.ready)[-1]
+                    if job.active:
+                        self.num_running += 1
+                        self.executor.submit(self.execute, job)
+                timeout = self.timers[0][0] - now if self.timers else None
+                self.condition.wait(timeout)
+
+    # run a job once and schedule its next tick
+    def execute(self, job):
+        result = None
+        try:
+            result = job.function()
+        except Exception:
+            logger.exception("job '%s' failed", job.name)
+        if job.period is None:
+            # jobs that only run once are done
+            with self.condition:
+                self.num_running -= 1
+                self.condition.notify()
+            job.callback(result, 0)
+            return
+        with self.condition:
+            self.num_running -= 1
+            job.runs += 1
+            now = time.time()
+            job.deadline += job.period * (self.backoff(job.name) if self.backoff else 1)
+            # coalesce the ticks that passed while the job was waiting or running into a single run right away
+            if job.deadline < now:
+                missed = int((now - job.deadline) // job.period) + 1
+                job.missed += missed
+                job.deadline = now
+            missed, job.missed = job.missed, 0
+            self.condition.notify()
+        if not job.active:
+            return
+        job.callback(result, missed)
+        # only schedule the next tick once the result was handed over, so results arrive in order
+        with self.condition:
+            if job.active:
+                self.push_timer(job)
+                self.condition.notify()
+
+    # get the number of jobs waiting for a free thread
+    def get_backlog(self):
+        with self.condition:
+            return len(self.ready)
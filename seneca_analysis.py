@@ -5,74 +5,269 @@ import getopt
 import json
 import matplotlib.pyplot as plt
 from io import BytesIO
-import base64
-import inspect
 import os
 import contextlib
+import time
+from protocol import write_frame, RESULT_FD_VARIABLE, UPSTREAM_FD_VARIABLE
+from statestore import StateStore, has_store, write_atomic
+# routines load their shots with load_shot, and can register loaders for other formats with register_loader
+from shotloaders import register_loader, load_shot, load_shots
+from shotcache import shot_cache
+# routines can decimate long lines to what can be seen of them, which the plot decorator does for the lines of a figure
+from decimation import lttb, minmax, decimate, decimate_lines, restore_lines, DECIMATION_METHODS
 
 
-# context manager to prevent standard output
+# receives the plots when a routine runs inside the server or a worker instead of in its own process
+_plot_handler = None
+# binary stream the plots are written to when the routine runs in its own process
+_result_stream = None
+# persistent figures and artists of plot functions indexed by (file name, function name), kept between runs in warm workers
+_plot_states = {}
+# state of the persistent plot function that is currently running
+_current_state = None
+# results of the routines the running routine depends on, given by the server or the worker running it
+_upstream = None
+
+
+# context manager to send plots to a handler instead of the result stream
+@contextlib.contextmanager
+def plot_handler(handler):
+    global _plot_handler
+    save_handler = _plot_handler
+    _plot_handler = handler
+    try:
+        yield
+    finally:
+        _plot_handler = save_handler
+
+
+# context manager to give the running routine the results of the routines it depends on
 @contextlib.contextmanager
-def no_stdout():
-    save_stdout = sys.stdout
-    sys.stdout = BytesIO()
-    yield
-    sys.stdout = save_stdout
+def upstream_results(results):
+    global _upstream
+    save_upstream = _upstream
+    _upstream = results
+    try:
+        yield
+    finally:
+        _upstream = save_upstream
+
+
+# get the results of the routines this routine depends on as {routine name: {plot function name: data}}, where data is the
+# dictionary returned by the last call of the plot function, or an empty dictionary if the routine doesn't depend on others
+def get_upstream():
+    global _upstream
+    if _upstream is None:
+        if os.environ.get(UPSTREAM_FD_VARIABLE):
+            with os.fdopen(int(os.environ[UPSTREAM_FD_VARIABLE]), "rb") as stream:
+                _upstream = json.loads(stream.read().decode("utf-8") or "{}")
+        else:
+            _upstream = {}
+    return _upstream
+
+
+# reset the plot counters of all plot functions in a routine module
+def reset_counters(module):
+    for name in dir(module):
+        function = getattr(module, name)
+        if callable(function) and hasattr(function, "plot"):
+            function.counter = 0
+
+
+# get the stream for plots, which is the file descriptor given by the server or standard output otherwise
+def get_result_stream():
+    global _result_stream
+    if _result_stream is None:
+        if os.environ.get(RESULT_FD_VARIABLE):
+            _result_stream = os.fdopen(int(os.environ[RESULT_FD_VARIABLE]), "wb")
+        else:
+            _result_stream = sys.stdout.buffer
+    return _result_stream
+
+
+# send a plot and its data to the server, with the time (in seconds) it took to 'draw' and 'render' it
+def send_plot(name, count, image, data, image_format="png", timings=None):
+    if _plot_handler is not None:
+        _plot_handler(name, count, image, data, image_format, timings or {})
+    else:
+        write_frame(get_result_stream(), name, count, image, data, image_format, timings)
+
+
+# get the path to the read-write file given with the -d option and the paths to the current measurement files
+def get_arguments():
+    opts = getopt.getopt(sys.argv[1:], "d:")
+    data_path = opts[0][0][1] if opts[0] else None
+    return data_path, opts[1]
 
 
 # parse the options and arguments into a dictionary with data from previous measurements and the paths to the current measurement files
 def parse_options():
     if sys.argv:
-        options = sys.argv[1:]
-        opts = getopt.getopt(options, "d:")
+        data_path, paths = get_arguments()
         data = None
         # check if -d option exists
-        if len(opts[0]) > 0:
-            data_path = opts[0][0][1]
-            with open(data_path, "r") as file:
-                data = json.load(file)
-        paths = opts[1]
+        if data_path:
+            if has_store(data_path):
+                data = StateStore(data_path).to_dict()
+            else:
+                with open(data_path, "r") as file:
+                    data = json.load(file)
         return data, paths
     else:
         return None, None
 
 
-# write data to the designated read-write file
-def write_data(data):
+# parse the options and arguments into the state kept from previous measurements (or None without the -d option) and the paths to the
+# current measurement files, only reading the parts of the state that are used instead of the whole read-write file
+def load_state():
     if sys.argv:
-        options = sys.argv[1:]
-        opts = getopt.getopt(options, "d:")
+        data_path, paths = get_arguments()
+        return (StateStore(data_path) if data_path else None), paths
+    else:
+        return None, None
+
+
+# load a shot as read-only arrays shared with the other routines on the host, so a shot analysed by several routines is
+# only read and decoded once
+def load_shared_shot(path):
+    return shot_cache.load(path)
+
+
+# write data to the designated read-write file, or commit the changes to the state loaded with load_state
+def write_data(data):
+    if isinstance(data, StateStore):
+        data.commit()
+    elif sys.argv:
+        data_path = get_arguments()[0]
         # check if -d option exists
-        if len(opts[0]) > 0:
-            data_path = opts[0][0][1]
-            with open(data_path, "w") as file:
-                json.dump(data, file)
+        if data_path:
+            if has_store(data_path):
+                state = StateStore(data_path)
+                state.replace(data)
+                state.commit()
+            else:
+                write_atomic(data_path, json.dumps(data).encode("utf-8"))
+
+# image formats a plot can be encoded in
+IMAGE_FORMATS = ["png", "jpeg", "webp", "svg"]
+
+
+# the persistent figure of a plot function and the artists it created
+class PlotState(object):
+
+    def __init__(self, figure):
+        self.figure = figure
+        # artists (e.g. lines returned by plt.plot) stored by the plot function to update them with set_data
+        self.artists = {}
+        self.calls = 0
+
+    # check if this is the first call drawing into the figure, so the artists still have to be created
+    @property
+    def first(self):
+        return self.calls == 1
+
+
+# get the state of the persistent plot function that is currently running
+def current_plot():
+    return _current_state
+
+
+# get the numbers of the persistent figures of plot functions
+def get_persistent_figures():
+    return [state.figure.number for state in _plot_states.values()]
+
+
+# close all figures except the persistent figures of plot functions
+def close_figures():
+    persistent = get_persistent_figures()
+    for number in plt.get_fignums():
+        if number not in persistent:
+            plt.close(number)
+
+
+# encode a figure as an image
+def encode_figure(figure, image_format="png", dpi=None, compression=None, quality=None):
+    img = BytesIO()
+    if image_format == "svg":
+        figure.savefig(img, format="svg")
+    elif image_format == "png" and compression is None:
+        figure.savefig(img, format="png", dpi=dpi)
+    else:
+        # render the raw pixels once and encode them with the chosen compression
+        from PIL import Image
+        figure.savefig(img, format="raw", dpi=dpi)
+        width, height = figure.get_size_inches() * (dpi or figure.dpi)
+        pixels = Image.frombuffer("RGBA", (int(width), int(height)), img.getvalue(), "raw", "RGBA", 0, 1)
+        img = BytesIO()
+        if image_format == "png":
+            pixels.save(img, format="PNG", compress_level=compression)
+        else:
+            options = {} if quality is None else dict(quality=quality)
+            pixels.convert("RGB").save(img, format=image_format.upper(), **options)
+    return img.getvalue()
+
+
+# decorator for plot functions, used as @plot or with options as @plot(persistent=True, dpi=50, image_format="jpeg")
+# persistent: keep one figure per plot function between calls so it can update its artists instead of redrawing
+# dpi, figsize: resolution and size (in inches) of the image
+# image_format: one of IMAGE_FORMATS, with compression (0-9) for png and quality (1-100) for jpeg and webp
+# decimation: one of DECIMATION_METHODS used to draw only what can be seen of lines with many more points than pixels,
+# or None to draw every point
+def plot(func=None, persistent=False, dpi=None, figsize=None, image_format="png", compression=None, quality=None, decimation="minmax"):
+    if func is None:
+        return lambda func: plot(func, persistent, dpi, figsize, image_format, compression, quality, decimation)
+    if image_format == "jpg":
+        image_format = "jpeg"
+    if image_format not in IMAGE_FORMATS:
+        raise ValueError("'%s' is not one of the image formats %s" % (image_format, IMAGE_FORMATS))
+    if decimation is not None and decimation not in DECIMATION_METHODS:
+        raise ValueError("'%s' is not one of the decimation methods %s" % (decimation, DECIMATION_METHODS))
+    # annotate plots with the routine name and function name, found once when the function is decorated
+    filename = os.path.basename(func.__code__.co_filename)
+    label = "%s (%s)" % (filename, func.__name__)
+    key = (func.__code__.co_filename, func.__name__)
 
-def plot(func):
     def plot_wrapper(*args, **kwargs):
+        global _current_state
         plot_wrapper.counter += 1
-        # clear plot
-        plt.clf()
-        with no_stdout():
-            # run plot function
+        if persistent:
+            # draw into the function's own figure, creating it on the first call
+            state = _plot_states.get(key)
+            if state is None or not plt.fignum_exists(state.figure.number):
+                state = _plot_states[key] = PlotState(plt.figure(figsize=figsize))
+                plt.annotate(label, xy=(0, 0), xycoords='figure fraction')
+            plt.figure(state.figure.number)
+            state.calls += 1
+        else:
+            state = None
+            # never clear a persistent figure
+            if plt.get_fignums() and plt.gcf().number in get_persistent_figures():
+                plt.figure()
+            # clear plot
+            plt.clf()
+        # run plot function
+        _current_state = state
+        start = time.perf_counter()
+        try:
             data = func(*args, **kwargs)
-        # annotate plot with routine name and function name
-        frame = inspect.stack()[1]
-        filename = os.path.basename(frame[0].f_code.co_filename)
-        plt.annotate("%s (%s)" % (filename, func.__name__), xy=(0, 0), xycoords='figure fraction')
-        # if function output is dictionary, encode it as a json string
+        finally:
+            _current_state = None
+        drawn = time.perf_counter()
+        figure = plt.gcf()
+        if not persistent:
+            plt.annotate(label, xy=(0, 0), xycoords='figure fraction')
+            if figsize:
+                figure.set_size_inches(figsize)
+        decimated = decimate_lines(figure, decimation, dpi) if decimation else []
+        try:
+            img = encode_figure(figure, image_format, dpi, compression, quality)
+        finally:
+            restore_lines(decimated)
+        timings = dict(draw=drawn - start, render=time.perf_counter() - drawn)
+        # only dictionaries are shown as data tables
         if type(data) != dict:
-            data = '{}'
-        else:
-            data = json.dumps(data)
-        # encode plot in base64
-        img = BytesIO()
-        plt.savefig(img)
-        img.seek(0)
-        plot_url = base64.b64encode(img.getvalue()).decode()
-        # write information to standard output
-        output_info = "@@@%s@@@%s@@@%s@@@%s" % (func.__name__, plot_wrapper.counter, plot_url, data)
-        sys.stdout.write(output_info)
+            data = {}
+        send_plot(func.__name__, plot_wrapper.counter, img, data, image_format, timings)
     # set plot_wrapper attribute to display function information in GUI
     plot_wrapper.plot = True
     plot_wrapper.counter = 0
@@ -0,0 +1,330 @@
+# import libraries
+import os
+import json
+import time
+import struct
+import hashlib
+import tempfile
+import threading
+import contextlib
+import collections
+import numpy as np
+from shotloaders import load_shot
+from statestore import write_atomic
+# the cache needs shared memory (python 3.8) and file locks, without them shots are loaded by every routine
+try:
+    import fcntl
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:
+    shared_memory = None
+
+# environment variable giving the number of bytes of decoded shots kept in shared memory for all routines on the host
+BUDGET_VARIABLE = "SENECA_SHOT_CACHE_BYTES"
+DEFAULT_BUDGET = 512 * 1024 ** 2
+# directory holding the index of the cached shots and the lock guarding it, shared by the processes of a user
+CACHE_DIR = os.path.join(tempfile.gettempdir(), "seneca-shot-cache-%s" % (os.getuid() if hasattr(os, "getuid") else "user"))
+INDEX_NAME = "index.json"
+LOCK_NAME = "index.lock"
+# shared memory segments are named after a hash of the shot, short enough for the 31 characters allowed on macOS
+SEGMENT_PREFIX = "seneca-"
+# a segment starts with MAGIC, a byte set to 1 once the arrays were written and the length of a json header describing the arrays
+SEGMENT_HEADER = struct.Struct("<7sBI")
+MAGIC = b"SENECA1"
+# the arrays of a segment start at multiples of this many bytes
+ALIGNMENT = 64
+# minimum time (in seconds) between two updates of the last use of a segment by the same process
+TOUCH_INTERVAL = 1
+# time (in seconds) between two checks of a shot being loaded by another process, and the longest time to wait for it
+WAIT_INTERVAL = 0.01
+LOAD_TIMEOUT = 60
+
+
+# get the number of bytes of decoded shots kept in shared memory
+def get_budget():
+    try:
+        return int(os.environ.get(BUDGET_VARIABLE, DEFAULT_BUDGET))
+    except ValueError:
+        return DEFAULT_BUDGET
+
+
+# get the name of the segment holding a version of a shot
+def get_segment_name(path, info):
+    content = json.dumps([os.path.realpath(path), info.st_size, info.st_mtime_ns, CACHE_DIR])
+    return SEGMENT_PREFIX + hashlib.sha1(content.encode("utf-8")).hexdigest()[:20]
+
+
+# open a segment that outlives this process, so the resource tracker must not unlink it when the process exits
+def open_segment(name, create=False, size=0):
+    try:
+        return shared_memory.SharedMemory(name, create, size, track=False)
+    except TypeError:
+        # python before 3.13 always tracks segments
+        segment = shared_memory.SharedMemory(name, create, size)
+        resource_tracker.unregister(segment._name, "shared_memory")
+        return segment
+
+
+# remove a segment, which stays readable by the processes that have it open
+def unlink_segment(name):
+    try:
+        # opened with tracking, which unlinking removes again
+        segment = shared_memory.SharedMemory(name)
+    except FileNotFoundError:
+        return
+    segment.close()
+    segment.unlink()
+
+
+# check if the process loading a shot is still running
+def is_loading(entry):
+    if "pid" not in entry:
+        return False
+    try:
+        os.kill(entry["pid"], 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+# get the arrays of decoded shot data as (kind, [(key, array)]), or None if it isn't a dictionary of arrays or an array,
+# or if all its arrays are memory maps that are already shared through the page cache
+def get_arrays(data):
+    if isinstance(data, np.ndarray):
+        kind, items = "array", [("", data)]
+    elif isinstance(data, dict) and data and all(isinstance(key, str) and isinstance(value, np.ndarray) for key, value in data.items()):
+        kind, items = "dict", list(data.items())
+    else:
+        return None
+    if any(array.dtype.hasobject for key, array in items) or all(isinstance(array, np.memmap) for key, array in items):
+        return None
+    return kind, items
+
+
+# get the json header of a segment holding arrays and the size of the segment
+def make_layout(kind, items):
+    entries = []
+    offset = 0
+    for key, array in items:
+        entries.append([key, np.lib.format.dtype_to_descr(array.dtype), list(array.shape), offset])
+        offset += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+    header = json.dumps(dict(kind=kind, arrays=entries)).encode("utf-8")
+    start = -(-(SEGMENT_HEADER.size + len(header)) // ALIGNMENT) * ALIGNMENT
+    return header, start, start + max(offset, ALIGNMENT)
+
+
+# write arrays to a segment, marking it as written last so other processes never read it half written
+def write_segment(segment, header, start, items):
+    segment.buf[SEGMENT_HEADER.size:SEGMENT_HEADER.size + len(header)] = header
+    for (key, array), entry in zip(items, json.loads(header)["arrays"]):
+        view = np.ndarray(array.shape, array.dtype, buffer=segment.buf, offset=start + entry[3])
+        view[...] = array
+        del view
+    segment.buf[:SEGMENT_HEADER.size] = SEGMENT_HEADER.pack(MAGIC, 1, len(header))
+
+
+# read the arrays of a segment as read-only views, or return None if it isn't written yet
+def read_segment(segment):
+    if len(segment.buf) < SEGMENT_HEADER.size:
+        return None
+    magic, written, header_length = SEGMENT_HEADER.unpack_from(segment.buf)
+    if magic != MAGIC or not written:
+        return None
+    header = json.loads(bytes(segment.buf[SEGMENT_HEADER.size:SEGMENT_HEADER.size + header_length]))
+    start = -(-(SEGMENT_HEADER.size + header_length) // ALIGNMENT) * ALIGNMENT
+    arrays = {}
+    for key, descr, shape, offset in header["arrays"]:
+        array = np.ndarray(tuple(shape), np.lib.format.descr_to_dtype(descr), buffer=segment.buf, offset=start + offset)
+        array.flags.writeable = False
+        arrays[key] = array
+    return arrays[""] if header["kind"] == "array" else arrays
+
+
+# decoded shots kept in shared memory for all routines on the host, so each version of a shot is decoded once however
+# many routines analyse it
+# a json index guarded by a file lock records the size and last use of every segment, and the least recently used
+# segments are removed when the budget would be exceeded
+class SharedShotCache(object):
+
+    def __init__(self):
+        # segments this process has open indexed by name as (segment, size), in the order they were last used
+        self.segments = collections.OrderedDict()
+        self.open_bytes = 0
+        # segments that couldn't be closed yet because arrays of them are still in use
+        self.closing = []
+        # time this process last updated the last use of each segment
+        self.touched = {}
+        self.lock = threading.RLock()
+
+    # read and update the index of the cached shots while holding the lock of all processes
+    @contextlib.contextmanager
+    def index(self):
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        index_path = os.path.join(CACHE_DIR, INDEX_NAME)
+        with open(os.path.join(CACHE_DIR, LOCK_NAME), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                with open(index_path) as file:
+                    content = file.read()
+                entries = json.loads(content)
+            except (OSError, ValueError):
+                content, entries = "", {}
+            yield entries
+            new_content = json.dumps(entries)
+            if new_content != content:
+                write_atomic(index_path, new_content.encode("utf-8"))
+
+    # load a shot, as read-only arrays shared with the other routines if it can be cached
+    # only one process decodes a shot while the others wait for it to be written
+    def load(self, path):
+        budget = get_budget()
+        if shared_memory is None or budget <= 0:
+            return load_shot(path)
+        try:
+            info = os.stat(path)
+        except OSError:
+            return load_shot(path)
+        name = get_segment_name(path, info)
+        with self.lock:
+            data = self.attach(name)
+            if data is not None:
+                self.touch(name)
+                return data
+        if not self.claim(name, path):
+            data = self.wait(name)
+            # decode the shot without caching it if the other process gave up
+            return data if data is not None else load_shot(path)
+        try:
+            data = load_shot(path)
+            arrays = get_arrays(data)
+            if arrays is None:
+                self.discard(name)
+                return data
+            header, start, size = make_layout(*arrays)
+            if size > budget:
+                self.discard(name)
+                return data
+            with self.lock:
+                segment = self.create(name, size, budget)
+                write_segment(segment, header, start, arrays[1])
+                self.keep(name, segment, size, budget)
+                self.finish(name)
+                return read_segment(segment)
+        except BaseException:
+            self.discard(name)
+            raise
+
+    # get the arrays of a shot from its segment, or None if it isn't cached
+    def attach(self, name):
+        if name in self.segments:
+            self.segments.move_to_end(name)
+            return read_segment(self.segments[name][0])
+        try:
+            segment = open_segment(name)
+        except (FileNotFoundError, ValueError):
+            return None
+        data = read_segment(segment)
+        if data is None:
+            segment.close()
+            return None
+        self.keep(name, segment, segment.size, get_budget())
+        return data
+
+    # remember the last use of a segment, at most every TOUCH_INTERVAL
+    def touch(self, name):
+        now = time.time()
+        if now - self.touched.get(name, 0) < TOUCH_INTERVAL:
+            return
+        self.touched[name] = now
+        with self.index() as entries:
+            if name in entries:
+                entries[name]["used"] = now
+
+    # claim the loading of a shot, or return False if another process is loading it
+    # the entry of a shot records the process loading it until its segment is written
+    def claim(self, name, path):
+        with self.index() as entries:
+            entry = entries.get(name)
+            if entry is not None and is_loading(entry):
+                return False
+            # the segment of an entry that isn't loading was removed, for example by a restart of the host
+            entries[name] = dict(size=0, used=time.time(), path=path, pid=os.getpid())
+        return True
+
+    # wait for another process to write the segment of a shot and get its arrays, or return None if it stopped loading it
+    def wait(self, name):
+        deadline = time.time() + LOAD_TIMEOUT
+        while time.time() < deadline:
+            time.sleep(WAIT_INTERVAL)
+            with self.lock:
+                data = self.attach(name)
+            if data is not None:
+                return data
+            with self.index() as entries:
+                if name not in entries or not is_loading(entries[name]):
+                    return None
+        return None
+
+    # create the segment of a claimed shot, removing the least recently used segments to stay within the budget
+    def create(self, name, size, budget):
+        with self.index() as entries:
+            total = sum(entry["size"] for entry in entries.values())
+            for old_name in sorted(entries, key=lambda old_name: entries[old_name]["used"]):
+                if total + size <= budget:
+                    break
+                if old_name == name or is_loading(entries[old_name]):
+                    continue
+                unlink_segment(old_name)
+                total -= entries.pop(old_name)["size"]
+            try:
+                segment = open_segment(name, create=True, size=size)
+            except FileExistsError:
+                # left behind without an entry, for example by a process killed while writing it
+                unlink_segment(name)
+                segment = open_segment(name, create=True, size=size)
+            entries.setdefault(name, dict(used=time.time(), pid=os.getpid())).update(size=size)
+        return segment
+
+    # mark the segment of a shot as written, so other processes stop waiting for it
+    def finish(self, name):
+        with self.index() as entries:
+            if name in entries:
+                entries[name].pop("pid", None)
+
+    # give up the loading of a shot, removing its segment if it was created
+    def discard(self, name):
+        with self.lock:
+            if name in self.segments:
+                segment, size = self.segments.pop(name)
+                self.open_bytes -= size
+                self.closing.append(segment)
+                self.close_unused()
+        with self.index() as entries:
+            if entries.get(name, {}).get("pid") == os.getpid():
+                del entries[name]
+                unlink_segment(name)
+
+    # keep a segment open for the next loads of its shot, closing the least recently used ones beyond the budget
+    def keep(self, name, segment, size, budget):
+        self.segments[name] = (segment, size)
+        self.open_bytes += size
+        while self.open_bytes > budget and len(self.segments) > 1:
+            old_name, (old_segment, old_size) = self.segments.popitem(last=False)
+            self.open_bytes -= old_size
+            self.touched.pop(old_name, None)
+            self.closing.append(old_segment)
+        self.close_unused()
+
+    # close the segments whose arrays are no longer used
+    def close_unused(self):
+        for segment in list(self.closing):
+            try:
+                segment.close()
+            except BufferError:
+                continue
+            self.closing.remove(segment)
+
+
+# decoded shots shared by the routines of this process and the other processes on the host
+shot_cache = SharedShotCache()
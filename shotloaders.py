@@ -0,0 +1,180 @@
+# import libraries
+import os
+import re
+import json
+import struct
+import zipfile
+import warnings
+import numpy as np
+from statestore import to_array
+
+# a raw binary shot is described by a json header next to it named after the shot with this suffix, or by RAW_HEADER_NAME
+# in its directory for all raw shots without their own header
+# the header holds the "dtype" of the shot (a numpy type like "<f4", or a list of [name, type] fields) and optionally its
+# "shape", the "offset" (in bytes) of the data in the file and its "order"
+HEADER_SUFFIX = ".hdr"
+RAW_HEADER_NAME = "raw.hdr"
+# the key of a value of a json shot up to the opening bracket of a list, and what follows the list
+LIST_KEY = re.compile(r'\s*"((?:[^"\\]|\\.)*)"\s*:\s*\[')
+LIST_END = re.compile(r'\s*([,}])')
+# local file header of a member of a zip archive up to the lengths of its name and extra field (see the zip specification)
+ZIP_LOCAL_HEADER = struct.Struct("<4s22xHH")
+
+# functions loading a shot from its path indexed by the lowercase extension of the shot
+loaders = {}
+
+
+# decorator generator registering a function loading the shots with the given extensions
+def register_loader(*extensions):
+
+    def decorator(loader):
+        for extension in extensions:
+            loaders[extension.lower().lstrip(".")] = loader
+        return loader
+    return decorator
+
+
+# load a shot with the loader registered for its extension
+def load_shot(path):
+    extension = path.rsplit(".", 1)[-1].lower() if "." in os.path.basename(path) else ""
+    loader = loaders.get(extension)
+    if loader is None:
+        raise ValueError("there is no loader for '%s' shots" % os.path.basename(path))
+    return loader(path)
+
+
+# load several shots
+def load_shots(paths):
+    return [load_shot(path) for path in paths]
+
+
+# parse the numbers between the brackets of a json list into an array, or return None if they aren't plain numbers
+def parse_numbers(text):
+    if not text.strip():
+        return np.array([], dtype=float)
+    is_float = any(char in text for char in ".eEIN")
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", DeprecationWarning)
+            array = np.fromstring(text, dtype=float if is_float else np.int64, sep=",")
+    except ValueError:
+        return None
+    # older versions of numpy stop at the first thing that isn't a number instead of failing
+    if len(array) != text.count(",") + 1:
+        return None
+    # integers too large for an int64 are clipped, so they are left to the json parser
+    if not is_float and len(array) and (array.max() == np.iinfo(np.int64).max or array.min() == np.iinfo(np.int64).min):
+        return None
+    return array
+
+
+# parse a json object whose values are all flat lists of numbers straight into arrays, or return None if it has other values
+def parse_number_lists(text):
+    text = text.strip()
+    if not text.startswith("{") or not text.endswith("}"):
+        return None
+    data = {}
+    position = 1
+    while True:
+        match = LIST_KEY.match(text, position)
+        if match is None:
+            return None
+        start = match.end()
+        end = text.find("]", start)
+        # the list must not hold lists, objects or strings
+        if end < 0 or any(text.find(char, start, end) >= 0 for char in '[{"'):
+            return None
+        array = parse_numbers(text[start:end])
+        if array is None:
+            return None
+        data[json.loads('"%s"' % match.group(1))] = array
+        match = LIST_END.match(text, end + 1)
+        if match is None:
+            return None
+        position = match.end()
+        if match.group(1) == "}":
+            return data if position == len(text) else None
+
+
+# load a json shot, giving its lists of numbers as arrays
+# objects holding only flat lists of numbers (the usual traces) skip the json parser, other shots are parsed as json and
+# their lists of numbers converted afterwards
+@register_loader("json")
+def load_json(path):
+    with open(path) as file:
+        text = file.read()
+    data = parse_number_lists(text)
+    if data is not None:
+        return data
+    data = json.loads(text)
+    if isinstance(data, dict):
+        for key, value in data.items():
+            array = to_array(value)
+            if array is not None:
+                data[key] = array
+    return data
+
+
+# load a npy shot as a read-only memory map
+@register_loader("npy")
+def load_npy(path):
+    return np.load(path, mmap_mode="r")
+
+
+# map an array stored without compression in a zip archive, or return None if it can't be mapped
+def map_member(path, file, info):
+    file.seek(info.header_offset)
+    signature, name_length, extra_length = ZIP_LOCAL_HEADER.unpack(file.read(ZIP_LOCAL_HEADER.size))
+    if signature != b"PK\x03\x04":
+        return None
+    file.seek(info.header_offset + ZIP_LOCAL_HEADER.size + name_length + extra_length)
+    version = np.lib.format.read_magic(file)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(file)
+    else:
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(file)
+    if dtype.hasobject:
+        return None
+    if not shape or int(np.prod(shape)) == 0:
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", offset=file.tell(), shape=shape, order="F" if fortran_order else "C")
+
+
+# load the arrays of a npz shot indexed by name, mapping the arrays that were saved without compression (np.savez)
+# and reading the compressed ones (np.savez_compressed)
+@register_loader("npz")
+def load_npz(path):
+    arrays = {}
+    with open(path, "rb") as file, zipfile.ZipFile(file) as archive:
+        for info in archive.infolist():
+            name = info.filename[:-4] if info.filename.endswith(".npy") else info.filename
+            array = map_member(path, file, info) if info.compress_type == zipfile.ZIP_STORED else None
+            if array is None:
+                with archive.open(info) as member:
+                    array = np.lib.format.read_array(member, allow_pickle=False)
+            arrays[name] = array
+    return arrays
+
+
+# get the header describing a raw binary shot
+def read_raw_header(path):
+    for header_path in [path + HEADER_SUFFIX, os.path.join(os.path.dirname(path), RAW_HEADER_NAME)]:
+        if os.path.exists(header_path):
+            with open(header_path) as file:
+                return json.load(file)
+    raise ValueError("'%s' has no '%s' or '%s' header giving its dtype" % (os.path.basename(path), os.path.basename(path) + HEADER_SUFFIX, RAW_HEADER_NAME))
+
+
+# load a raw binary shot as a read-only memory map, whose fields can be used like the keys of the other shots
+@register_loader("bin", "raw")
+def load_raw(path):
+    header = read_raw_header(path)
+    dtype = header["dtype"]
+    dtype = np.dtype([tuple(field) for field in dtype] if isinstance(dtype, list) else dtype)
+    offset = header.get("offset", 0)
+    shape = header.get("shape")
+    if shape is None:
+        shape = ((os.path.getsize(path) - offset) // dtype.itemsize,)
+    if int(np.prod(shape)) == 0:
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=tuple(shape), order=header.get("order", "C"))
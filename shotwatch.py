@@ -0,0 +1,283 @@
+# import libraries
+import os
+import json
+import stat
+import time
+import select
+import struct
+import ctypes
+import ctypes.util
+import threading
+from statestore import write_atomic
+
+# time (in seconds) the size and modification time of a shot must stay the same before it is considered written
+DEBOUNCE = 1
+# time (in seconds) between two scans of the shots directory when inotify isn't available, which must be below DEBOUNCE
+POLL_INTERVAL = 0.25
+# time (in seconds) between two scans of the shots directory when inotify is available, since it doesn't see the shots
+# written by other machines to network file systems
+RESCAN_INTERVAL = 30
+# inotify events (see inotify(7))
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+# header of an inotify event as (watch, mask, cookie, length of the name)
+EVENT_HEADER = struct.Struct("iIII")
+
+
+# watch a directory with inotify, returning the file descriptor of the events or None if inotify isn't available
+def open_inotify(path):
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        inotify_init1, inotify_add_watch = libc.inotify_init1, libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    descriptor = inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    if descriptor < 0:
+        return None
+    if inotify_add_watch(descriptor, os.fsencode(path), WATCH_MASK) < 0:
+        os.close(descriptor)
+        return None
+    return descriptor
+
+
+# read the pending inotify events, returning the names of the files they are about and whether events were lost
+def read_events(descriptor):
+    names = set()
+    lost = False
+    while True:
+        try:
+            buffer = os.read(descriptor, 65536)
+        except BlockingIOError:
+            break
+        if not buffer:
+            break
+        offset = 0
+        while offset < len(buffer):
+            watch, mask, cookie, length = EVENT_HEADER.unpack_from(buffer, offset)
+            offset += EVENT_HEADER.size
+            name = buffer[offset:offset + length].rstrip(b"\0")
+            offset += length
+            # the queue overflowed or the directory itself went away
+            if mask & (IN_Q_OVERFLOW | IN_IGNORED):
+                lost = True
+            elif name:
+                names.add(os.fsdecode(name))
+    return names, lost
+
+
+# get the identity of a shot from its file information as [inode, size, modification time in nanoseconds], which only
+# changes when the shot is replaced or written again, unlike its change time which also changes with its permissions
+def get_identity(info):
+    return [info[3], info[0], info[1]]
+
+
+# the shots of a directory and whether they are still being written, kept up to date by a background thread
+# a shot is settled once its size and modification time stayed the same for DEBOUNCE seconds, and the listeners are
+# called whenever shots settle
+class ShotWatcher(object):
+
+    def __init__(self, path):
+        self.path = path
+        # file information indexed by name as (size, modification time, change time, inode), both times in nanoseconds
+        self.stats = {}
+        # time each shot that didn't settle yet last changed
+        self.unsettled = {}
+        # functions called without arguments when shots settle
+        self.listeners = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        # set once the directory was scanned for the first time, so the shots it held are known
+        self.scanned = threading.Event()
+        self.thread = None
+
+    # call a function whenever shots settle, starting to watch the directory if necessary
+    def add_listener(self, listener):
+        with self.lock:
+            self.listeners.add(listener)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.watch, name="shots-%s" % os.path.basename(self.path), daemon=True)
+                self.thread.start()
+
+    # stop calling a function, and stop watching the directory once nobody listens, returning whether it stopped
+    def remove_listener(self, listener):
+        with self.lock:
+            self.listeners.discard(listener)
+            if self.listeners:
+                return False
+            self.stopped.set()
+            return True
+
+    def watch(self):
+        descriptor = open_inotify(self.path)
+        try:
+            self.scan()
+            self.scanned.set()
+            self.notify()
+            last_scan = time.monotonic()
+            while not self.stopped.is_set():
+                # look at unsettled shots more often so they are analysed soon after they settle
+                timeout = min(POLL_INTERVAL, DEBOUNCE / 4) if self.unsettled else POLL_INTERVAL
+                if descriptor is None:
+                    self.stopped.wait(timeout)
+                    self.scan()
+                else:
+                    if select.select([descriptor], [], [], timeout)[0]:
+                        names, lost = read_events(descriptor)
+                        if lost:
+                            # the events of the directory can't be trusted anymore, so it is polled instead
+                            os.close(descriptor)
+                            descriptor = None
+                            self.scan()
+                        for name in names:
+                            self.update(name)
+                    if time.monotonic() - last_scan > RESCAN_INTERVAL:
+                        last_scan = time.monotonic()
+                        self.scan()
+                self.settle()
+        finally:
+            if descriptor is not None:
+                os.close(descriptor)
+
+    # update the file information of a shot, which becomes unsettled if it changed
+    def update(self, name, entry=None):
+        if name.startswith("."):
+            return
+        try:
+            info = entry.stat() if entry is not None else os.stat(os.path.join(self.path, name))
+        except OSError:
+            info = None
+        with self.lock:
+            if info is None or not stat.S_ISREG(info.st_mode):
+                self.stats.pop(name, None)
+                self.unsettled.pop(name, None)
+                return
+            new_stat = (info.st_size, info.st_mtime_ns, info.st_ctime_ns, info.st_ino)
+            if self.stats.get(name) != new_stat:
+                self.stats[name] = new_stat
+                self.unsettled[name] = time.monotonic()
+
+    # update the file information of every shot in the directory
+    def scan(self):
+        names = set()
+        try:
+            with os.scandir(self.path) as entries:
+                for entry in entries:
+                    names.add(entry.name)
+                    self.update(entry.name, entry)
+        except OSError:
+            pass
+        with self.lock:
+            for name in [name for name in self.stats if name not in names]:
+                del self.stats[name]
+                self.unsettled.pop(name, None)
+
+    # call the listeners
+    def notify(self):
+        with self.lock:
+            listeners = list(self.listeners)
+        for listener in listeners:
+            listener()
+
+    # settle the shots that didn't change for DEBOUNCE seconds and tell the listeners
+    def settle(self):
+        now = time.monotonic()
+        # look at the shots once more, in case they were written without sending events
+        for name in [name for name, changed in list(self.unsettled.items()) if now - changed >= DEBOUNCE]:
+            self.update(name)
+        with self.lock:
+            settled = [name for name, changed in self.unsettled.items() if now - changed >= DEBOUNCE]
+            for name in settled:
+                del self.unsettled[name]
+        if settled:
+            self.notify()
+
+    # get the identities of all shots indexed by name
+    def get_identities(self):
+        with self.lock:
+            return {name: get_identity(info) for name, info in self.stats.items()}
+
+    # get the settled shots accepted by a function that weren't analysed yet, as their identities indexed by name in the
+    # order they arrived, given the identities of the analysed shots indexed by name
+    # shots are ordered by change time, and a batch ends before the first shot still being written so it doesn't overtake
+    # it, but a shot only counts as analysed by its identity, so a shot whose permissions or change time change isn't
+    # analysed again, and a shot arriving with an earlier change time than the analysed shots (because clocks differ) is
+    # still analysed
+    def get_batch(self, analysed, accept):
+        with self.lock:
+            arrivals = sorted((info[2], name) for name, info in self.stats.items() if analysed.get(name) != get_identity(info))
+            batch = {}
+            for ctime, name in arrivals:
+                if not accept(name):
+                    continue
+                if name in self.unsettled:
+                    break
+                batch[name] = get_identity(self.stats[name])
+        return batch
+
+
+# watchers shared by all routines indexed by the path to the shots directory
+watchers = {}
+watchers_lock = threading.Lock()
+
+
+# call a function whenever shots settle in a directory, returning the watcher of the directory
+def watch_shots(shots_dir_path, listener):
+    shots_dir_path = os.path.abspath(shots_dir_path)
+    with watchers_lock:
+        watcher = watchers.get(shots_dir_path)
+        if watcher is None:
+            watcher = watchers[shots_dir_path] = ShotWatcher(shots_dir_path)
+        watcher.add_listener(listener)
+    return watcher
+
+
+# stop calling a function when shots settle, forgetting the watcher once nobody listens
+def unwatch_shots(watcher, listener):
+    with watchers_lock:
+        if watcher.remove_listener(listener) and watchers.get(watcher.path) is watcher:
+            del watchers[watcher.path]
+
+
+# the shots analysed by every routine as their identities (see get_identity) indexed by name, kept in a json file so every
+# shot is analysed once even if the server restarts
+class ArrivalStore(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(path) as file:
+                self.shots = json.load(file)
+        except (OSError, ValueError):
+            self.shots = {}
+
+    # get the identities of the shots analysed for a key indexed by name, or None if nothing was recorded for it yet
+    def get(self, key):
+        with self.lock:
+            shots = self.shots.get(key)
+            return dict(shots) if shots is not None else None
+
+    # check if all shots of a batch (as identities indexed by name) were analysed for a key
+    def contains(self, key, batch):
+        with self.lock:
+            shots = self.shots.get(key) or {}
+            return all(shots.get(name) == identity for name, identity in batch.items())
+
+    # record shots (as identities indexed by name) as analysed for a key and write all shots to the file, forgetting the
+    # shots that are no longer in the directory if the names of the shots present are given
+    def record(self, key, batch, present=None):
+        with self.lock:
+            shots = self.shots.get(key) or {}
+            shots.update(batch)
+            if present is not None:
+                shots = {name: identity for name, identity in shots.items() if name in present}
+            self.shots[key] = shots
+            write_atomic(self.path, json.dumps(self.shots).encode("utf-8"))
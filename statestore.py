@@ -0,0 +1,221 @@
+# import libraries
+import os
+import json
+import tempfile
+import numpy as np
+
+# the state of a read-write file is kept in a directory next to it, named after the file with this suffix
+STORE_SUFFIX = ".state"
+HEADER_NAME = "header.json"
+# mode given to new files by write_atomic, which is what open gives them under the umask of the process
+UMASK = os.umask(0)
+os.umask(UMASK)
+NEW_FILE_MODE = 0o666 & ~UMASK
+
+
+# get the directory holding the state of a read-write file
+def get_store_path(data_path):
+    return data_path + STORE_SUFFIX
+
+
+# get the header of the state of a read-write file, which is rewritten on every commit
+def get_header_path(data_path):
+    return os.path.join(get_store_path(data_path), HEADER_NAME)
+
+
+# get the version of a file as (size, modification time in nanoseconds), or None if it doesn't exist
+def get_source_version(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+# convert a value to an array if it is a list of numbers (or of lists of numbers of the same length), or return None
+def to_array(value):
+    if isinstance(value, np.ndarray):
+        array = value
+    elif isinstance(value, list):
+        try:
+            array = np.asarray(value)
+        except ValueError:
+            return None
+    else:
+        return None
+    if array.ndim == 0 or array.dtype.kind not in "biuf":
+        return None
+    return array
+
+
+# write a file next to its destination and move it into place, so readers only ever see the old or the new content
+# the file keeps its mode, or gets the mode of new files if it doesn't exist yet, instead of the private mode of temporary files
+def write_atomic(path, content):
+    try:
+        mode = os.stat(path).st_mode & 0o7777
+    except OSError:
+        mode = NEW_FILE_MODE
+    descriptor, temp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=".tmp-")
+    try:
+        with os.fdopen(descriptor, "wb") as file:
+            file.write(content)
+        os.chmod(temp_path, mode)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+# the data a routine keeps from one run to the next: growing arrays of numbers stored as raw files that are appended to
+# in place and read through memory maps, plus small values kept in a json header
+# appends only become visible to other readers when the header is committed, so an interrupted run leaves the last committed state
+class StateStore(object):
+
+    def __init__(self, data_path):
+        self.data_path = data_path
+        self.path = get_store_path(data_path)
+        self.header_path = get_header_path(data_path)
+        source = get_source_version(data_path)
+        header = self.read_header()
+        # migrate the read-write file when there is no state yet or when it was edited since the last migration
+        if not header or (source is not None and source != header["source"]):
+            header = self.migrate(source, header)
+        self.values = header["values"]
+        self.arrays = header["arrays"]
+        self.next_file = header["next_file"]
+        self.source = header["source"]
+        # array files replaced since the last commit, deleted once the new header no longer refers to them
+        self.obsolete = []
+
+    # create the state from the content of the read-write json file, replacing the previous state if there is one
+    def migrate(self, source, previous_header):
+        data = {}
+        if source is not None and source[0] > 0:
+            with open(self.data_path) as file:
+                data = json.load(file)
+        if not isinstance(data, dict):
+            raise ValueError("'%s' must contain a json object to be used as state" % self.data_path)
+        os.makedirs(self.path, exist_ok=True)
+        self.values, self.arrays, self.source = {}, {}, source
+        self.next_file = previous_header.get("next_file", 0)
+        self.obsolete = [info["file"] for info in previous_header.get("arrays", {}).values()]
+        for key, value in data.items():
+            self[key] = value
+        self.commit()
+        return dict(values=self.values, arrays=self.arrays, next_file=self.next_file, source=source)
+
+    # read the committed header, or an empty one if there is none
+    def read_header(self):
+        try:
+            with open(self.header_path) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    # get the keys of all arrays and values
+    def keys(self):
+        return list(self.arrays) + list(self.values)
+
+    def __contains__(self, key):
+        return key in self.arrays or key in self.values
+
+    # get an array as a read-only memory map (including uncommitted appends) or a value
+    def __getitem__(self, key):
+        if key not in self.arrays:
+            return self.values[key]
+        info = self.arrays[key]
+        dtype = np.dtype(info["dtype"])
+        shape = (info["length"],) + tuple(info["shape"])
+        # empty files can't be mapped
+        if 0 in shape:
+            return np.empty(shape, dtype)
+        return np.memmap(os.path.join(self.path, info["file"]), dtype=dtype, mode="r", shape=shape)
+
+    # replace an array (from a list of numbers or a numpy array) or a value
+    def __setitem__(self, key, value):
+        self.discard(key)
+        array = to_array(value)
+        if array is None:
+            # numpy scalars are stored as plain numbers
+            self.values[key] = value.item() if isinstance(value, np.generic) else value
+            return
+        file_name = "%d.bin" % self.next_file
+        self.next_file += 1
+        array = np.ascontiguousarray(array)
+        with open(os.path.join(self.path, file_name), "wb") as file:
+            file.write(array.tobytes())
+        self.arrays[key] = dict(file=file_name, dtype=array.dtype.str, shape=list(array.shape[1:]), length=len(array))
+
+    # remove an array or a value
+    def discard(self, key):
+        self.values.pop(key, None)
+        info = self.arrays.pop(key, None)
+        if info is not None:
+            self.obsolete.append(info["file"])
+
+    # append rows to an array, writing only the new data, and create the array if it doesn't exist yet
+    def append(self, key, rows):
+        rows = np.asarray(rows)
+        if key in self.values:
+            raise TypeError("'%s' is not an array of numbers and can't be appended to" % key)
+        if key not in self.arrays:
+            if to_array(rows if rows.ndim else rows.reshape(1)) is None:
+                raise TypeError("only numbers can be appended to '%s'" % key)
+            self[key] = rows if rows.ndim else rows.reshape(1)
+            return
+        info = self.arrays[key]
+        dtype = np.dtype(info["dtype"])
+        shape = tuple(info["shape"])
+        # a single row can be appended on its own
+        if rows.shape == shape:
+            rows = rows[np.newaxis]
+        if rows.shape[1:] != shape:
+            raise ValueError("can't append rows of shape %s to '%s' whose rows have shape %s" % (rows.shape[1:], key, shape))
+        if np.result_type(dtype, rows.dtype) != dtype:
+            # widen the whole array, for example when floats are appended to integers
+            self[key] = np.concatenate([self[key], rows])
+            return
+        with open(os.path.join(self.path, info["file"]), "r+b") as file:
+            # overwrite anything past the committed rows, left behind by a run that didn't commit
+            file.seek(info["length"] * dtype.itemsize * int(np.prod(shape)))
+            file.write(rows.astype(dtype).tobytes())
+            file.truncate()
+        info["length"] += len(rows)
+
+    # replace the whole state by the content of a dictionary
+    def replace(self, data):
+        for key in self.keys():
+            if key not in data:
+                self.discard(key)
+        for key, value in data.items():
+            self[key] = value
+
+    # get the whole state as a dictionary of lists and values, like the content of the read-write json file
+    def to_dict(self):
+        data = dict(self.values)
+        for key in self.arrays:
+            data[key] = self[key].tolist()
+        return data
+
+    # make the changes since the last commit visible by atomically replacing the header
+    def commit(self):
+        header = dict(values=self.values, arrays=self.arrays, next_file=self.next_file, source=self.source)
+        write_atomic(self.header_path, json.dumps(header).encode("utf-8"))
+        for file_name in self.obsolete:
+            try:
+                os.unlink(os.path.join(self.path, file_name))
+            except OSError:
+                pass
+        self.obsolete = []
+
+
+# check if the state of a read-write file was already migrated to a state store
+def has_store(data_path):
+    return os.path.isfile(get_header_path(data_path))
+
+
+# check if a path is the directory holding the state of a read-write file, which is next to the file or has a header
+def is_store_path(path):
+    if not path.endswith(STORE_SUFFIX):
+        return False
+    return os.path.isfile(path[:-len(STORE_SUFFIX)]) or os.path.isfile(os.path.join(path, HEADER_NAME))
@@ -1,5 +1,7 @@
 
 // initialize global variables
+// the id of this page, so stopping or pausing the analysis here doesn't affect other pages watching it
+var viewer_id = Math.random().toString(36).slice(2) + Date.now().toString(36);
 var paused = false;
 var timeElapsed = 0;
 var timerID = -1;
@@ -71,10 +73,52 @@ function update_img(url, container, keep_size) {
     });
 }
 
+// show the progress of the analysis of the old shots of a routine
+function update_progress(routine_name, progress) {
+    var line = $("#progress").children().filter(function () {
+        return $(this).data("routine") === routine_name;
+    });
+    if (line.length === 0) {
+        line = $("<p class='progress'></p>").data("routine", routine_name).appendTo("#progress");
+    }
+    line.text(routine_name + ": " + progress);
+}
+
+// update the cells of a data table whose values changed and remove the rows of parameters that are gone, keeping the rows sorted
+function update_table(container, changed, removed) {
+    var body = $("#" + container + " tbody");
+    var rows = body.children("tr");
+    var find_row = function (param) {
+        return rows.filter(function () {
+            return $(this).attr("data-param") === param;
+        });
+    };
+    $.each(removed, function (i, param) {
+        find_row(param).remove();
+    });
+    $.each(changed, function (param, value) {
+        var row = find_row(param);
+        if (row.length === 0) {
+            row = $("<tr><th></th><td></td></tr>").attr("data-param", param);
+            row.children("th").text(param);
+            var next = body.children("tr").filter(function () {
+                return $(this).attr("data-param") > param;
+            }).first();
+            if (next.length === 0) {
+                body.append(row);
+            } else {
+                row.insertBefore(next);
+            }
+            rows = body.children("tr");
+        }
+        row.children("td").text(value);
+    });
+}
+
 // start the analysis
 $("#start-analysis").on("click", function () {
     if (!$(this).hasClass("inactive")) {
-        Sijax.request("analyse", [paused]);
+        Sijax.request("analyse", [viewer_id, paused]);
         $("#start-analysis").addClass("inactive");
         $("#stop-analysis").removeClass("inactive");
         $("#pause-analysis").removeClass("inactive");
@@ -85,21 +129,39 @@ $("#start-analysis").on("click", function () {
 $("#pause-analysis").on("click", function () {
     if (!$(this).hasClass("inactive")) {
         paused = true;
-        Sijax.request("pause_analysis");
+        Sijax.request("pause_analysis", [viewer_id]);
         $("#start-analysis").removeClass("inactive");
         $("#pause-analysis").addClass("inactive");
     }
 });
 
-// request analyse_routine
-function make_comet_request(data_dir, routine, period) {
-    sjxComet.request("analyse_routine", [data_dir, routine, period]);
-}
+// receive the updates of the analysis from the push server, which the browser reconnects to and resumes by itself
+var updates = new EventSource(location.protocol + "//" + location.hostname + ":" + push_port + "/events?viewer=" + viewer_id);
+updates.addEventListener("plot", function (event) {
+    var update = JSON.parse(event.data);
+    if (update.url) {
+        update_img(update.url, update.plot_id, "true");
+    }
+    if (update.table_id) {
+        update_table(update.table_id, update.changed, update.removed);
+    }
+});
+updates.addEventListener("progress", function (event) {
+    var progress = JSON.parse(event.data);
+    update_progress(progress.routine, progress.text);
+});
+updates.addEventListener("status", function (event) {
+    $("#status").append(JSON.parse(event.data).html + "<br/>");
+});
+updates.addEventListener("stop", function () {
+    stop_analysis();
+});
 
 // stop the analysis
 function stop_analysis() {
     paused = false;
-    Sijax.request("stop_analysis");
+    $("#progress").empty();
+    Sijax.request("stop_analysis", [viewer_id]);
     $("#start-analysis").removeClass("inactive");
     $("#stop-analysis").addClass("inactive");
     $("#pause-analysis").addClass("inactive");
@@ -6,12 +6,11 @@ $(".filetree").on("click", ".tree-item.routine, .main-item.routine", function ()
         $("#revert-analysis").trigger("click");
         Sijax.request("display_routine_info", [$(this).text()]);
     }
-    $("#shots-choice").select2({
-        maximumSelectionLength: parseInt($("#num-shots").val(), 10)
-    });
+    init_shots_choice();
     $("#filetype").select2({
         tags: true
     });
+    $("#depends-on").select2();
 });
 
 // reset all routine information when routine selection changes
@@ -46,6 +45,27 @@ $("#json-options").on("change", function () {
     Sijax.request("set_json_options", [routine_name, json_file]);
 });
 
+// select how the routine is executed, its priority and its timeout
+$("#execution-options, #priority, #timeout").on("change", function () {
+    var routine_name = $(".selected").text();
+    var execution = Sijax.getFormValues("#routine-execution");
+    Sijax.request("set_execution_options", [routine_name, execution]);
+});
+
+// select the routines whose results the routine uses
+$("#depends-on").on("change", function () {
+    var routine_name = $(".selected").text();
+    Sijax.request("set_dependencies", [routine_name, $("#depends-on").val() || []]);
+});
+
+// replace the dependency options by the other routines, selecting the routines the routine depends on
+function set_dependencies(names, selected) {
+    var options = $.map(names, function (name) {
+        return new Option(name, name, false, selected.indexOf(name) >= 0);
+    });
+    $("#depends-on").empty().append(options).trigger("change.select2");
+}
+
 // revert the analysis options (i.e. undo changes)
 $("#revert-analysis").on("click", function () {
     if (!$(this).hasClass("inactive")) {
@@ -56,6 +76,12 @@ $("#revert-analysis").on("click", function () {
     }
 });
 
+// skip the arrived shots the routine failed to analyse
+$("#skip-shots").on("click", function () {
+    var routine_name = $(".selected").text();
+    Sijax.request("skip_failed_shots", [routine_name]);
+});
+
 // update which analysis options are available
 function check_shots_display() {
     var new_analysis = $("#oldnew-toggle").prop("checked");
@@ -64,7 +90,7 @@ function check_shots_display() {
     if (new_analysis) {
         select = document.getElementById("select-shots-by");
         selected_method = select.options[select.selectedIndex].value;
-        var methods_no_num_shots = ["all", "new", "modified"];
+        var methods_no_num_shots = ["all", "new", "modified", "arrival"];
         $("#regex-container").show();
         $("#regex-label-des").text("filter");
         if (methods_no_num_shots.indexOf(selected_method) >= 0) {
@@ -72,6 +98,11 @@ function check_shots_display() {
         } else {
             $("#num-shots-container").show();
         }
+        if (selected_method === "arrival") {
+            $("#skip-shots-container").show();
+        } else {
+            $("#skip-shots-container").hide();
+        }
     } else {
         select = document.getElementById("order-shots-by");
         selected_method = select.options[select.selectedIndex].value;
@@ -94,10 +125,31 @@ function check_shots_display() {
 // change the number of shots
 $("#num-shots").on("change", function() {
     $("#shots-choice").val(null);
+    init_shots_choice();
+});
+
+// set up the shots picker, which fetches the shots of the selected routine page by page as it is scrolled or searched
+function init_shots_choice() {
     $("#shots-choice").select2({
-        maximumSelectionLength: parseInt($("#num-shots").val(), 10)
+        maximumSelectionLength: parseInt($("#num-shots").val(), 10),
+        ajax: {
+            url: "/shots",
+            dataType: "json",
+            delay: 250,
+            data: function (params) {
+                return {routine: $(".selected").text(), term: params.term || "", page: params.page || 1};
+            }
+        }
     });
-});
+}
+
+// replace the shots picker options by the chosen shots in a single update
+function set_shots_choice(choice) {
+    var options = $.map(choice, function (shot) {
+        return new Option(shot, shot, true, true);
+    });
+    $("#shots-choice").empty().append(options).trigger("change.select2");
+}
 
 // update analysis options
 $("#update-analysis").on("click", function () {
@@ -0,0 +1,294 @@
+# import libraries
+import os
+import sys
+import io
+import atexit
+import importlib
+import traceback
+import threading
+import contextlib
+import subprocess
+from multiprocessing.connection import Connection
+from metrics import spawn_seconds
+from runcontrol import kill_process_group
+
+# number of runs after which a worker is replaced
+MAX_RUNS = 200
+# peak resident memory (in bytes) after which a worker is replaced
+MAX_MEMORY = 1024 ** 3
+# modules imported once by every worker before it accepts jobs
+PRELOAD_MODULES = ["numpy", "scipy.optimize", "matplotlib.pyplot", "seneca_analysis"]
+# path to this script, which is started as the worker process
+WORKER_SCRIPT = os.path.abspath(__file__)
+
+
+# raised when a worker process dies or stops responding
+class WorkerError(Exception):
+    pass
+
+
+# get the peak resident memory of the current process in bytes
+def get_peak_memory():
+    try:
+        import resource
+    except ImportError:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes everywhere except macOS
+    if sys.platform == "darwin":
+        return peak
+    return peak * 1024
+
+
+# a long-lived python process that keeps the analysis libraries imported between runs
+class Worker(object):
+
+    def __init__(self):
+        env = dict(os.environ)
+        env.setdefault("MPLBACKEND", "Agg")
+        # in its own process group, so killing a run also kills the processes the routine started
+        self.process = subprocess.Popen(["python", WORKER_SCRIPT], stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env, start_new_session=True)
+        # talk to the worker over its standard input and output
+        self.writer = Connection(os.dup(self.process.stdin.fileno()), readable=False)
+        self.reader = Connection(os.dup(self.process.stdout.fileno()), writable=False)
+        self.runs = 0
+        self.memory = 0
+
+    # run a routine with the given command line arguments and results of the routines it depends on, yielding its plots as they arrive
+    # returns the printed output of the routine and whether it failed
+    def run(self, path_to_routine, arguments, upstream=None):
+        try:
+            self.writer.send((path_to_routine, arguments, upstream))
+            while True:
+                message = self.reader.recv()
+                if message[0] != "plot":
+                    break
+                yield message[1]
+        except (EOFError, OSError) as err:
+            raise WorkerError("worker for '%s' exited unexpectedly (%s)" % (os.path.basename(path_to_routine), err))
+        status, output, failed, self.memory = message
+        self.runs += 1
+        return output, failed
+
+    # kill the worker in the middle of a run, which ends the run with a WorkerError
+    def kill(self):
+        kill_process_group(self.process)
+
+    # check if the worker should be replaced
+    def expired(self, max_runs, max_memory):
+        return self.runs >= max_runs or self.memory >= max_memory
+
+    # stop the worker process
+    def close(self):
+        for conn in [self.writer, self.reader]:
+            try:
+                conn.close()
+            except OSError:
+                pass
+        for pipe in [self.process.stdin, self.process.stdout]:
+            try:
+                pipe.close()
+            except OSError:
+                pass
+        try:
+            self.process.wait(timeout=1)
+        except subprocess.TimeoutExpired:
+            self.kill()
+            self.process.wait()
+
+
+# a pool of warm workers for a single routine
+class WorkerPool(object):
+
+    def __init__(self, size=1, max_runs=MAX_RUNS, max_memory=MAX_MEMORY, name=""):
+        self.size = size
+        # name of the routine the workers run, for the metrics
+        self.name = name
+        self.max_runs = max_runs
+        self.max_memory = max_memory
+        self.idle = []
+        self.num_workers = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+    # take an idle worker, starting a new one if the pool is not full
+    def acquire(self):
+        with self.condition:
+            while not self.idle and self.num_workers >= self.size:
+                self.condition.wait()
+            if self.idle:
+                return self.idle.pop()
+            self.num_workers += 1
+        try:
+            with spawn_seconds.time(routine=self.name):
+                return Worker()
+        except Exception:
+            with self.condition:
+                self.num_workers -= 1
+                self.condition.notify()
+            raise
+
+    # return a worker to the pool, replacing it if it is broken, too old or too large
+    def release(self, worker, broken=False):
+        with self.condition:
+            if broken or self.closed or worker.expired(self.max_runs, self.max_memory):
+                self.num_workers -= 1
+                retire = True
+            else:
+                self.idle.append(worker)
+                retire = False
+            self.condition.notify()
+        if retire:
+            worker.close()
+
+    # run a routine on a worker from the pool, yielding its plots as they arrive
+    # cancelling the control of the run kills the worker, which is replaced by a new one
+    def run(self, path_to_routine, arguments, control=None, upstream=None):
+        worker = self.acquire()
+        finished = False
+        try:
+            with control.killing(worker.kill) if control else contextlib.nullcontext():
+                result = yield from worker.run(path_to_routine, arguments, upstream)
+            finished = True
+        finally:
+            # a worker that died or was abandoned in the middle of a run can't be reused
+            self.release(worker, broken=not finished)
+        return result
+
+    # change the number of workers in the pool
+    def resize(self, size):
+        with self.condition:
+            self.size = size
+            self.condition.notify_all()
+
+    # stop all idle workers and retire busy workers when they are released
+    def close(self):
+        with self.condition:
+            self.closed = True
+            idle, self.idle = self.idle, []
+            self.num_workers -= len(idle)
+        for worker in idle:
+            worker.close()
+
+
+# worker pools indexed by the path to the routine
+pools = {}
+pools_lock = threading.Lock()
+
+
+# get the worker pool for a routine, creating it if necessary
+def get_pool(path_to_routine, size=1):
+    with pools_lock:
+        pool = pools.get(path_to_routine)
+        if pool is None:
+            pool = pools[path_to_routine] = WorkerPool(size, name=os.path.basename(path_to_routine))
+        elif pool.size < size:
+            pool.resize(size)
+        return pool
+
+
+# stop the workers for a routine, for example after it is removed
+def close_pool(path_to_routine):
+    with pools_lock:
+        pool = pools.pop(path_to_routine, None)
+    if pool:
+        pool.close()
+
+
+# stop all workers
+@atexit.register
+def close_all_pools():
+    with pools_lock:
+        all_pools = list(pools.values())
+        pools.clear()
+    for pool in all_pools:
+        pool.close()
+
+
+# drop modules imported from a directory whose source files changed since they were imported
+def purge_stale_modules(directory, import_times):
+    for name, module in list(sys.modules.items()):
+        filename = getattr(module, "__file__", None)
+        if not filename or os.path.dirname(os.path.abspath(filename)) != directory:
+            continue
+        try:
+            mtime = os.path.getmtime(filename)
+        except OSError:
+            mtime = None
+        if name in import_times and import_times[name] != mtime:
+            del sys.modules[name]
+            del import_times[name]
+        elif name not in import_times:
+            import_times[name] = mtime
+
+
+# run a routine as if it were started with 'python <routine> <arguments>', passing each plot to send_plot and giving it the
+# results of the routines it depends on
+# returns the printed output of the routine and whether it failed
+def run_job(path_to_routine, arguments, send_plot, code_cache, import_times, upstream=None):
+    import seneca_analysis
+    stream = io.StringIO()
+    failed = False
+    save_argv, save_path = sys.argv, list(sys.path)
+    save_stdout, save_stderr = sys.stdout, sys.stderr
+    directory = os.path.dirname(os.path.abspath(path_to_routine))
+    sys.argv = [path_to_routine] + list(arguments)
+    sys.path.insert(0, directory)
+    sys.stdout = sys.stderr = stream
+    try:
+        purge_stale_modules(directory, import_times)
+        # compile the routine once per modification
+        mtime = os.path.getmtime(path_to_routine)
+        cached = code_cache.get(path_to_routine)
+        if cached is None or cached[0] != mtime:
+            with open(path_to_routine, "rb") as file:
+                cached = code_cache[path_to_routine] = (mtime, compile(file.read(), path_to_routine, "exec"))
+        with seneca_analysis.plot_handler(send_plot), seneca_analysis.upstream_results(upstream or {}):
+            exec(cached[1], dict(__name__="__main__", __file__=path_to_routine, __builtins__=__builtins__))
+    except SystemExit as err:
+        if err.code not in (None, 0):
+            failed = True
+            traceback.print_exc()
+    except BaseException:
+        failed = True
+        traceback.print_exc()
+    finally:
+        sys.stdout, sys.stderr = save_stdout, save_stderr
+        sys.argv, sys.path[:] = save_argv, save_path
+        # close figures left open by the routine so they don't accumulate between runs
+        seneca_analysis.close_figures()
+        purge_stale_modules(directory, import_times)
+    return stream.getvalue(), failed
+
+
+# serve jobs from the parent process until its end of the pipe is closed
+def serve():
+    # keep the original standard input and output for the job protocol and send stray output to stderr
+    reader = Connection(os.dup(0), writable=False)
+    writer = Connection(os.dup(1), readable=False)
+    os.dup2(2, 1)
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(devnull, 0)
+    os.close(devnull)
+    # pay the import cost once
+    for module in PRELOAD_MODULES:
+        try:
+            importlib.import_module(module)
+        except Exception:
+            pass
+    code_cache = {}
+    import_times = {}
+    while True:
+        try:
+            job = reader.recv()
+        except (EOFError, OSError):
+            break
+        path_to_routine, arguments, upstream = job
+        # send each plot back as soon as it is rendered
+        send_plot = lambda *record: writer.send(("plot", record))
+        output, failed = run_job(path_to_routine, arguments, send_plot, code_cache, import_times, upstream)
+        writer.send(("done", output, failed, get_peak_memory()))
+
+
+if __name__ == "__main__":
+    serve()